@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from date_utils import DateUtils
+from price_data import ArrayPriceData
+from price_data_io import PriceReader , PriceWriter
+from price_store import PriceStore
+from data_manager import DataManager , PriceDataCache
+from profitability_filter import ProfitabilityRanker
+from price_crawler import benchmark_json_parsing , benchmark_html_parsing
+from stub_server import StubGrandExchangeServer
+from instrumentation import Instrumentation
+
+'''
+Generates a synthetic Grand Exchange dataset: price data for any number of
+made up commodities over any number of days, laid out on disk the same way
+as the real data (price_data/item_ids, price_data/master_list and the month
+partition files), so that the code that reads and writes the real data can
+be timed at sizes we do not have yet.
+
+Daily prices follow a random walk with occasional reversals, the average
+price is the 30-day moving average of the daily price, and the first tenth
+of every history has no volumes, as in the real data.
+'''
+class SyntheticDataset( object ):
+
+    '''
+    Creates a SyntheticDataset. Nothing is generated until generate() is
+    called, and the same parameters always generate the same data.
+
+    @param numItems - the number of commodities
+    @param numDays - the number of days of price data for every commodity
+    @param seed - the seed of the random number generator
+    @param startDate - the first day of price data, as a (year, month, day)
+    tuple
+    '''
+    def __init__( self , numItems=100 , numDays=365 , seed=0 , startDate=(2015 , 3 , 1) ):
+        self.numItems = numItems
+        self.numDays = numDays
+        self.seed = seed
+        self.startOrdinal = DateUtils.to_ordinal( *startDate )
+
+    '''
+    @return - the IDs of the commodities in the dataset, as a list of integers
+    '''
+    def get_ids( self ):
+        return range( 1 , self.numItems+1 )
+
+    '''
+    Generates the price data of one commodity.
+
+    @param commodityId - the ID of the commodity, as an integer
+    @return - an ArrayPriceData object with the commodity's price data
+    '''
+    def get_price_data( self , commodityId ):
+        random = np.random.RandomState( self.seed*1000003 + commodityId )
+        dates = np.arange( self.startOrdinal , self.startOrdinal + self.numDays , dtype=np.int32 )
+
+        #a random walk whose drift changes sign every few weeks
+        base = np.exp( random.uniform( np.log( 10 ) , np.log( 1000000 ) ) )
+        drift = np.repeat( random.normal( 0 , 0.01 , self.numDays//20 + 1 ) , 20 )[ 0:self.numDays ]
+        steps = drift + random.normal( 0 , 0.03 , self.numDays )
+        daily = np.maximum( 1 , np.round( base*np.exp( np.cumsum( steps ) ) ) ).astype( np.int64 )
+
+        sums = np.cumsum( np.concatenate( ( [ 0 ] , daily ) ) )
+        starts = np.maximum( 0 , np.arange( 1 , self.numDays+1 ) - 30 )
+        average = (sums[ 1: ] - sums[ starts ])//(np.arange( 1 , self.numDays+1 ) - starts)
+
+        volume = np.round( random.lognormal( random.uniform( 2 , 12 ) , 1 , self.numDays ) ).astype( np.int64 )
+        volume[ 0:self.numDays//10 ] = 0
+        return ArrayPriceData( commodityId , "Synthetic item " + str( commodityId ) , \
+                               dates , daily , average , volume )
+
+    '''
+    Writes the dataset to price_data in the current directory.
+
+    @param partitions - if True, the month partition files are written too
+    @param batchSize - how many commodities are written to the month
+    partition files at a time
+    @return - how many seconds it took to write the month partition files
+    '''
+    def generate( self , partitions=True , batchSize=500 ):
+        if ( not os.path.exists( "price_data/master_list" ) ):
+            os.makedirs( "price_data/master_list" )
+
+        #every commodity has the same dates, so their text is made only once
+        dateText = [ str( x ).replace( "-" , "," ) for x in \
+                     np.arange( self.startOrdinal - DateUtils.EPOCH_ORDINAL , \
+                                self.startOrdinal - DateUtils.EPOCH_ORDINAL + self.numDays ).astype( "datetime64[D]" ) ]
+        ids = open( "price_data/item_ids" , "w" )
+        for commodityId in self.get_ids():
+            priceData = self.get_price_data( commodityId )
+            ids.write( priceData.get_name() + "," + str( commodityId ) + "\n" )
+            f = open( PriceStore.get_csv_filename( commodityId ) , "w" )
+            f.write( priceData.get_name() + "\n" )
+            f.write( "".join( [ x + "," + str( p ) + "," + str( a ) + "," + str( v ) + "\n" \
+                        for x , p , a , v in zip( dateText , priceData.prices().tolist() , \
+                            priceData.averages().tolist() , priceData.volumes().tolist() ) ] ) )
+            f.close()
+        ids.close()
+
+        start = time.time()
+        if ( partitions ):
+            ids = self.get_ids()
+            for i in range( 0 , len( ids ) , batchSize ):
+                PriceWriter.save_month_data_batch( [ self.get_price_data( x ) for x in ids[ i:i+batchSize ] ] )
+        return time.time() - start
+
+'''
+Times the readers, writers, queries, rankings and crawler parsers on a
+SyntheticDataset, in a scratch directory that is deleted afterwards.
+'''
+class Benchmark( object ):
+
+    '''
+    The webpages saved from the Grand Exchange, which are parsed along with
+    the synthetic webpages
+    '''
+    FIXTURE_DIRECTORY = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ) , \
+                                      "price_data" , "html_fixtures" )
+
+    '''
+    Creates a Benchmark.
+
+    @param dataset - the SyntheticDataset to run on
+    @param maxPayloads - the most commodities whose webpages and json are
+    generated for timing the crawler parsers
+    @param processes - the number of worker processes for the parallel
+    readers and rankings. If None, one process per CPU is used.
+    '''
+    def __init__( self , dataset , maxPayloads=500 , processes=None ):
+        self.dataset = dataset
+        self.maxPayloads = maxPayloads
+        self.processes = processes
+        self.timings = {}
+
+    '''
+    Runs every benchmark.
+
+    @return - a dictionary with the dataset's parameters, the Python and
+    NumPy versions and the timings. Every timing has the total number of
+    seconds, the number of items it covered and the seconds per item.
+    '''
+    def run( self ):
+        self.timings = {}
+        fixtures = self._read_fixtures()
+        cwd = os.getcwd()
+        tmpDir = tempfile.mkdtemp()
+
+        #the DataManager and the price data cache are shared by the whole
+        #process, so the real ones are put back afterwards
+        dataManagerState = (DataManager.initialized , DataManager.idToName , DataManager.nameToId)
+        try:
+            os.chdir( tmpDir )
+            DataManager.initialized = False
+            DataManager.idToName = {}
+            DataManager.nameToId = {}
+            PriceDataCache.clear()
+            self._run( fixtures )
+        finally:
+            os.chdir( cwd )
+            shutil.rmtree( tmpDir )
+            DataManager.initialized , DataManager.idToName , DataManager.nameToId = dataManagerState
+            PriceDataCache.clear()
+
+        return { "dataset" : { "items" : self.dataset.numItems , "days" : self.dataset.numDays , \
+                               "seed" : self.dataset.seed } , \
+                 "python" : sys.version.split()[ 0 ] , "numpy" : np.__version__ , \
+                 "timings" : self.timings }
+
+    '''
+    Runs every benchmark in the current folder, which run() sets to an
+    empty temporary folder. The synthetic dataset is generated first, and
+    every other benchmark reads or appends to it.
+
+    @param fixtures - the saved item pages to time the HTML parsers on, as
+    a list of (item ID, page) tuples from _read_fixtures()
+    '''
+    def _run( self , fixtures ):
+        ids = self.dataset.get_ids()
+        numItems = len( ids )
+
+        start = time.time()
+        partitionSeconds = self.dataset.generate()
+        self._record( "generate" , time.time() - start - partitionSeconds , numItems )
+        self._record( "writer.month_partitions" , partitionSeconds , numItems )
+
+        self._time( "reader.csv" , numItems , \
+                       lambda : [ PriceReader.get_price_data_from_csv( x ) for x in ids ] )
+        self._time( "reader.csv_parallel" , numItems , \
+                       lambda : PriceReader.get_price_data_from_csvs( ids , self.processes ) )
+        self._time( "writer.binary" , numItems , lambda : PriceStore.convert_master_list( ids ) )
+        self._time( "reader.binary" , numItems , \
+                       lambda : [ PriceReader.get_price_data_from_binary( x ) for x in ids ] )
+        
+        #every reader must see the data that was generated
+        expected = self.dataset.get_price_data( ids[ -1 ] )
+        assert PriceReader.get_price_data_from_csv( ids[ -1 ] ) == expected
+        assert PriceReader.get_price_data_from_binary( ids[ -1 ] ) == expected
+
+        months = sorted( set( [ DateUtils.from_ordinal( x )[ 0:2 ] for x in \
+                    range( self.dataset.startOrdinal , self.dataset.startOrdinal + self.dataset.numDays ) ] ) )
+        self._time( "reader.month_partition" , len( months ) , \
+                       lambda : [ PriceReader.read_month_partition( month , year ) for year , month in months ] )
+
+        #one month of one commodity at a time, from the last month
+        lastYear , lastMonth , lastDay = DateUtils.from_ordinal( self.dataset.startOrdinal + self.dataset.numDays - 1 )
+        names = [ "Synthetic item " + str( x ) for x in ids ]
+        self._time( "reader.month_data" , numItems , \
+                       lambda : [ PriceReader.read_month_data( lastMonth , lastYear , x ) for x in names ] )
+
+        #a three month query per commodity, first with an empty cache and
+        #then with every commodity cached (if they all fit)
+        firstYear , firstMonth = months[ max( 0 , len( months )-3 ) ]
+        query = lambda : [ DataManager.get_data_by_date_range( x , firstMonth , firstYear , \
+                                                               lastMonth , lastYear ) for x in names ]
+        self._time( "data_manager.init" , numItems , DataManager.init )
+        PriceDataCache.clear()
+        self._time( "data_manager.date_range_cold" , numItems , query )
+        self._time( "data_manager.date_range_warm" , numItems , query )
+        PriceDataCache.clear()
+
+        self._time( "rankings.full" , numItems , \
+                       lambda : ProfitabilityRanker.get_profitability_rankings( 2000000 , 30 ) )
+        self._time( "rankings.parallel" , numItems , \
+                       lambda : ProfitabilityRanker.get_profitability_rankings( 2000000 , 30 , self.processes ) )
+        self._time( "rankings.top100" , numItems , \
+                       lambda : ProfitabilityRanker.get_top_rankings( 2000000 , 30 , 100 ) )
+
+        payloadIds = ids[ 0:self.maxPayloads ]
+        pages = [ (x , StubGrandExchangeServer.get_html( x )) for x in payloadIds ] + fixtures
+        payloads = [ ("Item" , x , StubGrandExchangeServer.get_json( x )) for x in payloadIds ]
+        for name , seconds in benchmark_html_parsing( pages ).items():
+            self._record( "crawler.html." + name.replace( " " , "_" ) , seconds*len( pages ) , len( pages ) )
+        for name , seconds in benchmark_json_parsing( payloads , 1 ).items():
+            self._record( "crawler.json." + name , seconds*len( payloads ) , len( payloads ) )
+
+        #append one new day to every commodity
+        newDay = self.dataset.startOrdinal + self.dataset.numDays
+        newData = [ ArrayPriceData( x , "Synthetic item " + str( x ) , np.array( [ newDay ] ) , \
+                        np.array( [ 100 ] ) , np.array( [ 100 ] ) , np.array( [ 1000 ] ) ) for x in ids ]
+        self._time( "writer.append" , numItems , lambda : [ PriceWriter.save_list_data( x ) for x in newData ] )
+        self._time( "writer.month_batch_append" , numItems , \
+                       lambda : PriceWriter.save_month_data_batch( newData ) )
+
+    '''
+    Reads the webpages saved from the Grand Exchange, which are named by
+    item ID, from Benchmark.FIXTURE_DIRECTORY.
+
+    @return - a list of (item ID, page) tuples, sorted by filename. The list
+    is empty if the folder does not exist.
+    '''
+    def _read_fixtures( self ):
+        fixtures = []
+        if ( os.path.exists( Benchmark.FIXTURE_DIRECTORY ) ):
+            for filename in sorted( os.listdir( Benchmark.FIXTURE_DIRECTORY ) ):
+                if ( filename[ 0:-5 ].isdigit() ):
+                    f = open( os.path.join( Benchmark.FIXTURE_DIRECTORY , filename ) )
+                    fixtures.append( (int( filename[ 0:-5 ] ) , f.read()) )
+                    f.close()
+        return fixtures
+
+    '''
+    Times a function and records how long it took.
+
+    @param name - the name of the timing
+    @param numItems - the number of items the function goes over
+    @param function - the function to time, which takes no arguments
+    '''
+    def _time( self , name , numItems , function ):
+        start = time.time()
+        function()
+        self._record( name , time.time() - start , numItems )
+
+    '''
+    Records a timing in self.timings, replacing any earlier timing with the
+    same name.
+
+    @param name - the name of the timing
+    @param seconds - how many seconds it took
+    @param numItems - the number of items it covered, which seconds is
+    divided by to get the seconds per item
+    '''
+    def _record( self , name , seconds , numItems ):
+        self.timings[ name ] = { "seconds" : seconds , "items" : numItems , \
+                                 "secondsPerItem" : seconds/max( 1 , numItems ) }
+
+def main():
+    parser = argparse.ArgumentParser( description="Times the price data code on a synthetic dataset." )
+    parser.add_argument( "--items" , type=int , default=200 , help="the number of commodities" )
+    parser.add_argument( "--days" , type=int , default=365 , help="the number of days per commodity" )
+    parser.add_argument( "--seed" , type=int , default=0 , help="the random seed of the dataset" )
+    parser.add_argument( "--processes" , type=int , default=None , \
+                         help="the number of worker processes for parallel readers and rankings" )
+    parser.add_argument( "--output" , default=None , help="the file to write the JSON results to" )
+    parser.add_argument( "--instrument" , default=None , \
+                         help="the file to write a JSON report of the instrumented operations to" )
+    args = parser.parse_args()
+
+    Instrumentation.enabled = args.instrument is not None
+    results = Benchmark( SyntheticDataset( args.items , args.days , args.seed ) , \
+                         processes=args.processes ).run()
+    text = json.dumps( results , indent=2 , sort_keys=True )
+    if ( args.output is None ):
+        print text
+    else:
+        f = open( args.output , "w" )
+        f.write( text + "\n" )
+        f.close()
+    if ( args.instrument is not None ):
+        Instrumentation.write_report( args.instrument )
+
+if __name__ == "__main__" : main()
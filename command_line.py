@@ -12,8 +12,8 @@ Gets the price data for the given commodity.
 @param return - the price data for the given commodity
 '''
 def get_data_by_id( commodityId ):
-    from price_data_io import PriceReader
-    return PriceReader.get_price_data_from_csv( commodityId )
+    from data_manager import DataManager
+    return DataManager.get_data_by_id( commodityId )
     
 '''
 Plots the price of a commodity over time
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from market_panel import MarketPanel
+
+'''
+Finds which commodities move together, by correlating the daily log returns
+of every pair of commodities in a MarketPanel.
+
+The log return of a commodity on a day is the log of its price that day
+minus the log of its price the day before, so it is missing if either day
+is missing or has no price. Each pair of commodities is correlated over the
+days on which both have a return, so commodities with gaps in their
+histories can still be compared.
+
+The correlations are computed a block of rows against a block of columns at
+a time. For a block, the number of shared days, the sums and the sums of
+squares over the shared days and the sum of products all come from matrix
+products of the returns and of the mask of days that have a return, so the
+work is done by BLAS and only a block of the correlation matrix is in
+memory at once. Only the best partners of each commodity are kept as the
+blocks are computed, so the full matrix is never built.
+'''
+class CorrelationEngine( object ):
+
+    '''
+    Creates a CorrelationEngine for the commodities in a panel.
+
+    @param panel - the MarketPanel with the price data of the commodities.
+    If None, the panel saved in price_data/panel is used, and it is built
+    if it has not been built yet.
+    @param minOverlap - the smallest number of shared days over which two
+    commodities are correlated. Pairs that share fewer days have no
+    correlation.
+    @param minMoves - the smallest number of days on which a commodity's
+    price has to change for it to be correlated with anything. A commodity
+    whose price only changes a few times is perfectly correlated with
+    anything that happens to change on the same days.
+    '''
+    def __init__( self , panel=None , minOverlap=30 , minMoves=10 ):
+        if ( panel is None ):
+            panel = MarketPanel.load()
+            if ( panel is None ):
+                panel = MarketPanel.build()
+        self.panel = panel
+        self.minOverlap = minOverlap
+        self.returns , self.valid = CorrelationEngine.get_log_returns( panel.daily , panel.missing )
+
+        #commodities that rarely move are left out by giving them no returns
+        changes = np.diff( np.asarray( panel.daily ) , axis=1 ) != 0
+        moves = ( changes & ( self.valid > 0 ) ).sum( axis=1 )
+        self.returns[ moves < minMoves ] = 0
+        self.valid[ moves < minMoves ] = 0
+        self.squares = self.returns*self.returns
+
+    '''
+    Computes the daily log returns of every commodity in a panel. Each
+    commodity's returns are centered on their mean before they are used, so
+    that the sums in get_block() do not lose precision to cancellation. The
+    correlations do not change, since they do not depend on the mean.
+
+    @param prices - the prices, as an items-by-days array
+    @param missing - True wherever a price is missing, as an items-by-days
+    array
+    @return - a (returns, valid) tuple of items-by-(days-1) arrays of
+    floats, where valid is 1 wherever there is a return and 0 elsewhere, and
+    returns is the centered log return wherever there is one and 0 elsewhere
+    '''
+    @staticmethod
+    def get_log_returns( prices , missing ):
+        present = ~np.asarray( missing ) & ( np.asarray( prices ) > 0 )
+        logPrices = np.log( np.where( present , prices , 1 ).astype( np.float64 ) )
+        valid = present[ : , 1: ] & present[ : , 0:-1 ]
+        returns = np.where( valid , logPrices[ : , 1: ] - logPrices[ : , 0:-1 ] , 0.0 )
+
+        counts = valid.sum( axis=1 )
+        means = returns.sum( axis=1 )/np.maximum( counts , 1 )
+        returns = np.where( valid , returns - means[ : , np.newaxis ] , 0.0 )
+        return (returns , valid.astype( np.float64 ))
+
+    '''
+    Correlates a block of commodities with another block of commodities.
+    With a lag, the return of each commodity in the first block on each day
+    is correlated with the return of each commodity in the second block lag
+    days later.
+
+    @param rows - the rows of the first block in the panel, as a slice
+    @param columns - the rows of the second block in the panel, as a slice
+    @param lag - the number of days by which the second block's returns
+    are shifted, as an integer. It can be negative.
+    @return - a (correlations, overlaps) tuple of arrays with a row for each
+    commodity in the first block and a column for each commodity in the
+    second block, where overlaps has the number of days on which both
+    commodities have a return and correlations has the correlation of their
+    returns over those days, or NaN if there are fewer than minOverlap such
+    days or either commodity's price does not move on them
+    '''
+    def get_block( self , rows , columns , lag=0 ):
+        numReturns = self.returns.shape[ 1 ]
+        start = max( 0 , -lag )
+        days = slice( start , max( start , min( numReturns , numReturns - lag ) ) )
+        laterDays = slice( days.start + lag , days.stop + lag )
+        x , vx , xx = [ a[ rows , days ] for a in ( self.returns , self.valid , self.squares ) ]
+        y , vy , yy = [ a[ columns , laterDays ] for a in ( self.returns , self.valid , self.squares ) ]
+
+        #every sum is only over the days on which both have a return
+        overlaps = np.dot( vx , vy.T )
+        sumX = np.dot( x , vy.T )
+        sumY = np.dot( vx , y.T )
+        sumXX = np.dot( xx , vy.T )
+        sumYY = np.dot( vx , yy.T )
+        sumXY = np.dot( x , y.T )
+
+        n = np.maximum( overlaps , 1 )
+        covariance = sumXY - sumX*sumY/n
+        varianceX = sumXX - sumX*sumX/n
+        varianceY = sumYY - sumY*sumY/n
+        defined = ( overlaps >= self.minOverlap ) & ( varianceX > 0 ) & ( varianceY > 0 )
+        with np.errstate( divide="ignore" , invalid="ignore" ):
+            correlations = covariance/np.sqrt( varianceX*varianceY )
+        correlations = np.where( defined , np.clip( correlations , -1 , 1 ) , np.nan )
+        return (correlations , overlaps.astype( np.int64 ))
+
+    '''
+    @param commodityA - the ID of a commodity in the panel, as an integer
+    @param commodityB - the ID of another commodity in the panel
+    @return - the correlation of the returns of the two commodities, or NaN
+    if it is not defined, see get_block()
+    '''
+    def get_correlation( self , commodityA , commodityB ):
+        rowA = self.panel.get_row( commodityA )
+        rowB = self.panel.get_row( commodityB )
+        return self.get_block( slice( rowA , rowA+1 ) , slice( rowB , rowB+1 ) )[ 0 ][ 0 , 0 ]
+
+    '''
+    Finds the commodities that are most correlated with each commodity. The
+    correlation matrix is symmetric, so only the blocks on and above the
+    diagonal are computed, and each one updates the partners of both its
+    rows and its columns.
+
+    @param k - the number of partners to find for each commodity
+    @param blockSize - the number of commodities in each block. A block of
+    the correlation matrix takes about 8*blockSize^2 bytes for each of the
+    sums in get_block().
+    @param absolute - if True, partners are ranked by the size of their
+    correlation, so strongly anti-correlated commodities are found too.
+    Otherwise only the most positively correlated partners are found.
+    @return - a (partners, correlations) tuple of items-by-k arrays in the
+    order of the panel's rows, where partners has the IDs of each
+    commodity's partners, best first, and correlations has their
+    correlations. Commodities with fewer than k partners that have a
+    correlation are padded with ID -1 and correlation NaN. If several
+    partners are exactly as good as the k-th best, which of them are kept
+    may depend on the block size.
+    '''
+    def get_top_partners( self , k=10 , blockSize=512 , absolute=False ):
+        numItems = self.panel.get_num_items()
+        k = max( 0 , min( k , numItems-1 ) )
+        bestScores = np.full( ( numItems , k ) , -np.inf )
+        bestCorrelations = np.full( ( numItems , k ) , np.nan )
+        bestRows = np.full( ( numItems , k ) , -1 , dtype=np.int64 )
+        if ( k == 0 ):
+            return (bestRows , bestCorrelations)
+
+        for rowStart in range( 0 , numItems , blockSize ):
+            rows = slice( rowStart , min( rowStart + blockSize , numItems ) )
+            for columnStart in range( rowStart , numItems , blockSize ):
+                columns = slice( columnStart , min( columnStart + blockSize , numItems ) )
+                correlations = self.get_block( rows , columns )[ 0 ]
+                scores = np.abs( correlations ) if absolute else correlations.copy()
+                scores[ np.isnan( scores ) ] = -np.inf
+
+                #a commodity is not its own partner
+                if ( columnStart == rowStart ):
+                    np.fill_diagonal( scores , -np.inf )
+
+                CorrelationEngine._keep_best( bestScores , bestCorrelations , bestRows , \
+                            rows , scores , correlations , np.arange( columns.start , columns.stop ) )
+                if ( columnStart != rowStart ):
+                    CorrelationEngine._keep_best( bestScores , bestCorrelations , bestRows , \
+                            columns , scores.T , correlations.T , np.arange( rows.start , rows.stop ) )
+
+        #sort each commodity's partners, best first, with equally good
+        #partners in the order of the panel's rows
+        order = np.lexsort( ( bestRows , -bestScores ) , axis=1 )
+        bestScores = np.take_along_axis( bestScores , order , axis=1 )
+        bestCorrelations = np.take_along_axis( bestCorrelations , order , axis=1 )
+        bestRows = np.take_along_axis( bestRows , order , axis=1 )
+        found = bestScores > -np.inf
+        partners = np.where( found , self.panel.ids[ np.maximum( bestRows , 0 ) ] , -1 )
+        return (partners , np.where( found , bestCorrelations , np.nan ))
+
+    '''
+    Merges the scores of a block into the best partners found so far of the
+    block's rows.
+
+    @param bestScores - the scores of the best partners found so far of
+    every commodity, as an items-by-k array, which is updated in place
+    @param bestCorrelations - their correlations, updated in place
+    @param bestRows - their rows in the panel, updated in place
+    @param rows - the rows of the block, as a slice
+    @param scores - the scores of the block, where -inf means no partner
+    @param correlations - the correlations of the block
+    @param columns - the row in the panel of each column of the block
+    '''
+    @staticmethod
+    def _keep_best( bestScores , bestCorrelations , bestRows , rows , scores , correlations , \
+                       columns ):
+        k = bestScores.shape[ 1 ]
+        allScores = np.hstack( ( bestScores[ rows ] , scores ) )
+        allCorrelations = np.hstack( ( bestCorrelations[ rows ] , correlations ) )
+        allRows = np.hstack( ( bestRows[ rows ] , np.broadcast_to( columns , scores.shape ) ) )
+
+        #only the k best are needed, in no particular order
+        keep = np.argpartition( -allScores , k-1 , axis=1 )[ : , 0:k ]
+        bestScores[ rows ] = np.take_along_axis( allScores , keep , axis=1 )
+        bestCorrelations[ rows ] = np.take_along_axis( allCorrelations , keep , axis=1 )
+        bestRows[ rows ] = np.take_along_axis( allRows , keep , axis=1 )
+
+def main():
+    import shutil
+    import tempfile
+    import time
+
+    #a random panel with gaps, flat stretches, two commodities that only
+    #move on the same few days and pairs that move together
+    random = np.random.RandomState( 0 )
+    numItems = 150
+    numDays = 120
+    steps = random.normal( 0 , 0.02 , ( numItems , numDays ) )
+    steps[ 1::3 ] = steps[ 0::3 ][ 0:len( steps[ 1::3 ] ) ] + random.normal( 0 , 0.005 , \
+                                            ( len( steps[ 1::3 ] ) , numDays ) )
+    steps[ 2::7 ] = -steps[ 0::7 ][ 0:len( steps[ 2::7 ] ) ]
+    steps[ 5 ] = 0
+    steps[ 8 ] = 0
+    steps[ 8 , [ 30 , 60 , 90 ] ] = 0.05
+    steps[ 11 ] = steps[ 8 ]
+    daily = np.round( 1000*np.exp( np.cumsum( steps , axis=1 ) ) ).astype( np.int64 )
+    missing = random.rand( numItems , numDays ) < 0.1
+    missing[ 7 , 20: ] = True
+    daily[ missing ] = 0
+    ids = np.arange( 1000 , 1000 + numItems , dtype=np.int64 )
+    panel = MarketPanel( ids , np.arange( numDays , dtype=np.int32 ) , daily , daily , \
+                         np.zeros_like( daily ) , missing )
+    engine = CorrelationEngine( panel , minOverlap=20 )
+
+    #every pair matches correlating its shared days directly
+    logPrices = np.log( np.where( missing , 1 , daily ).astype( np.float64 ) )
+    brute = np.full( ( numItems , numItems ) , np.nan )
+    for a in range( 0 , numItems ):
+        for b in range( 0 , numItems ):
+            shared = ~missing[ a , 1: ] & ~missing[ a , 0:-1 ] & \
+                     ~missing[ b , 1: ] & ~missing[ b , 0:-1 ]
+            x = np.diff( logPrices[ a ] )[ shared ]
+            y = np.diff( logPrices[ b ] )[ shared ]
+            if ( shared.sum() >= 20 and np.std( x ) > 1e-12 and np.std( y ) > 1e-12 ):
+                brute[ a , b ] = np.corrcoef( x , y )[ 0 , 1 ]
+    
+    #except that commodities that rarely move are left out
+    assert CorrelationEngine( panel , minOverlap=20 , minMoves=0 ).get_correlation( 1008 , 1011 ) > 0.99
+    for row in [ 8 , 11 ]:
+        brute[ row , : ] = np.nan
+        brute[ : , row ] = np.nan
+    correlations , overlaps = engine.get_block( slice( 0 , numItems ) , slice( 0 , numItems ) )
+    assert np.array_equal( np.isnan( correlations ) , np.isnan( brute ) )
+    assert np.nanmax( np.abs( correlations - brute ) ) < 1e-9
+    assert np.all( np.isnan( correlations[ 5 ] ) ) and np.all( np.isnan( correlations[ 7 ] ) )
+    assert abs( engine.get_correlation( 1000 , 1001 ) - brute[ 0 , 1 ] ) < 1e-9
+    assert engine.get_correlation( 1000 , 1002 ) < -0.999
+
+    #the best partners do not depend on the block size and match sorting
+    #each row of the full matrix
+    for absolute in [ False , True ]:
+        scores = np.abs( brute ) if absolute else brute.copy()
+        np.fill_diagonal( scores , np.nan )
+        expected = None
+        for blockSize in [ 1 , 7 , 64 , 512 ]:
+            partners , best = engine.get_top_partners( 5 , blockSize , absolute )
+            if ( expected is None ):
+                expected = (partners , best)
+                for row in range( 0 , numItems ):
+                    ranked = [ x for x in np.argsort( -scores[ row ] , kind="mergesort" ) \
+                                if not np.isnan( scores[ row , x ] ) ][ 0:5 ]
+                    assert list( partners[ row , 0:len( ranked ) ] ) == list( ids[ ranked ] )
+                    assert np.all( partners[ row , len( ranked ): ] == -1 )
+                    assert np.allclose( best[ row , 0:len( ranked ) ] , brute[ row , ranked ] )
+            else:
+                assert np.array_equal( partners , expected[ 0 ] )
+                assert np.allclose( best , expected[ 1 ] , equal_nan=True )
+    partners , best = engine.get_top_partners( 3 )
+    assert partners[ 0 , 0 ] == 1001 and partners[ 1 , 0 ] == 1000 and best[ 0 , 0 ] > 0.9
+    assert np.all( partners[ 5 ] == -1 ) and np.all( np.isnan( best[ 5 ] ) )
+    assert engine.get_top_partners( 3 , absolute=True )[ 0 ][ 0 , 0 ] in [ 1001 , 1002 ]
+
+    #the whole master list
+    defaultDirectory = MarketPanel.DIRECTORY
+    MarketPanel.DIRECTORY = tempfile.mkdtemp()
+    try:
+        engine = CorrelationEngine( MarketPanel.build() )
+        start = time.time()
+        partners , best = engine.get_top_partners( 10 )
+        print "Found the top 10 partners of " + str( engine.panel.get_num_items() ) + \
+                " items in " + str( round( time.time() - start , 3 ) ) + " seconds"
+        mithril = engine.panel.get_row( 447 )
+        assert np.all( np.diff( best[ mithril ][ ~np.isnan( best[ mithril ] ) ] ) <= 0 )
+    finally:
+        shutil.rmtree( MarketPanel.DIRECTORY )
+        MarketPanel.DIRECTORY = defaultDirectory
+
+    print "Regression testing for correlation.py passed."
+
+if __name__ == "__main__" : main()
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from price_crawler import PriceCrawler , RequestThrottledError
+from http_cache import HttpCache
+
+'''
+A token bucket that limits how fast requests are made. It is shared by all
+the threads of a crawl, so the overall request rate stays under the limit no
+matter how many threads are making requests.
+
+The bucket refills at rate tokens per second up to capacity tokens, and
+every request takes one token. When the Grand Exchange throttles us, the
+bucket is paused for a while and its rate is halved. Each successful
+request then raises the rate a little, back up to the rate it started with.
+'''
+class TokenBucket( object ):
+
+    '''
+    Creates a full TokenBucket.
+
+    @param rate - the number of requests allowed per second
+    @param capacity - the maximum number of requests that can be made in a
+    burst after the bucket has been idle
+    @param minRate - the lowest rate the bucket will slow down to after
+    being throttled
+    '''
+    def __init__( self , rate , capacity=1 , minRate=0.05 ):
+        self.maxRate = float( rate )
+        self.rate = float( rate )
+        self.minRate = min( float( minRate ) , self.rate )
+        self.capacity = float( capacity )
+        self.tokens = float( capacity )
+        self.lastRefill = time.time()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    '''
+    Blocks until a request may be made and takes a token for it.
+    '''
+    def acquire( self ):
+        while ( True ):
+            with self.lock:
+                now = time.time()
+                self.tokens = min( self.capacity , \
+                                   self.tokens + (now - self.lastRefill)*self.rate )
+                self.lastRefill = now
+                if ( now < self.pausedUntil ):
+                    wait = self.pausedUntil - now
+                elif ( self.tokens >= 1 ):
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens)/self.rate
+            time.sleep( wait )
+
+    '''
+    Stops all requests for the given number of seconds and halves the rate
+    at which requests are allowed afterwards.
+
+    @param seconds - how long to stop making requests
+    '''
+    def back_off( self , seconds ):
+        with self.lock:
+            self.pausedUntil = max( self.pausedUntil , time.time() + seconds )
+            self.rate = max( self.minRate , self.rate/2 )
+            self.tokens = 0
+
+    '''
+    Raises the rate at which requests are allowed after a successful request,
+    up to the rate the bucket started with.
+    '''
+    def recover( self ):
+        with self.lock:
+            self.rate = min( self.maxRate , self.rate + 0.05*self.maxRate )
+
+'''
+Downloads price data for many commodities concurrently.
+
+Requests are made by a pool of threads that share one TokenBucket, so the
+crawl stays within a request rate. When the "too many requests" page comes
+back, every thread backs off: the wait doubles each time we are throttled in
+a row (up to maxBackoff seconds) and goes back to backoff seconds after a
+successful request. Each commodity is tried at most maxRetries+1 times, and
+commodities that are still throttled after that are reported as failed
+instead of being retried forever.
+'''
+class CrawlEngine( object ):
+
+    '''
+    Creates a CrawlEngine.
+
+    @param rate - the maximum number of requests per second
+    @param threads - the number of requests that can be in flight at once
+    @param maxRetries - how many times to retry a commodity after being
+    throttled before giving up on it
+    @param backoff - how many seconds to wait the first time we are throttled
+    @param maxBackoff - the longest we will wait after being throttled, in
+    seconds
+    @param burst - how many requests can be made at once after being idle
+    '''
+    def __init__( self , rate=0.5 , threads=4 , maxRetries=5 , backoff=15 , \
+                  maxBackoff=300 , burst=1 ):
+        self.bucket = TokenBucket( rate , burst )
+        self.threads = threads
+        self.maxRetries = maxRetries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.currentBackoff = backoff
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    '''
+    Resets the statistics that are kept about the requests made. The
+    "http." statistics are the HttpCache counters for the requests made by
+    this engine's crawls since the last reset: how many pages came from the
+    cache, how many were revalidated or downloaded, and how many bytes were
+    downloaded or saved.
+    '''
+    def reset_stats( self ):
+        with self.lock:
+            self.stats = { "requests" : 0 , "throttled" : 0 , "succeeded" : 0 , \
+                           "invalid" : 0 , "failed" : 0 , "errors" : 0 , "seconds" : 0.0 }
+            for key in HttpCache.new_stats():
+                self.stats[ "http." + key ] = 0
+
+    '''
+    Downloads something for each of the given commodities.
+
+    @param objectIds - the Grand Exchange object IDs of the commodities, as a
+    list of integers
+    @param fetch - a function that takes an object ID and downloads its data.
+    It should raise RequestThrottledError if we have been throttled and
+    return None if the object ID is invalid.
+    @param callback - if given, a function that is called with the object ID
+    and its data as soon as each commodity has been downloaded. Calls to the
+    callback are never made at the same time, so it does not need to be
+    thread safe.
+    @param maxRequests - if given, the most requests to make in this crawl,
+    including retries. Once they have all been made, the commodities that
+    have not been downloaded yet are left out of both results and failed.
+    @return - a (results, failed) tuple: results maps each object ID that
+    was downloaded to what fetch returned for it, and failed is a list of
+    the object IDs that could not be downloaded
+    '''
+    def crawl( self , objectIds , fetch , callback=None , maxRequests=None ):
+        results = {}
+        failed = []
+        callbackLock = threading.Lock()
+        start = time.time()
+        numRequests = [ 0 ]
+        httpStats = HttpCache.new_stats()
+
+        def work( objectId ):
+            #the threads of the pool only work on this crawl
+            HttpCache.track( httpStats )
+            for attempt in range( 0 , self.maxRetries+1 ):
+                with self.lock:
+                    if ( maxRequests is not None and numRequests[ 0 ] >= maxRequests ):
+                        return
+                    numRequests[ 0 ] += 1
+                self.bucket.acquire()
+                self._count( "requests" )
+                try:
+                    data = fetch( objectId )
+                except RequestThrottledError:
+                    self._count( "throttled" )
+                    self._throttled()
+                    continue
+                except Exception , e:
+                    print "Error while downloading " + str( objectId ) + ": " + str( e )
+                    self._count( "errors" )
+                    break
+                self._succeeded()
+                self._count( "succeeded" if data is not None else "invalid" )
+                with callbackLock:
+                    results[ objectId ] = data
+                    if ( callback is not None ):
+                        callback( objectId , data )
+                return
+            self._count( "failed" )
+            with callbackLock:
+                failed.append( objectId )
+
+        pool = ThreadPool( self.threads )
+        try:
+            pool.map( work , objectIds , 1 )
+        finally:
+            pool.close()
+            pool.join()
+        self._count( "seconds" , time.time() - start )
+        
+        #report how much the HTTP cache saved during this crawl
+        for key , value in httpStats.items():
+            self._count( "http." + key , value )
+        return (results , failed)
+
+    '''
+    Downloads the price data of each of the given commodities from their
+    Grand Exchange webpages.
+
+    @param objectIds - the Grand Exchange object IDs of the commodities, as a
+    list of integers
+    @param callback - see crawl()
+    @param maxRequests - see crawl()
+    @return - a (results, failed) tuple, where results maps object IDs to
+    CommodityPriceData objects (or None for invalid IDs). See crawl().
+    '''
+    def crawl_html( self , objectIds , callback=None , maxRequests=None ):
+        return self.crawl( objectIds , CrawlEngine.fetch_html , callback , maxRequests )
+
+    '''
+    Downloads and parses the webpage of one commodity, without retrying when
+    we are throttled.
+    '''
+    @staticmethod
+    def fetch_html( objectId ):
+        return PriceCrawler.parse_html( objectId , PriceCrawler.fetch_html( objectId ) )
+
+    def _count( self , key , amount=1 ):
+        with self.lock:
+            self.stats[ key ] += amount
+
+    '''
+    Backs off after being throttled. The wait doubles every time we are
+    throttled without a successful request in between.
+    '''
+    def _throttled( self ):
+        with self.lock:
+            wait = self.currentBackoff
+            self.currentBackoff = min( self.maxBackoff , self.currentBackoff*2 )
+        self.bucket.back_off( wait )
+
+    def _succeeded( self ):
+        with self.lock:
+            self.currentBackoff = self.backoff
+        self.bucket.recover()
+
+def main():
+    from stub_server import StubGrandExchangeServer
+    from price_data_io import PriceReader
+    import shutil
+    import tempfile
+
+    #requests are spread out to the rate limit
+    bucket = TokenBucket( 20 , 1 )
+    start = time.time()
+    for i in range( 0 , 11 ):
+        bucket.acquire()
+    assert time.time() - start >= 0.45
+
+    #the stub throttles any request that comes within 0.02 seconds of the
+    #previous one, so crawling faster than that must back off and retry
+    server = StubGrandExchangeServer( minInterval=0.02 , throttleFirst=2 )
+    server.start()
+    defaultUrl = PriceCrawler.BASE_URL
+    defaultDirectory = HttpCache.DIRECTORY
+    PriceCrawler.BASE_URL = server.get_url()
+    HttpCache.DIRECTORY = tempfile.mkdtemp()
+    try:
+        ids = [ 2 , 6 , 8 , 447 , 1038 , 1 ]
+        engine = CrawlEngine( rate=200 , threads=4 , maxRetries=20 , backoff=0.05 , \
+                              maxBackoff=0.2 , burst=4 )
+        seen = []
+        results , failed = engine.crawl_html( ids , lambda x , data : seen.append( x ) )
+        assert failed == []
+        assert sorted( seen ) == sorted( ids )
+        assert results[ 1 ] is None
+        for objectId in ids[ 0:-1 ]:
+            stored = PriceReader.get_price_data_from_csv( objectId )
+            assert results[ objectId ].get_all_datapoints() == stored.get_all_datapoints()[ -180: ]
+        assert engine.stats[ "throttled" ] >= 2
+        assert engine.stats[ "throttled" ] == server.throttled
+        assert engine.stats[ "requests" ] == server.requests
+        assert engine.stats[ "succeeded" ] == 5 and engine.stats[ "invalid" ] == 1
+        assert engine.stats[ "http.misses" ] == server.requests
+        
+        #crawling again is answered from the HTTP cache
+        engine.reset_stats()
+        results , failed = engine.crawl_html( ids )
+        assert failed == [] and len( results ) == len( ids )
+        assert engine.stats[ "http.hits" ] == 5 and engine.stats[ "http.misses" ] == 1
+        assert engine.stats[ "http.bytesSaved" ] > 0
+
+        #crawls that run at the same time only count their own requests
+        engines = [ CrawlEngine( rate=200 , threads=2 , maxRetries=20 , backoff=0.01 , \
+                                 maxBackoff=0.05 , burst=4 ) for i in range( 0 , 3 ) ]
+        threads = [ threading.Thread( target=x.crawl_html , args=(ids ,) ) for x in engines ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for other in engines:
+            assert other.stats[ "http.hits" ] == 5
+            assert other.stats[ "http.misses" ] == other.stats[ "requests" ] - 5
+            assert other.stats[ "http.bytesSaved" ] == engine.stats[ "http.bytesSaved" ]
+
+        #a bounded number of retries means a server that always throttles
+        #makes the crawl fail instead of retrying forever
+        server.throttleFirst = 1000
+        engine = CrawlEngine( rate=200 , threads=2 , maxRetries=2 , backoff=0.01 , maxBackoff=0.01 )
+        results , failed = engine.crawl_html( [ 10 , 12 ] )
+        assert results == {} and sorted( failed ) == [ 10 , 12 ]
+        assert engine.stats[ "requests" ] == 6 and engine.stats[ "failed" ] == 2
+        
+        #no more than maxRequests requests are made, retries included
+        engine = CrawlEngine( rate=200 , threads=1 , maxRetries=2 , backoff=0.01 , maxBackoff=0.01 )
+        results , failed = engine.crawl_html( [ 10 , 12 , 14 ] , maxRequests=4 )
+        assert results == {} and failed == [ 10 ] and engine.stats[ "requests" ] == 4
+    finally:
+        shutil.rmtree( HttpCache.DIRECTORY )
+        HttpCache.DIRECTORY = defaultDirectory
+        PriceCrawler.BASE_URL = defaultUrl
+        server.stop()
+
+    print "Regression testing for crawl_engine.py passed."
+
+if __name__ == "__main__" : main()
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from price_crawler import PriceCrawler
+from id_discovery import IDDiscovery
 from price_data_io import PriceWriter, PriceReader
-from random import randint
-from time import sleep
+from price_store import PriceStore
+from price_data import ArrayPriceData
+from date_utils import DateUtils
+from collections import OrderedDict
+import numpy as np
+import os
+import threading
 
 class IDManager( object ):
     
@@ -17,8 +23,8 @@ class IDManager( object ):
     move that much.
     
     Note: This function appends to the price_data/item_stats file.
-    Make sure you look through the file first before giving it
-    a start and end ID.
+    IDs that are already in the file, or that were probed by an earlier
+    run, are skipped. See IDDiscovery.
     
     @param startId - the first ID for which to record commodity stats
     @param endId - one greater than the last ID for which to record
@@ -27,43 +33,181 @@ class IDManager( object ):
     '''
     @staticmethod
     def record_commodity_stats( startId , endId ):
-        for i in range( startId , endId ):
-            print "Processing " + str( i )
-            testData = PriceCrawler.get_price_data_from_html( i )
-            if ( not testData is None ):
-                maxPrice = 0
-                minPrice = 999999999
-                maxVolume = 0
-                minVolume = 999999999
-                allPoints = testData.get_all_datapoints()
-                
-                #we do not include the last data point because
-                #that is today's data, which may be incomplete
-                #and so the volume may be much less than what it
-                #really is.
-                for datapoint in allPoints[1:len(allPoints)-1]:
+        
+        #let's not get blocked for too many requests. The discovery job
+        #spaces requests out to one every 2 seconds, backs off if we do get
+        #blocked, and skips IDs that have already been recorded or probed.
+        IDDiscovery().discover( range( startId , endId ) )
+    
+    '''
+    Recomputes the maximum price, minimum price, and volume of every
+    commodity in price_data/item_stats from the price data already stored in
+    price_data/master_list, instead of downloading it again. See
+    IDDiscovery.build_stats().
+    
+    @param processes - the number of worker processes to use. If None, one
+    process per CPU is used.
+    @return - the number of commodities whose stats were recomputed
+    '''
+    @staticmethod
+    def rebuild_commodity_stats( processes=None ):
+        return IDDiscovery.build_stats( processes=processes )
+            
+'''
+Caches the price data of commodities in memory so that looking up the same
+commodity again does not re-read and re-parse its file.
 
-                    #prices and volumes of 0 are invalid                    
-                    if ( datapoint.get_price != 0 ):
-                        maxPrice = max( datapoint.get_price() , maxPrice )
-                        minPrice = min( datapoint.get_price() , minPrice )
-                    
-                    if ( datapoint.get_volume() != 0 ):
-                        maxVolume = max( datapoint.get_volume() , maxVolume )
-                        minVolume = min( datapoint.get_volume() , minVolume )
-                    
-                out = open( "price_data/item_stats" , "a" )
-                out.write( str(i) + "," + str(maxPrice) + "," + str(minPrice) + \
-                    "," + str(maxVolume) + "," + str(minVolume) + "\n" )
-                out.close()
-            else:
-                print str( i ) + " was not a valid id"
-                
-            #let's not get blocked for too many requests
-            sleepInterval = randint( 1 , 2 )
-            sleepInterval = 2
-            print "Sleeping " + str( sleepInterval )
-            sleep( sleepInterval )
+The cache is shared by the whole process. It holds at most maxBytes bytes
+of price data and evicts the least recently used commodities when it is
+full. Sizes are estimates from CommodityPriceData.get_memory_usage(), so
+the real memory used can be somewhat larger than the budget. Every lookup
+checks the modification time and size of the commodity's files, so data
+that has changed on disk since it was cached is read again.
+'''
+class PriceDataCache( object ):
+    
+    '''
+    The maximum number of bytes of price data to keep in the cache, as
+    estimated by CommodityPriceData.get_memory_usage()
+    '''
+    maxBytes = 256*1024*1024
+    
+    '''
+    Maps commodity IDs to (priceData, estimated size, signature) tuples,
+    ordered from least to most recently used
+    '''
+    entries = OrderedDict()
+    
+    '''
+    The total estimated size of the price data in the cache, in bytes
+    '''
+    usedBytes = 0
+    
+    hits = 0
+    misses = 0
+    evictions = 0
+    invalidations = 0
+    
+    lock = threading.Lock()
+    
+    '''
+    Determines the modification times and sizes of the files a commodity's
+    price data is read from. If the signature changes, the cached data is
+    out of date.
+    
+    @param commodityId - the ID of a commodity, as an integer
+    @return - a tuple that identifies the current version of the files
+    '''
+    @staticmethod
+    def get_signature( commodityId ):
+        rtn = []
+        for filename in (PriceStore.get_csv_filename( commodityId ) , \
+                         PriceStore.get_filename( commodityId )):
+            try:
+                stat = os.stat( filename )
+                rtn.append( (stat.st_mtime , stat.st_size) )
+            except OSError:
+                rtn.append( None )
+        return tuple( rtn )
+    
+    '''
+    Gets the price data for a commodity from the cache, reading it from disk
+    if it is not cached or if its files have changed since it was cached.
+    Every caller gets its own read only view of the cached arrays (see
+    ArrayPriceData.get_read_only_view()), so callers cannot change the data
+    that other callers get.
+    
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the ArrayPriceData of the commodity, or None if the commodity
+    has no price data
+    '''
+    @staticmethod
+    def get( commodityId ):
+        signature = PriceDataCache.get_signature( commodityId )
+        with PriceDataCache.lock:
+            entry = PriceDataCache.entries.pop( commodityId , None )
+            if ( entry is not None ):
+                if ( entry[ 2 ] == signature ):
+                    PriceDataCache.entries[ commodityId ] = entry
+                    PriceDataCache.hits += 1
+                    return entry[ 0 ].get_read_only_view()
+                PriceDataCache.usedBytes -= entry[ 1 ]
+                PriceDataCache.invalidations += 1
+            PriceDataCache.misses += 1
+        
+        priceData = PriceReader.get_price_data( commodityId )
+        if ( priceData is None ):
+            return None
+        if ( not isinstance( priceData , ArrayPriceData ) ):
+            priceData = ArrayPriceData( priceData.get_id() , priceData.get_name() , \
+                            priceData.dates() , priceData.prices() , priceData.averages() , \
+                            priceData.volumes() )
+        size = priceData.get_memory_usage()
+        
+        with PriceDataCache.lock:
+            
+            #another thread may have cached the same commodity while we
+            #were reading it
+            oldEntry = PriceDataCache.entries.pop( commodityId , None )
+            if ( oldEntry is not None ):
+                PriceDataCache.usedBytes -= oldEntry[ 1 ]
+            if ( size <= PriceDataCache.maxBytes ):
+                PriceDataCache.entries[ commodityId ] = (priceData , size , signature)
+                PriceDataCache.usedBytes += size
+                PriceDataCache._evict()
+        return priceData.get_read_only_view()
+        
+    '''
+    Sets the maximum number of bytes of price data to keep in the cache,
+    evicting commodities if the cache is now too full.
+    
+    @param maxBytes - the new byte budget of the cache, as an integer
+    '''
+    @staticmethod
+    def set_max_bytes( maxBytes ):
+        with PriceDataCache.lock:
+            PriceDataCache.maxBytes = maxBytes
+            PriceDataCache._evict()
+    
+    '''
+    Evicts the least recently used commodities until the cache is within
+    its byte budget. The lock must be held by the caller.
+    '''
+    @staticmethod
+    def _evict():
+        while ( PriceDataCache.usedBytes > PriceDataCache.maxBytes ):
+            commodityId , entry = PriceDataCache.entries.popitem( last=False )
+            PriceDataCache.usedBytes -= entry[ 1 ]
+            PriceDataCache.evictions += 1
+    
+    '''
+    Removes everything from the cache and resets its counters.
+    '''
+    @staticmethod
+    def clear():
+        with PriceDataCache.lock:
+            PriceDataCache.entries.clear()
+            PriceDataCache.usedBytes = 0
+            PriceDataCache.hits = 0
+            PriceDataCache.misses = 0
+            PriceDataCache.evictions = 0
+            PriceDataCache.invalidations = 0
+    
+    '''
+    @return - a dictionary with the cache's hit, miss, eviction and
+    invalidation counters, the number of cached commodities, and the
+    estimated number of bytes used ("usedBytes") out of the byte budget
+    '''
+    @staticmethod
+    def get_stats():
+        with PriceDataCache.lock:
+            return { "hits" : PriceDataCache.hits , \
+                     "misses" : PriceDataCache.misses , \
+                     "evictions" : PriceDataCache.evictions , \
+                     "invalidations" : PriceDataCache.invalidations , \
+                     "items" : len( PriceDataCache.entries ) , \
+                     "usedBytes" : PriceDataCache.usedBytes , \
+                     "maxBytes" : PriceDataCache.maxBytes }
             
 '''
 Provides functions for managing data. 
@@ -165,7 +309,8 @@ class DataManager( object ):
     
     '''
     Gets all known price data for the commodity with the given name.
-    The name is not case sensitive.
+    The name is not case sensitive. The data is cached, so it should not
+    be modified!
     
     @param name - the name of a commodity, as a string
     @return - the PriceData for the given commodity, or None if the commodity
@@ -174,10 +319,11 @@ class DataManager( object ):
     @staticmethod
     def get_data_by_name( name ):
         id = DataManager.nameToId[ name.lower() ]
-        return PriceReader.get_price_data_from_csv( id )
+        return PriceDataCache.get( id )
         
     '''
     Gets all known price data for the commodity with the given ID.
+    The data is cached, so it should not be modified!
     
     @param id - the ID of a commodity, as an integer
     @return - the PriceData for the given commodity, or None if the
@@ -185,65 +331,112 @@ class DataManager( object ):
     '''
     @staticmethod
     def get_data_by_id( id ):
-        return PriceReader.get_price_data_from_csv( id )
+        return PriceDataCache.get( id )
         
     '''
     Gets all price data for a given commodity starting at the given start
     date and ending at the given end date. These dates are inclusive.
     
+    The data comes from the commodity's master series. Its dates are sorted
+    day ordinals, so the requested window is found by binary search and
+    returned as slices of the series: a query costs O(log n + k) for a
+    series of n days and a window of k days, and no other files are read.
+    When the commodity's binary file is current, the slices are views into
+    the memory-mapped file and nothing is copied.
+    
     @param name - the name of a commodity. This is a case insensitive string.
     @param startMonth - the month of the start date, as an integer.
     @param startYear - the year of the start date, as an integer.
     @param endMonth - the month of the end date, as an integer.
     @param endYear - the year of the end date, as an integer.
+    @return - a (dates, daily, average, volume) tuple of NumPy arrays, where
+    dates holds the day ordinal of each datapoint in the window. The arrays
+    are empty if there is no data in the window.
     '''
     @staticmethod
     def get_data_by_date_range( name , startMonth , startYear , endMonth , endYear ):
-        caseSensitiveName = DataManager.idToName[ DataManager.nameToId[ name.lower() ] ]
+        id = DataManager.nameToId[ name.lower() ]
+        columns = PriceReader.get_price_columns( id )
+        if ( columns is None ):
+            empty = np.array( [] , dtype=np.int64 )
+            return (empty , empty , empty , empty)
+        dates , daily , average , volume = columns[ 1: ]
         
-        rtn = []
+        startDate = DateUtils.to_ordinal( startYear , startMonth , 1 )
+        endDate = DateUtils.to_ordinal( endYear , endMonth , \
+                    DateUtils.get_num_days_in_month( endMonth , endYear ) )
+        start = np.searchsorted( dates , startDate , side="left" )
+        end = np.searchsorted( dates , endDate , side="right" )
+        return (dates[ start:end ] , daily[ start:end ] , average[ start:end ] , volume[ start:end ])
+    
+def main():
+    from price_data import DataPoint , CommodityPriceData
+    
+    DataManager.init()
+    dates , daily , average , volume = DataManager.get_data_by_date_range( "Mithril ore" , 12 , 2015 , 1 , 2016 )
+    assert len( dates ) == 31 + 8
+    assert DateUtils.from_ordinal( dates[ 0 ] ) == (2015 , 12 , 1)
+    assert DateUtils.from_ordinal( dates[ -1 ] ) == (2016 , 1 , 8)
+    assert daily[ -1 ] == 252 and average[ -1 ] == 295 and volume[ -1 ] == 422970
+    dates , daily , average , volume = DataManager.get_data_by_date_range( "mithril ORE" , 1 , 2014 , 2 , 2015 )
+    assert len( dates ) == 0
+    
+    #repeated lookups are served from the cache until the file changes
+    import shutil
+    import tempfile
+    import time
+    PriceDataCache.clear()
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp()
+    try:
+        os.makedirs( tmpDir + "/price_data/master_list" )
+        for commodityId in [ 2 , 447 , 1038 ]:
+            shutil.copy( PriceStore.get_csv_filename( commodityId ) , \
+                         tmpDir + "/" + PriceStore.get_csv_filename( commodityId ) )
+        os.chdir( tmpDir )
+        first = DataManager.get_data_by_id( 447 )
+        assert DataManager.get_data_by_id( 447 ) == first
+        assert DataManager.get_data_by_name( "mithril ore" ) == first
+        assert PriceDataCache.get_stats()[ "hits" ] == 2
         
-        #iterate through month by month, year by year from the start to the
-        #end and add any nonzero datapoints to the list of data
-        currYear = startYear
-        currMonth = startMonth
-        while( currYear <= endYear ):
-            
-            #if the current year is before the end year, then we just
-            #iterate through all months
-            if ( currYear < endYear ):
-                while( currMonth <= 12 ):
-                    monthData = PriceReader.read_month_data( currMonth , currYear , caseSensitiveName )
-                    for day in range( 1 , len( monthData.data ) ):
-                        prices = monthData.get( day )
-                        
-                        #we only add nonzero prices becauase prices of 0
-                        #means that there was no price data for that given date
-                        if ( prices[ 0 ] != 0 and prices[ 1 ] != 0 ):
-                            rtn.append( (currYear , currMonth , day , prices[ 0 ] , prices[ 1 ] ) )
-                    currMonth = currMonth + 1
-                    
-                #have to reset the month back to 1 after we've gone through
-                #all 12 months in the current year
-                currMonth = 1
-                
-            #if the current year is the end year, then we can only iterate
-            #up to the end month
-            elif ( currYear == endYear ):
-                while( currMonth <= endMonth ):
-                    monthData = PriceReader.read_month_data( currMonth , currYear , name )
-                    for day in range( 1 , len( monthData.data ) ):
-                        prices = monthData.get( day )
-                        if ( prices[ 0 ] != 0 and prices[ 1 ] != 0 ):
-                            rtn.append( (currYear , currMonth , day , prices[ 0 ] , prices[ 1 ] ) )
-                    currMonth = currMonth + 1
-                
-            #move on to the next year
-            currYear = currYear + 1
+        #callers cannot change what the cache gives other callers
+        try:
+            first.prices()[ 0 ] = -1
+            assert False
+        except ValueError:
+            pass
+        first.append_datapoint( DataPoint( "2016" , "01" , "09" , 1 , 1 , 1 ) )
+        assert DataManager.get_data_by_id( 447 ).get_num_datapoints() == first.get_num_datapoints() - 1
+        first = DataManager.get_data_by_id( 447 )
+        assert PriceDataCache.get_stats()[ "misses" ] == 1
+        assert DataManager.get_data_by_id( -1 ) is None
         
-        return rtn
+        #appending to the file invalidates the cached data
+        time.sleep( 0.01 )
+        PriceWriter.save_list_data( CommodityPriceData( 447 , "Mithril ore" , \
+                    [ DataPoint( "2016" , "01" , "09" , 253 , 295 , 1000 ) ] ) )
+        updated = DataManager.get_data_by_id( 447 )
+        assert updated is not first
+        assert updated.get_num_datapoints() == first.get_num_datapoints() + 1
+        assert PriceDataCache.get_stats()[ "invalidations" ] == 1
+        
+        #a budget that only fits two commodities evicts the least recent one
+        PriceDataCache.set_max_bytes( updated.get_memory_usage()*2 + 1 )
+        assert PriceDataCache.get_stats()[ "evictions" ] == 0
+        DataManager.get_data_by_id( 2 )
+        DataManager.get_data_by_id( 1038 )
+        stats = PriceDataCache.get_stats()
+        assert stats[ "evictions" ] == 1 and stats[ "items" ] == 2
+        assert stats[ "usedBytes" ] <= stats[ "maxBytes" ]
+        assert 447 not in PriceDataCache.entries
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( tmpDir )
+        PriceDataCache.clear()
+        PriceDataCache.set_max_bytes( 256*1024*1024 )
+    
+    print "Regression testing for data_manager.py passed."
     
-def main():
     #DataManager.init()
     #DataManager.download_data_by_names( "mithril ore" , "mithril bar" , "coal" , "iron ore" , "steel bar" )
     #test = DataManager.get_data_by_date_range( "Mithril bar" , 12 , 2014 , 12 , 2015 )
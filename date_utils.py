@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from datetime import date
+import numpy as np
+
 class DateUtils( object ):
     
     DAYS_IN_MONTH = {
@@ -17,6 +20,19 @@ class DateUtils( object ):
         12 : 31
     }  
     
+    '''
+    Maps (year, month) tuples to the day ordinal of the first day of that
+    month, so that converting dates to ordinals does not have to create a
+    date object every time. The years and months are used as keys exactly
+    as they are given, so ("2015", "08") and (2015, 8) are separate entries.
+    '''
+    monthOrdinals = {}
+    
+    '''
+    The day ordinal of 1970/01/01, which NumPy counts its dates from
+    '''
+    EPOCH_ORDINAL = date( 1970 , 1 , 1 ).toordinal()
+    
     '''
     Determines the number of days in a given month.
     
@@ -100,9 +116,66 @@ class DateUtils( object ):
                 else:
                     return False
                     
+    '''
+    Converts a {year, month, day} date into an integer day ordinal. Day
+    ordinals count days from 0001/01/01 (which is day 1), so consecutive
+    days always have consecutive ordinals and dates can be compared and
+    subtracted as plain integers.
+    
+    @param year - the year of the date, as an integer or string
+    @param month - the month of the date, as an integer or string
+    @param day - the day of the date, as an integer or string
+    @return - the day ordinal of the given date, as an integer
+    '''
+    @staticmethod
+    def to_ordinal( year , month , day ):
+        firstDay = DateUtils.monthOrdinals.get( (year , month) )
+        if ( firstDay is None ):
+            firstDay = date( int( year ) , int( month ) , 1 ).toordinal()
+            DateUtils.monthOrdinals[ (year , month) ] = firstDay
+        return firstDay + int( day ) - 1
+        
+    '''
+    Converts arrays of {year, month, day} dates into an array of integer day
+    ordinals (see to_ordinal) in one vectorized step.
+    
+    @param years - the years of the dates, as a NumPy array of integers
+    @param months - the months of the dates, as a NumPy array of integers
+    @param days - the days of the dates, as a NumPy array of integers
+    @return - the day ordinals of the given dates, as a NumPy array of
+    integers
+    '''
+    @staticmethod
+    def to_ordinal_array( years , months , days ):
+        monthsSinceEpoch = (np.asarray( years , dtype=np.int64 ) - 1970)*12 + \
+                            np.asarray( months , dtype=np.int64 ) - 1
+        firstDays = monthsSinceEpoch.astype( "datetime64[M]" ).astype( "datetime64[D]" )
+        return firstDays.astype( np.int64 ) + np.asarray( days , dtype=np.int64 ) - 1 + \
+                DateUtils.EPOCH_ORDINAL
+        
+    '''
+    Converts an integer day ordinal back into a {year, month, day} date.
+    
+    @param ordinal - a day ordinal, as returned by to_ordinal()
+    @return - a (year, month, day) tuple of integers
+    '''
+    @staticmethod
+    def from_ordinal( ordinal ):
+        d = date.fromordinal( int( ordinal ) )
+        return (d.year , d.month , d.day)
+                    
 def main():
     assert DateUtils.is_after( 2015 , 8 , 27 , 2015 , 8 , 13 ) == False
     assert DateUtils.is_after( 2015 , 8 , 13 , 2015 , 8 , 27 ) == True
+    assert DateUtils.to_ordinal( 2015 , 3 , 1 ) - DateUtils.to_ordinal( 2015 , 2 , 28 ) == 1
+    assert DateUtils.to_ordinal( "2016" , "01" , "08" ) == DateUtils.to_ordinal( 2016 , 1 , 8 )
+    assert DateUtils.from_ordinal( DateUtils.to_ordinal( 2012 , 2 , 29 ) ) == (2012 , 2 , 29)
+    ordinals = DateUtils.to_ordinal_array( [ 1969 , 2012 , 2015 , 2016 ] , [ 12 , 2 , 3 , 1 ] , \
+                                           [ 31 , 29 , 1 , 8 ] )
+    assert ordinals.tolist() == [ DateUtils.to_ordinal( 1969 , 12 , 31 ) , \
+                                  DateUtils.to_ordinal( 2012 , 2 , 29 ) , \
+                                  DateUtils.to_ordinal( 2015 , 3 , 1 ) , \
+                                  DateUtils.to_ordinal( 2016 , 1 , 8 ) ]
     print "Regression testing for date_utils.py passed."
 
 if __name__ == "__main__" : main()
\ No newline at end of file
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+'''
+Stores the features of each commodity that the profitability rankings and
+the item stats are computed from, so that they do not have to be computed
+from the commodity's whole price history every time.
+
+The features of a commodity are:
+
+* the last 180 average prices and the number of trend reversals in them
+* the sum and number of the nonzero trade volumes, for the average volume
+* the daily price and volume on the last day
+* the highest and lowest nonzero daily price and volume, leaving out the
+first and last day, as in price_data/item_stats
+* the date of the last day they cover and the number of days they cover
+* the size and modification time of the commodity's CSV file when they
+were computed from it
+
+Each commodity's features are kept in price_data/features/<id>.bin as one
+little-endian record of FeatureStore.FEATURES, with no header, so reading
+them is a single read that needs no parsing. When new
+datapoints are appended to the master list, only the new datapoints are
+folded into the stored features. Features whose CSV size and modification
+time no longer match the commodity's CSV file were not kept up to date and
+are not used, and neither are the features of a commodity whose CSV file
+is gone.
+'''
+class FeatureStore( object ):
+
+    '''
+    The folder in which features are stored
+    '''
+    DIRECTORY = "price_data/features"
+
+    '''
+    How many of the most recent average prices are kept to count trend
+    reversals in
+    '''
+    NUM_AVERAGES = 180
+
+    '''
+    The highest and lowest values recorded when a commodity has no valid
+    prices or volumes, as in price_data/item_stats
+    '''
+    NO_MAX = 0
+    NO_MIN = 999999999
+
+    FEATURES = np.dtype( [ ("id" , "<i8") , ("name" , "S64") , ("lastDate" , "<i4") , \
+                           ("count" , "<i8") , ("lastPrice" , "<i8") , ("lastVolume" , "<i8") , \
+                           ("volumeSum" , "<i8") , ("volumeCount" , "<i8") , \
+                           ("maxPrice" , "<i8") , ("minPrice" , "<i8") , \
+                           ("maxVolume" , "<i8") , ("minVolume" , "<i8") , \
+                           ("numAverages" , "<i8") , ("averages" , "<i8" , (180 ,)) , \
+                           ("trendChanges" , "<i8") , ("csvSize" , "<i8") , \
+                           ("csvMtime" , "<f8") ] )
+
+    '''
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the name of the file that stores the given commodity's features
+    '''
+    @staticmethod
+    def get_filename( commodityId ):
+        return FeatureStore.DIRECTORY + "/" + str( commodityId ) + ".bin"
+
+    '''
+    Counts how many times the trend of a commodity's average price
+    reversed over the last 180 days. See ProfitabilityRanker.
+
+    @param averages - the commodity's average prices, as an array
+    @return - the number of trend reversals
+    '''
+    @staticmethod
+    def count_trend_changes( averages ):
+        numDatapoints = len( averages )
+
+        #use the average price data over the last 180 days to
+        #see if a given commodity changes trend enough to be
+        #profitable to trade on. Indices before the start of a short
+        #series wrap around to its end, as they always have, but a series
+        #too short to wrap around once is used as it is.
+        if ( numDatapoints*2 >= 180 ):
+            averagePrices = averages[ np.arange( numDatapoints-180 , numDatapoints ) ]
+        else:
+            averagePrices = np.asarray( averages )
+
+        #calculate number of trend reversals in the average price trends
+        differences = np.diff( averagePrices )
+        differences =  differences[ differences != 0 ]
+        isPositive = (differences > 0).astype( int )
+        isNegatve = (differences < 0).astype( int )
+        trends = (isPositive - isNegatve)
+        isTrendChange = (np.abs( np.diff( trends )) == 2)
+        return np.sum( isTrendChange )
+
+    '''
+    Creates the features of a commodity that has no price data yet.
+
+    @param commodityId - the ID of the commodity, as an integer
+    @param name - the name of the commodity, as a string
+    @return - the features, as a record of FeatureStore.FEATURES
+    '''
+    @staticmethod
+    def empty( commodityId , name ):
+        features = np.zeros( 1 , dtype=FeatureStore.FEATURES )[ 0 ]
+        features[ "id" ] = commodityId
+        features[ "name" ] = name
+        features[ "maxPrice" ] = features[ "maxVolume" ] = FeatureStore.NO_MAX
+        features[ "minPrice" ] = features[ "minVolume" ] = FeatureStore.NO_MIN
+        features[ "csvSize" ] = -1
+        return features
+
+    '''
+    Folds new datapoints into the features of a commodity. The cost depends
+    only on the number of new datapoints, not on the length of the history.
+
+    @param features - the features, as a record of FeatureStore.FEATURES.
+    It is updated in place.
+    @param dates - the day ordinals of the new datapoints, which must all
+    come after features["lastDate"]
+    @param daily - the daily prices of the new datapoints
+    @param average - the average prices of the new datapoints
+    @param volume - the trade volumes of the new datapoints
+    '''
+    @staticmethod
+    def update( features , dates , daily , average , volume ):
+        numNew = len( dates )
+        if ( numNew == 0 ):
+            return
+        oldCount = int( features[ "count" ] )
+        count = oldCount + numNew
+
+        #the stats leave out the first and last day, so the day that used
+        #to be the last one is counted now (unless it is also the first
+        #day), along with every new day except the new last one
+        first = max( 0 , 1 - oldCount )
+        prices = np.asarray( daily[ first:-1 ] , dtype=np.int64 )
+        volumes = np.asarray( volume[ first:-1 ] , dtype=np.int64 )
+        if ( oldCount >= 2 ):
+            prices = np.concatenate( ( [ features[ "lastPrice" ] ] , prices ) )
+            volumes = np.concatenate( ( [ features[ "lastVolume" ] ] , volumes ) )
+
+        #prices and volumes of 0 are invalid
+        prices = prices[ prices != 0 ]
+        volumes = volumes[ volumes != 0 ]
+        if ( prices.size > 0 ):
+            features[ "maxPrice" ] = max( features[ "maxPrice" ] , prices.max() )
+            features[ "minPrice" ] = min( features[ "minPrice" ] , prices.min() )
+        if ( volumes.size > 0 ):
+            features[ "maxVolume" ] = max( features[ "maxVolume" ] , volumes.max() )
+            features[ "minVolume" ] = min( features[ "minVolume" ] , volumes.min() )
+
+        nonzeroVolumes = np.asarray( volume , dtype=np.int64 )
+        nonzeroVolumes = nonzeroVolumes[ nonzeroVolumes != 0 ]
+        features[ "volumeSum" ] += np.sum( nonzeroVolumes )
+        features[ "volumeCount" ] += nonzeroVolumes.size
+
+        numAverages = int( features[ "numAverages" ] )
+        averages = np.concatenate( ( features[ "averages" ][ 0:numAverages ] , \
+                                     average ) )[ -FeatureStore.NUM_AVERAGES: ]
+        features[ "numAverages" ] = len( averages )
+        features[ "averages" ][ 0:len( averages ) ] = averages
+        features[ "trendChanges" ] = FeatureStore.count_trend_changes( averages )
+
+        features[ "lastDate" ] = dates[ -1 ]
+        features[ "lastPrice" ] = daily[ -1 ]
+        features[ "lastVolume" ] = volume[ -1 ]
+        features[ "count" ] = count
+
+    '''
+    Computes the features of a commodity from all of its price data.
+
+    @param commodityId - the ID of the commodity, as an integer
+    @param name - the name of the commodity, as a string
+    @param dates - the day ordinal of each datapoint
+    @param daily - the daily price of each datapoint
+    @param average - the average price of each datapoint
+    @param volume - the trade volume of each datapoint
+    @return - the features, as a record of FeatureStore.FEATURES
+    '''
+    @staticmethod
+    def compute( commodityId , name , dates , daily , average , volume ):
+        features = FeatureStore.empty( commodityId , name )
+        FeatureStore.update( features , dates , daily , average , volume )
+        return features
+
+    '''
+    Writes the features of a commodity to its file. The file is written to
+    a temporary file first and then renamed so that readers never see a
+    partially written file.
+
+    @param features - the features, as a record of FeatureStore.FEATURES
+    @param csvSignature - the PriceStore.get_csv_signature() of the CSV file
+    the features are up to date with. If None, the features will not be
+    used until they are computed again.
+    '''
+    @staticmethod
+    def write( features , csvSignature ):
+        features[ "csvSize" ] , features[ "csvMtime" ] = csvSignature if csvSignature is not None \
+                                                        else (-1 , 0.0)
+        if ( not os.path.exists( FeatureStore.DIRECTORY ) ):
+            os.makedirs( FeatureStore.DIRECTORY )
+        filename = FeatureStore.get_filename( int( features[ "id" ] ) )
+        f = open( filename + ".tmp" , "wb" )
+        f.write( np.array( [ features ] , dtype=FeatureStore.FEATURES ).tostring() )
+        f.close()
+        os.rename( filename + ".tmp" , filename )
+
+    '''
+    Reads the stored features of a commodity, if they are up to date with
+    its CSV file in the master list. They are up to date if the size and
+    modification time of the CSV file are the ones stored with them, as in
+    PriceStore.is_current().
+
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the features, as a record of FeatureStore.FEATURES, or None if
+    there are no features for the commodity, they are out of date or the
+    commodity has no CSV file
+    '''
+    @staticmethod
+    def get( commodityId ):
+        from price_store import PriceStore
+        features = FeatureStore._read( FeatureStore.get_filename( commodityId ) )
+        if ( features is None ):
+            return None
+        signature = PriceStore.get_csv_signature( commodityId )
+        if ( signature is None or \
+                (int( features[ "csvSize" ] ) , float( features[ "csvMtime" ] )) != signature ):
+            return None
+        return features
+    
+    '''
+    @param filename - the name of a features file
+    @return - the features in the file, as a record of FeatureStore.FEATURES,
+    or None if the file does not hold exactly one record
+    '''
+    @staticmethod
+    def _read( filename ):
+        try:
+            f = open( filename , "rb" )
+            data = f.read()
+            f.close()
+        except IOError:
+            return None
+        if ( len( data ) != FeatureStore.FEATURES.itemsize ):
+            return None
+        return np.fromstring( data , dtype=FeatureStore.FEATURES )[ 0 ]
+
+    '''
+    Folds datapoints that were just appended to a commodity's CSV file into
+    its stored features. The new datapoints are only folded in if the stored
+    features were up to date with the file before it changed and end on the
+    same day as the file did. Otherwise the file was changed some other way,
+    for example rewritten or appended to without the features being
+    updated, so the features are computed again from the whole file.
+    Commodities with no stored features are left without any.
+
+    @param priceData - a CommodityPriceData object with the datapoints that
+    were appended
+    @param numAppended - how many datapoints at the end of priceData were
+    appended
+    @param features - the features returned by get() before the datapoints
+    were appended, or None if they were not up to date
+    @param lastDate - the day ordinal of the last datapoint in the CSV file
+    before the datapoints were appended, or None if it had none
+    @return - True if the stored features were updated
+    '''
+    @staticmethod
+    def append( priceData , numAppended , features , lastDate ):
+        from price_store import PriceStore
+        if ( numAppended == 0 or \
+                not os.path.exists( FeatureStore.get_filename( priceData.get_id() ) ) ):
+            return False
+        
+        #the CSV file is looked at before it is read, so if it changes
+        #while it is read, the features will not be up to date with it
+        signature = PriceStore.get_csv_signature( priceData.get_id() )
+        if ( features is None or \
+                ( lastDate is None and features[ "count" ] != 0 ) or \
+                ( lastDate is not None and ( features[ "count" ] == 0 or \
+                                             features[ "lastDate" ] != lastDate ) ) ):
+            from price_data_io import PriceReader
+            columns = PriceReader.get_price_data_from_csv( priceData.get_id() )
+            FeatureStore.write( FeatureStore.compute( priceData.get_id() , columns.get_name() , \
+                    columns.dates() , columns.prices() , columns.averages() , columns.volumes() ) , \
+                    signature )
+            return True
+        
+        start = priceData.get_num_datapoints() - numAppended
+        FeatureStore.update( features , priceData.dates()[ start: ] , priceData.prices()[ start: ] , \
+                             priceData.averages()[ start: ] , priceData.volumes()[ start: ] )
+        FeatureStore.write( features , signature )
+        return True
+    
+    '''
+    Computes the stored features of a commodity again after its CSV file
+    was rewritten with the given price data. Commodities with no stored
+    features are left without any.
+    
+    @param priceData - a CommodityPriceData object with all the price data
+    that was written to the commodity's CSV file
+    @return - True if the stored features were computed again
+    '''
+    @staticmethod
+    def replace( priceData ):
+        from price_store import PriceStore
+        if ( not os.path.exists( FeatureStore.get_filename( priceData.get_id() ) ) ):
+            return False
+        FeatureStore.write( FeatureStore.compute( priceData.get_id() , priceData.get_name() , \
+                priceData.dates() , priceData.prices() , priceData.averages() , priceData.volumes() ) , \
+                PriceStore.get_csv_signature( priceData.get_id() ) )
+        return True
+
+    '''
+    Computes and stores the features of commodities from their price data.
+    Commodities whose features are already up to date are skipped.
+
+    @param commodityIds - the IDs of the commodities, as a list of integers.
+    If None, every commodity with a CSV file in the master list is included.
+    @return - the number of commodities whose features were computed
+    '''
+    @staticmethod
+    def build( commodityIds=None ):
+        from price_data_io import PriceReader
+        from price_store import PriceStore
+        if ( commodityIds is None ):
+            commodityIds = PriceStore.get_csv_ids()
+        built = 0
+        for commodityId in commodityIds:
+            if ( FeatureStore.get( commodityId ) is not None ):
+                continue
+            signature = PriceStore.get_csv_signature( commodityId )
+            columns = PriceReader.get_price_columns( commodityId )
+            if ( columns is None ):
+                continue
+            FeatureStore.write( FeatureStore.compute( commodityId , *columns ) , signature )
+            built += 1
+        return built
+
+def main():
+    import shutil
+    import tempfile
+    import time
+    from price_data_io import PriceReader , PriceWriter
+    from price_store import PriceStore
+    from price_data import CommodityPriceData
+
+    #features built all at once match the ones updated a few days at a time
+    for commodityId in [ 2 , 447 , 1038 ]:
+        name , dates , daily , average , volume = PriceReader.get_price_columns( commodityId )
+        expected = FeatureStore.compute( commodityId , name , dates , daily , average , volume )
+        for step in [ 1 , 7 , 100 ]:
+            features = FeatureStore.empty( commodityId , name )
+            for i in range( 0 , len( dates ) , step ):
+                FeatureStore.update( features , dates[ i:i+step ] , daily[ i:i+step ] , \
+                                     average[ i:i+step ] , volume[ i:i+step ] )
+            assert features.tostring() == expected.tostring()
+        assert expected[ "trendChanges" ] == FeatureStore.count_trend_changes( average )
+        assert expected[ "volumeSum" ] == np.sum( volume )
+        assert expected[ "maxPrice" ] == np.max( daily[ 1:-1 ] )
+        assert expected[ "minVolume" ] == np.min( volume[ 1:-1 ][ volume[ 1:-1 ] != 0 ] )
+    features = FeatureStore.compute( 447 , "Mithril ore" , *PriceReader.get_price_columns( 447 )[ 1: ] )
+    assert features[ "lastPrice" ] == 252 and features[ "lastVolume" ] == 422970
+    assert features[ "count" ] == PriceReader.get_price_data( 447 ).get_num_datapoints()
+
+    #stored features are compared without the CSV file they were stored for
+    def without_csv( features ):
+        features = np.array( [ features ] , dtype=FeatureStore.FEATURES )[ 0 ]
+        features[ "csvSize" ] , features[ "csvMtime" ] = (-1 , 0.0)
+        return features.tostring()
+
+    #appending to the master list keeps the stored features up to date
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp()
+    try:
+        os.makedirs( tmpDir + "/price_data/master_list" )
+        history = PriceReader.get_price_data_from_csv( 447 )
+        os.chdir( tmpDir )
+        datapoints = history.get_all_datapoints()
+        PriceWriter.save_list_data( CommodityPriceData( 447 , history.get_name() , datapoints[ 0:300 ] ) )
+        assert FeatureStore.get( 447 ) is None
+        assert FeatureStore.build( [ 447 , 2 ] ) == 1
+        assert FeatureStore.build( [ 447 ] ) == 0
+        assert FeatureStore.get( 447 )[ "count" ] == 300
+
+        time.sleep( 0.01 )
+        PriceWriter.save_list_data( CommodityPriceData( 447 , history.get_name() , datapoints[ 290: ] ) )
+        assert without_csv( FeatureStore.get( 447 ) ) == without_csv( features )
+
+        #rewriting the file computes the features again
+        PriceWriter.write_price_data_to_csv( PriceStore.get_csv_filename( 447 ) , history )
+        assert without_csv( FeatureStore.get( 447 ) ) == without_csv( features )
+        
+        #features that were not kept up to date are not used, even if the
+        #file changed within the same clock tick or kept its old time
+        filename = PriceStore.get_csv_filename( 447 )
+        csvTime = int( os.path.getmtime( filename ) )
+        os.utime( filename , (csvTime , csvTime) )
+        assert FeatureStore.replace( PriceReader.get_price_data_from_csv( 447 ) )
+        text = open( filename ).read()
+        f = open( filename , "w" )
+        f.write( text.rsplit( "\n" , 2 )[ 0 ] + "\n" )
+        f.close()
+        os.utime( filename , (csvTime , csvTime) )
+        assert FeatureStore.get( 447 ) is None
+        f = open( filename , "w" )
+        f.write( text )
+        f.close()
+        os.utime( filename , (csvTime , csvTime) )
+        assert without_csv( FeatureStore.get( 447 ) ) == without_csv( features )
+        os.utime( filename , (csvTime - 10 , csvTime - 10) )
+        assert FeatureStore.get( 447 ) is None
+        os.rename( filename , filename + ".bak" )
+        assert FeatureStore.get( 447 ) is None
+        os.rename( filename + ".bak" , filename )
+        
+        #and appending after the file was changed some other way computes
+        #them again instead of folding the new datapoints into stale ones
+        short = CommodityPriceData( 447 , history.get_name() , datapoints[ 0:200 ] )
+        os.remove( filename )
+        PriceWriter.save_list_data( short )
+        FeatureStore.write( FeatureStore.compute( 447 , *PriceReader.get_price_columns( 447 ) ) , \
+                            PriceStore.get_csv_signature( 447 ) )
+        
+        #the file is rewritten with 20 more datapoints without updating the
+        #features, and then 10 more are appended
+        f = open( filename , "a" )
+        f.write( "".join( [ str( x ) + "\n" for x in datapoints[ 200:220 ] ] ) )
+        f.close()
+        PriceWriter.save_list_data( CommodityPriceData( 447 , history.get_name() , datapoints[ 0:230 ] ) )
+        expected = FeatureStore.compute( 447 , *PriceReader.get_price_columns( 447 ) )
+        assert expected[ "count" ] == 230
+        assert without_csv( FeatureStore.get( 447 ) ) == without_csv( expected )
+        
+        #10 datapoints are appended without updating the features, as if a
+        #run crashed in between, and then 10 more are appended
+        time.sleep( 0.01 )
+        PriceWriter.append_price_data_to_csv( filename , CommodityPriceData( 447 , \
+                                              history.get_name() , datapoints[ 0:240 ] ) )
+        time.sleep( 0.01 )
+        PriceWriter.save_list_data( CommodityPriceData( 447 , history.get_name() , datapoints[ 0:250 ] ) )
+        expected = FeatureStore.compute( 447 , *PriceReader.get_price_columns( 447 ) )
+        assert expected[ "count" ] == 250
+        assert without_csv( FeatureStore.get( 447 ) ) == without_csv( expected )
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( tmpDir )
+
+    print "Regression testing for feature_store.py passed."
+
+if __name__ == "__main__" : main()
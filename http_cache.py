@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+
+'''
+Makes HTTP GET requests through pooled keep-alive sessions and keeps the
+responses in an on-disk cache keyed by URL.
+
+A cached response younger than ttl seconds is returned without making any
+request. An older one is revalidated by sending its ETag and Last-Modified
+values back as If-None-Match and If-Modified-Since, so if the page has not
+changed the server answers 304 Not Modified and the page is not downloaded
+again.
+
+Each thread gets its own requests.Session (sessions are not safe to share
+between threads), and every session keeps its connections open between
+requests.
+
+The cache takes at most maxBytes on disk. Once it grows past that, the
+responses that were fetched the longest time ago are removed.
+'''
+class HttpCache( object ):
+
+    '''
+    The folder in which cached responses are stored
+    '''
+    DIRECTORY = "price_data/http_cache"
+
+    '''
+    How many seconds a cached response is used without revalidating it
+    '''
+    ttl = 3600
+
+    '''
+    If False, every request goes to the server and nothing is cached
+    '''
+    enabled = True
+
+    '''
+    The most bytes that cached responses may take up on disk. When saving a
+    response takes the cache over this size, the oldest responses are removed
+    until the cache is back under 90% of it.
+    '''
+    maxBytes = 256*1024*1024
+
+    sessions = threading.local()
+    lock = threading.Lock()
+    stats = { "requests" : 0 , "hits" : 0 , "revalidated" : 0 , "misses" : 0 , \
+              "bytesDownloaded" : 0 , "bytesSaved" : 0 }
+
+    '''
+    Maps each folder that responses have been saved in to how many bytes the
+    files in it take up
+    '''
+    diskBytes = {}
+
+    '''
+    @return - a new set of counters, all 0, to be passed to track()
+    '''
+    @staticmethod
+    def new_stats():
+        return dict( [ (key , 0) for key in HttpCache.stats ] )
+
+    '''
+    Makes the requests made by the current thread also be counted in the
+    given counters, on top of the counters of the whole process. This is
+    how a crawl counts its own requests while other crawls are running.
+
+    @param stats - counters from new_stats(), or None to stop counting the
+    current thread's requests anywhere but in the counters of the process
+    '''
+    @staticmethod
+    def track( stats ):
+        HttpCache.sessions.stats = stats
+
+    '''
+    @return - the requests.Session of the current thread
+    '''
+    @staticmethod
+    def get_session():
+        session = getattr( HttpCache.sessions , "session" , None )
+        if ( session is None ):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter( pool_connections=4 , pool_maxsize=4 )
+            session.mount( "http://" , adapter )
+            session.mount( "https://" , adapter )
+            HttpCache.sessions.session = session
+        return session
+
+    '''
+    @param url - a URL, as a string
+    @return - the file in which the cached response for the URL is stored
+    '''
+    @staticmethod
+    def get_filename( url ):
+        return HttpCache.DIRECTORY + "/" + hashlib.sha1( url ).hexdigest() + ".json"
+
+    '''
+    Gets the body of the response to a GET request for the given URL, from
+    the cache if possible.
+
+    @param url - the URL to get, as a string
+    @param cacheable - if given, a function that takes the body of a response
+    and returns False if it should not be cached (for example, an error page)
+    @return - the body of the response, as a unicode string
+    '''
+    @staticmethod
+    def get( url , cacheable=None ):
+        if ( not HttpCache.enabled ):
+            response = HttpCache.get_session().get( url )
+            HttpCache._count( "requests" , "misses" , bytesDownloaded=len( response.content ) )
+            return response.text
+
+        filename = HttpCache.get_filename( url )
+        entry = HttpCache._load( filename )
+        if ( entry is not None and time.time() - entry[ "fetched" ] < HttpCache.ttl ):
+            HttpCache._count( "hits" , bytesSaved=HttpCache.get_size( entry ) )
+            return entry[ "body" ]
+
+        headers = {}
+        if ( entry is not None ):
+            if ( entry.get( "etag" ) ):
+                headers[ "If-None-Match" ] = entry[ "etag" ]
+            if ( entry.get( "lastModified" ) ):
+                headers[ "If-Modified-Since" ] = entry[ "lastModified" ]
+        response = HttpCache.get_session().get( url , headers=headers )
+
+        if ( response.status_code == 304 and entry is not None ):
+            HttpCache._count( "requests" , "revalidated" , \
+                                 bytesSaved=HttpCache.get_size( entry ) )
+            entry[ "fetched" ] = time.time()
+            HttpCache._save( filename , entry )
+            return entry[ "body" ]
+
+        HttpCache._count( "requests" , "misses" , bytesDownloaded=len( response.content ) )
+        body = response.text
+        if ( response.status_code == 200 and ( cacheable is None or cacheable( body ) ) ):
+            HttpCache._save( filename , { "url" : url , "fetched" : time.time() , \
+                                "etag" : response.headers.get( "ETag" ) , \
+                                "lastModified" : response.headers.get( "Last-Modified" ) , \
+                                "bytes" : len( response.content ) , "body" : body } )
+        return body
+
+    '''
+    @param entry - a cached response
+    @return - how many bytes the server sent for the body of the response
+    '''
+    @staticmethod
+    def get_size( entry ):
+        if ( "bytes" in entry ):
+            return entry[ "bytes" ]
+        return len( entry[ "body" ].encode( "utf-8" ) )
+
+    '''
+    Removes the responses that were fetched the longest time ago until the
+    cache takes up no more than the given number of bytes on disk.
+
+    @param maxBytes - the most bytes the cache may take up afterwards
+    '''
+    @staticmethod
+    def prune( maxBytes ):
+        with HttpCache.lock:
+            entries = []
+            if ( os.path.exists( HttpCache.DIRECTORY ) ):
+                for name in os.listdir( HttpCache.DIRECTORY ):
+                    if ( name.endswith( ".json" ) ):
+                        try:
+                            info = os.stat( HttpCache.DIRECTORY + "/" + name )
+                        except OSError:
+                            continue
+                        entries.append( (info.st_mtime , info.st_size , name) )
+            entries.sort()
+            total = sum( [ x[ 1 ] for x in entries ] )
+            for mtime , size , name in entries:
+                if ( total <= maxBytes ):
+                    break
+                try:
+                    os.remove( HttpCache.DIRECTORY + "/" + name )
+                except OSError:
+                    pass
+                total -= size
+            HttpCache.diskBytes[ HttpCache.DIRECTORY ] = total
+
+    '''
+    @return - a copy of the cache's counters: the number of requests made,
+    cache hits (no request), revalidations (304 responses), misses (full
+    downloads), bytes downloaded and bytes that did not have to be
+    downloaded thanks to the cache
+    '''
+    @staticmethod
+    def get_stats():
+        with HttpCache.lock:
+            return dict( HttpCache.stats )
+
+    '''
+    Resets the cache's counters to 0.
+    '''
+    @staticmethod
+    def reset_stats():
+        with HttpCache.lock:
+            for key in HttpCache.stats:
+                HttpCache.stats[ key ] = 0
+
+    @staticmethod
+    def _count( *keys , **amounts ):
+        tracked = getattr( HttpCache.sessions , "stats" , None )
+        with HttpCache.lock:
+            for stats in [ HttpCache.stats , tracked ]:
+                if ( stats is None ):
+                    continue
+                for key in keys:
+                    stats[ key ] += 1
+                for key , amount in amounts.items():
+                    stats[ key ] += amount
+
+    @staticmethod
+    def _load( filename ):
+        try:
+            f = open( filename , "r" )
+            entry = json.load( f )
+            f.close()
+            return entry
+        except (IOError , ValueError):
+            return None
+
+    '''
+    Writes a cache entry to a temporary file and renames it, so that other
+    threads never read a partially written entry, then prunes the cache if
+    it has grown past maxBytes.
+    '''
+    @staticmethod
+    def _save( filename , entry ):
+        if ( not os.path.exists( HttpCache.DIRECTORY ) ):
+            try:
+                os.makedirs( HttpCache.DIRECTORY )
+            except OSError:
+                pass
+        tmpFilename = filename + "." + str( threading.current_thread().ident ) + ".tmp"
+        f = open( tmpFilename , "w" )
+        json.dump( entry , f )
+        f.close()
+        size = os.path.getsize( tmpFilename )
+        with HttpCache.lock:
+            diskBytes = HttpCache.diskBytes.get( HttpCache.DIRECTORY )
+            if ( diskBytes is not None and os.path.exists( filename ) ):
+                diskBytes -= os.path.getsize( filename )
+            os.rename( tmpFilename , filename )
+            if ( diskBytes is not None ):
+                diskBytes += size
+                HttpCache.diskBytes[ HttpCache.DIRECTORY ] = diskBytes
+        #the size of the cache is only known once its folder has been listed
+        if ( diskBytes is None ):
+            HttpCache.prune( HttpCache.maxBytes )
+        elif ( diskBytes > HttpCache.maxBytes ):
+            HttpCache.prune( int( HttpCache.maxBytes*0.9 ) )
+
+def main():
+    from stub_server import StubGrandExchangeServer
+    import shutil
+    import tempfile
+
+    server = StubGrandExchangeServer()
+    server.start()
+    defaultDirectory = HttpCache.DIRECTORY
+    defaultTtl = HttpCache.ttl
+    defaultMaxBytes = HttpCache.maxBytes
+    HttpCache.DIRECTORY = tempfile.mkdtemp()
+    HttpCache.reset_stats()
+    try:
+        url = server.get_url() + "/viewitem?obj=447"
+        page = HttpCache.get( url )
+        assert "Mithril ore" in page
+        assert HttpCache.get( url ) == page
+        stats = HttpCache.get_stats()
+        assert stats[ "requests" ] == 1 and stats[ "misses" ] == 1 and stats[ "hits" ] == 1
+        assert stats[ "bytesSaved" ] == stats[ "bytesDownloaded" ] and server.requests == 1
+
+        #the bytes saved are counted in bytes sent by the server, not in
+        #decoded characters
+        entry = json.load( open( HttpCache.get_filename( url ) ) )
+        body = u"caf\xe9 " + entry[ "body" ]
+        assert HttpCache.get_size( { "body" : body } ) == len( page ) + 6
+        assert HttpCache.get_size( dict( entry , body=body ) ) == len( page )
+
+        #requests made by a thread that is tracked are also counted in its
+        #own counters
+        tracked = HttpCache.new_stats()
+        HttpCache.track( tracked )
+        try:
+            HttpCache.get( url )
+        finally:
+            HttpCache.track( None )
+        HttpCache.get( url )
+        assert tracked[ "hits" ] == 1 and tracked[ "bytesSaved" ] == len( page )
+        assert HttpCache.get_stats()[ "hits" ] == 3
+
+        #once the cached page is stale, it is revalidated instead of
+        #downloaded again
+        HttpCache.ttl = 0
+        assert HttpCache.get( url ) == page
+        stats = HttpCache.get_stats()
+        assert stats[ "requests" ] == 2 and stats[ "revalidated" ] == 1
+        assert stats[ "bytesDownloaded" ] == len( page )
+
+        #pages that are not cacheable are always downloaded
+        errorUrl = server.get_url() + "/viewitem?obj=1"
+        HttpCache.get( errorUrl , lambda body : "Sorry" not in body )
+        HttpCache.get( errorUrl , lambda body : "Sorry" not in body )
+        assert HttpCache.get_stats()[ "misses" ] == 3
+
+        #the responses fetched the longest time ago are removed to keep the
+        #cache under maxBytes
+        HttpCache.ttl = 3600
+        HttpCache.maxBytes = 3*os.path.getsize( HttpCache.get_filename( url ) )
+        urls = [ server.get_url() + "/viewitem?obj=" + str( x ) for x in [ 2 , 6 , 8 , 1038 ] ]
+        os.utime( HttpCache.get_filename( url ) , (0 , 0) )
+        for i , other in enumerate( urls ):
+            HttpCache.get( other )
+            os.utime( HttpCache.get_filename( other ) , (i+1 , i+1) )
+        assert not os.path.exists( HttpCache.get_filename( url ) )
+        assert not os.path.exists( HttpCache.get_filename( urls[ 0 ] ) )
+        assert os.path.exists( HttpCache.get_filename( urls[ -1 ] ) )
+        assert sum( [ os.path.getsize( HttpCache.DIRECTORY + "/" + x ) \
+                      for x in os.listdir( HttpCache.DIRECTORY ) ] ) <= HttpCache.maxBytes
+        assert HttpCache.diskBytes[ HttpCache.DIRECTORY ] <= HttpCache.maxBytes
+    finally:
+        shutil.rmtree( HttpCache.DIRECTORY )
+        HttpCache.DIRECTORY = defaultDirectory
+        HttpCache.ttl = defaultTtl
+        HttpCache.maxBytes = defaultMaxBytes
+        server.stop()
+
+    print "Regression testing for http_cache.py passed."
+
+if __name__ == "__main__" : main()
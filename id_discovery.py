@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+from crawl_engine import CrawlEngine
+
+'''
+Finds which object IDs are tradeable commodities and records their stats in
+price_data/item_stats.
+
+Candidate IDs come from price_data/id_master_list, which has the ID of every
+item in the game, instead of probing every integer in a range. IDs that
+already have stats are skipped. The candidates are probed concurrently by a
+rate-limited CrawlEngine.
+
+Every probed ID is written to a journal as soon as its answer comes back,
+along with whether it was valid, so a job that crashes or is stopped can be
+run again and resumes exactly where it stopped. IDs that could not be probed
+because we were throttled are not written to the journal, so they are tried
+again on the next run.
+'''
+class IDDiscovery( object ):
+
+    '''
+    The file with the ID of every item in the game, one "name;id" per line
+    '''
+    SEED_FILENAME = "price_data/id_master_list"
+
+    '''
+    The file to which the stats of every valid commodity are appended
+    '''
+    STATS_FILENAME = "price_data/item_stats"
+
+    '''
+    The file with the IDs of the commodities whose price data we have
+    '''
+    IDS_FILENAME = "price_data/item_ids"
+
+    '''
+    The file in which every probed ID is recorded, one "id,valid" or
+    "id,invalid" per line
+    '''
+    JOURNAL_FILENAME = "price_data/discovery_journal"
+
+    '''
+    Creates an IDDiscovery job.
+
+    @param engine - the CrawlEngine with which to probe IDs. By default, one
+    that makes one request every 2 seconds.
+    @param fetch - the function that downloads the price data of one
+    commodity, see CrawlEngine.crawl(). By default, the commodity's webpage
+    is downloaded.
+    '''
+    def __init__( self , engine=None , fetch=None ):
+        self.engine = engine if engine is not None else CrawlEngine( rate=0.5 )
+        self.fetch = fetch if fetch is not None else CrawlEngine.fetch_html
+
+    '''
+    Reads the candidate IDs from price_data/id_master_list.
+
+    @return - the IDs, as a list of integers, in the order in which they
+    first appear in the file
+    '''
+    @staticmethod
+    def read_seed_ids():
+        rtn = []
+        seen = set()
+        f = open( IDDiscovery.SEED_FILENAME , "r" )
+        for line in f:
+            objectId = int( line.rsplit( ";" , 1 )[ 1 ] )
+            if ( objectId not in seen ):
+                seen.add( objectId )
+                rtn.append( objectId )
+        f.close()
+        return rtn
+
+    '''
+    @return - the set of IDs that are already known, because they have stats
+    in price_data/item_stats or price data listed in price_data/item_ids
+    '''
+    @staticmethod
+    def read_known_ids():
+        known = set()
+        if ( os.path.exists( IDDiscovery.STATS_FILENAME ) ):
+            f = open( IDDiscovery.STATS_FILENAME , "r" )
+            for line in f:
+                known.add( int( line.split( "," , 1 )[ 0 ] ) )
+            f.close()
+        if ( os.path.exists( IDDiscovery.IDS_FILENAME ) ):
+            f = open( IDDiscovery.IDS_FILENAME , "r" )
+            for line in f:
+                known.add( int( line.rsplit( "," , 1 )[ 1 ] ) )
+            f.close()
+        return known
+
+    '''
+    Reads the journal of a previous run.
+
+    @return - a dictionary that maps every ID that was probed to True if it
+    was a valid commodity and False if it was not
+    '''
+    @staticmethod
+    def read_journal():
+        rtn = {}
+        if ( not os.path.exists( IDDiscovery.JOURNAL_FILENAME ) ):
+            return rtn
+        f = open( IDDiscovery.JOURNAL_FILENAME , "r" )
+        for line in f:
+            data = line.strip().split( "," )
+
+            #a line that was only partially written when the job stopped
+            #does not count as probed
+            if ( len( data ) == 2 and data[ 1 ] in ("valid" , "invalid") ):
+                rtn[ int( data[ 0 ] ) ] = data[ 1 ] == "valid"
+        f.close()
+        return rtn
+
+    '''
+    Finds the maximum price, minimum price, maximum volume and minimum
+    volume of a commodity, which are used to determine what the promising
+    commodities to trade are. For example, we'd like to trade on Mithril Ore
+    because the volume is high and the price fluctuates quite a bit, but we
+    don't want to trade on Steel Longsword because nobody trades it and the
+    price doesn't move that much.
+
+    @param priceData - the CommodityPriceData of the commodity
+    @return - a (maxPrice, minPrice, maxVolume, minVolume) tuple
+    '''
+    @staticmethod
+    def get_commodity_stats( priceData ):
+        
+        #we do not include the last data point because
+        #that is today's data, which may be incomplete
+        #and so the volume may be much less than what it
+        #really is.
+        prices = priceData.prices()[ 1:-1 ]
+        volumes = priceData.volumes()[ 1:-1 ]
+        
+        #prices and volumes of 0 are invalid
+        prices = prices[ prices != 0 ]
+        volumes = volumes[ volumes != 0 ]
+        maxPrice = max( 0 , int( prices.max() ) ) if prices.size > 0 else 0
+        minPrice = min( 999999999 , int( prices.min() ) ) if prices.size > 0 else 999999999
+        maxVolume = max( 0 , int( volumes.max() ) ) if volumes.size > 0 else 0
+        minVolume = min( 999999999 , int( volumes.min() ) ) if volumes.size > 0 else 999999999
+        return (maxPrice , minPrice , maxVolume , minVolume)
+    
+    '''
+    Rebuilds price_data/item_stats from the price data already stored in
+    price_data/master_list, without making any requests. The CSV files are
+    read and their stats computed in parallel by a pool of worker processes.
+    
+    Every commodity that already has stats keeps its place in the file, and
+    commodities that are new to the file are added at the end in order of
+    their IDs. Commodities that have stats but no stored price data keep
+    their old stats. The file is written to a temporary file first and then
+    renamed, so it is never left partially written.
+    
+    @param commodityIds - the IDs of the commodities whose stats to rebuild,
+    as a list of integers. If None, every commodity in the master list is
+    rebuilt.
+    @param processes - the number of worker processes to use. If None, one
+    process per CPU is used. If 1, the stats are computed in this process.
+    @return - the number of commodities whose stats were rebuilt
+    '''
+    @staticmethod
+    def build_stats( commodityIds=None , processes=None ):
+        from price_store import PriceStore
+        if ( commodityIds is None ):
+            commodityIds = PriceStore.get_csv_ids()
+        commodityIds = list( commodityIds )
+        if ( processes is None ):
+            processes = multiprocessing.cpu_count()
+        if ( processes <= 1 or len( commodityIds ) <= 1 ):
+            results = [ _get_commodity_stats( x ) for x in commodityIds ]
+        else:
+            pool = multiprocessing.Pool( processes )
+            try:
+                chunksize = max( 1 , len( commodityIds ) // (4*processes) )
+                results = pool.map( _get_commodity_stats , commodityIds , chunksize )
+            finally:
+                pool.close()
+                pool.join()
+        newStats = dict( [ (x , stats) for x , stats in zip( commodityIds , results ) \
+                            if stats is not None ] )
+        
+        #keep the order of the old file, and the lines of commodities that
+        #were not rebuilt
+        lines = []
+        written = set()
+        if ( os.path.exists( IDDiscovery.STATS_FILENAME ) ):
+            f = open( IDDiscovery.STATS_FILENAME , "r" )
+            for line in f:
+                objectId = int( line.split( "," , 1 )[ 0 ] )
+                if ( objectId in written ):
+                    continue
+                written.add( objectId )
+                if ( objectId in newStats ):
+                    lines.append( IDDiscovery._format_stats( objectId , newStats[ objectId ] ) )
+                else:
+                    lines.append( line if line.endswith( "\n" ) else line + "\n" )
+            f.close()
+        for objectId in sorted( newStats ):
+            if ( objectId not in written ):
+                lines.append( IDDiscovery._format_stats( objectId , newStats[ objectId ] ) )
+        
+        f = open( IDDiscovery.STATS_FILENAME + ".tmp" , "w" )
+        f.write( "".join( lines ) )
+        f.close()
+        os.rename( IDDiscovery.STATS_FILENAME + ".tmp" , IDDiscovery.STATS_FILENAME )
+        return len( newStats )
+    
+    '''
+    @param objectId - the ID of a commodity, as an integer
+    @param stats - the commodity's stats, from get_commodity_stats()
+    @return - the commodity's line in price_data/item_stats
+    '''
+    @staticmethod
+    def _format_stats( objectId , stats ):
+        return str( objectId ) + "," + ",".join( [ str( x ) for x in stats ] ) + "\n"
+
+    '''
+    Probes the candidate IDs that have not been probed or recorded yet. The
+    stats of every valid commodity are appended to price_data/item_stats,
+    and every probed ID is appended to the journal.
+
+    @param objectIds - the IDs to probe, as a list of integers. If None, the
+    IDs in price_data/id_master_list are probed.
+    @param maxRequests - if given, the most requests to make in this run.
+    The IDs left over are probed by the next run.
+    @return - a dictionary of statistics about the run: how many IDs were
+    skipped because they were already known or already in the journal, how
+    many were probed, how many were valid and invalid, and which IDs could
+    not be probed because we were blocked too many times
+    '''
+    def discover( self , objectIds=None , maxRequests=None ):
+        if ( objectIds is None ):
+            objectIds = IDDiscovery.read_seed_ids()
+        known = IDDiscovery.read_known_ids()
+        journal = IDDiscovery.read_journal()
+        candidates = [ x for x in objectIds if x not in known and x not in journal ]
+        stats = { "skipped" : len( objectIds ) - len( candidates ) , "probed" : 0 , \
+                  "valid" : 0 , "invalid" : 0 }
+
+        def record( objectId , priceData ):
+            print "Processing " + str( objectId )
+            if ( priceData is not None ):
+                out = open( IDDiscovery.STATS_FILENAME , "a" )
+                out.write( IDDiscovery._format_stats( objectId , \
+                                IDDiscovery.get_commodity_stats( priceData ) ) )
+                out.close()
+                stats[ "valid" ] += 1
+            else:
+                print str( objectId ) + " was not a valid id"
+                stats[ "invalid" ] += 1
+            stats[ "probed" ] += 1
+
+            #the journal is written last, so an ID is only marked as probed
+            #once everything for it has been saved
+            out = open( IDDiscovery.JOURNAL_FILENAME , "a" )
+            out.write( str( objectId ) + "," + \
+                ( "valid" if priceData is not None else "invalid" ) + "\n" )
+            out.close()
+
+        results , failed = self.engine.crawl( candidates , self.fetch , record , maxRequests )
+        for objectId in failed:
+            print "Could not get " + str( objectId ) + " because we were blocked too many times"
+        stats[ "failed" ] = failed
+        return stats
+
+'''
+Worker function for IDDiscovery.build_stats. Worker processes can only be
+given module-level functions.
+
+@param commodityId - the ID of a commodity, as an integer
+@return - the commodity's stats, or None if it has no stored price data
+'''
+def _get_commodity_stats( commodityId ):
+    from feature_store import FeatureStore
+    from price_data_io import PriceReader
+    
+    #the stored features keep the same stats up to date, so the CSV file
+    #only has to be parsed when they are missing or stale
+    features = FeatureStore.get( commodityId )
+    if ( features is not None ):
+        return (int( features[ "maxPrice" ] ) , int( features[ "minPrice" ] ) , \
+                int( features[ "maxVolume" ] ) , int( features[ "minVolume" ] ))
+    priceData = PriceReader.get_price_data_from_csv( commodityId )
+    if ( priceData is None ):
+        return None
+    return IDDiscovery.get_commodity_stats( priceData )
+
+def main():
+    from price_crawler import PriceCrawler , RequestThrottledError
+    from stub_server import StubGrandExchangeServer
+    import numpy as np
+    import shutil
+    import tempfile
+
+    pages = dict( [ (x , StubGrandExchangeServer.get_html( x )) for x in [ 2 , 6 , 8 , 447 ] ] )
+    fetched = []
+    throttled = set( [ 8 ] )
+    def fetch( objectId ):
+        fetched.append( objectId )
+        if ( objectId in throttled ):
+            raise RequestThrottledError( "Too many requests" )
+        return PriceCrawler.parse_html( objectId , \
+                    pages.get( objectId , StubGrandExchangeServer.ERROR_PAGE ) )
+
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp()
+    try:
+        os.makedirs( tmpDir + "/price_data" )
+        os.chdir( tmpDir )
+        f = open( IDDiscovery.SEED_FILENAME , "w" )
+        f.write( "Cannonball;2\nCannon base;6\nCannon stand;8\nMithril ore;447\n" + \
+                 "Not tradeable;1\nNot tradeable either;3\nCannonball;2\n" )
+        f.close()
+        open( IDDiscovery.STATS_FILENAME , "w" ).write( "6,186340,140000,478,22\n" )
+        assert IDDiscovery.read_seed_ids() == [ 2 , 6 , 8 , 447 , 1 , 3 ]
+
+        #stop the first run after two requests, as if it had crashed
+        engine = CrawlEngine( rate=1000 , threads=1 , maxRetries=1 , backoff=0 , maxBackoff=0 )
+        discovery = IDDiscovery( engine , fetch )
+        stats = discovery.discover( maxRequests=2 )
+        assert fetched == [ 2 , 8 ] and stats[ "skipped" ] == 1
+        assert stats[ "probed" ] == 1 and stats[ "failed" ] == []
+        assert IDDiscovery.read_journal() == { 2 : True }
+
+        #the next run resumes after the last probed ID, and the throttled
+        #ID is tried again
+        del fetched[ : ]
+        stats = discovery.discover()
+        assert fetched == [ 8 , 8 , 447 , 1 , 3 ] and stats[ "skipped" ] == 2
+        assert stats[ "valid" ] == 1 and stats[ "invalid" ] == 2 and stats[ "failed" ] == [ 8 ]
+        assert IDDiscovery.read_journal() == { 2 : True , 447 : True , 1 : False , 3 : False }
+
+        throttled.clear()
+        del fetched[ : ]
+        stats = discovery.discover()
+        assert fetched == [ 8 ] and stats[ "valid" ] == 1
+        del fetched[ : ]
+        assert discovery.discover()[ "probed" ] == 0 and fetched == []
+
+        lines = open( IDDiscovery.STATS_FILENAME ).read().splitlines()
+        assert [ int( x.split( "," )[ 0 ] ) for x in lines ] == [ 6 , 2 , 447 , 8 ]
+        mithrilOre = PriceCrawler.parse_html( 447 , pages[ 447 ] )
+        assert lines[ 2 ] == "447," + ",".join( [ str( x ) for x in \
+                                IDDiscovery.get_commodity_stats( mithrilOre ) ] )
+        
+        #the stats of the commodities in the master list can be rebuilt
+        #without any requests, keeping the order of the file
+        os.makedirs( "price_data/master_list" )
+        for objectId in [ 2 , 447 , 1038 ]:
+            shutil.copy( cwd + "/price_data/master_list/" + str( objectId ) + ".csv" , \
+                         "price_data/master_list" )
+        open( IDDiscovery.STATS_FILENAME , "a" ).write( "2,1,1,1,1\n" )
+        assert IDDiscovery.build_stats( processes=2 ) == 3
+        lines = open( IDDiscovery.STATS_FILENAME ).read().splitlines()
+        assert [ int( x.split( "," )[ 0 ] ) for x in lines ] == [ 6 , 2 , 447 , 8 , 1038 ]
+        assert lines[ 0 ] == "6,186340,140000,478,22"
+        
+        #prices of 0 are left out, and so are the first and last day
+        from price_data_io import PriceReader
+        from price_data import ArrayPriceData
+        mithrilOre = PriceReader.get_price_data_from_csv( 447 )
+        prices = mithrilOre.prices()[ 1:-1 ]
+        volumes = mithrilOre.volumes()[ 1:-1 ]
+        assert lines[ 2 ] == "447," + str( prices.max() ) + "," + str( prices.min() ) + \
+                "," + str( volumes.max() ) + "," + str( volumes[ volumes != 0 ].min() )
+        zeros = ArrayPriceData( 1 , "Test" , np.arange( 5 ) , np.array( [ 0 , 0 , 5 , 3 , 9 ] ) , \
+                                np.zeros( 5 ) , np.array( [ 9 , 0 , 0 , 0 , 1 ] ) )
+        assert IDDiscovery.get_commodity_stats( zeros ) == (5 , 3 , 0 , 999999999)
+        
+        #stored features give the same stats without parsing the CSV files
+        from feature_store import FeatureStore
+        assert FeatureStore.build( [ 2 , 447 , 1038 ] ) == 3
+        for objectId in [ 2 , 447 , 1038 ]:
+            assert FeatureStore.get( objectId ) is not None
+            assert _get_commodity_stats( objectId ) == IDDiscovery.get_commodity_stats( \
+                                    PriceReader.get_price_data_from_csv( objectId ) )
+        assert IDDiscovery.build_stats() == 3
+        assert open( IDDiscovery.STATS_FILENAME ).read().splitlines() == lines
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( tmpDir )
+
+    print "Regression testing for id_discovery.py passed."
+
+if __name__ == "__main__" : main()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import threading
+import time
+
+'''
+Opt-in counters, byte totals and latency histograms for the hot paths of a
+run: downloading and parsing pages, reading and writing price data, and
+scoring items.
+
+Instrumented code calls start() before an operation and stop() after it:
+
+        start = Instrumentation.start()
+        ...
+        Instrumentation.stop( "reader.csv" , start , len( text ) )
+
+While instrumentation is disabled, which is the default, start() returns
+None and stop() returns right away, so the only cost is two function calls.
+Operations that raise an exception between the two calls are not recorded.
+
+Latencies are counted in histograms with one bucket per power of two
+microseconds, which is precise enough to tell a 1 ms read from a 10 ms read
+and keeps the memory used per operation constant no matter how long the run
+is. Only the current process is recorded. Code that runs on worker processes
+sends the workers' records back with collect() and merge(). Forked workers
+start with a copy of their parent's records, so they have to reset() first
+or those records are sent back and counted twice.
+'''
+class Instrumentation( object ):
+
+    '''
+    If False, nothing is recorded
+    '''
+    enabled = False
+
+    '''
+    The number of histogram buckets. Bucket 0 counts operations that took
+    less than 1 microsecond and bucket k counts operations that took at
+    least 2^(k-1) and less than 2^k microseconds. The last bucket also
+    counts everything slower than that.
+    '''
+    NUM_BUCKETS = 32
+
+    lock = threading.Lock()
+    operations = {}
+
+    '''
+    @return - the time at which an operation starts, to be passed to stop(),
+    or None if instrumentation is disabled
+    '''
+    @staticmethod
+    def start():
+        if ( not Instrumentation.enabled ):
+            return None
+        return time.time()
+
+    '''
+    Records an operation that started at the given time and has just ended.
+
+    @param operation - the name of the operation, as a string
+    @param start - the value returned by start() when the operation started
+    @param numBytes - how many bytes the operation read, wrote or downloaded
+    '''
+    @staticmethod
+    def stop( operation , start , numBytes=0 ):
+        if ( start is None ):
+            return
+        Instrumentation.record( operation , time.time() - start , numBytes )
+
+    '''
+    Records one operation, whether or not instrumentation is enabled.
+
+    @param operation - the name of the operation, as a string
+    @param seconds - how long the operation took
+    @param numBytes - how many bytes the operation read, wrote or downloaded
+    '''
+    @staticmethod
+    def record( operation , seconds , numBytes=0 ):
+        bucket = min( max( math.frexp( seconds*1e6 )[ 1 ] , 0 ) , Instrumentation.NUM_BUCKETS-1 )
+        with Instrumentation.lock:
+            entry = Instrumentation.operations.get( operation )
+            if ( entry is None ):
+                entry = Instrumentation._empty_entry()
+                Instrumentation.operations[ operation ] = entry
+            entry[ "count" ] += 1
+            entry[ "seconds" ] += seconds
+            entry[ "bytes" ] += numBytes
+            entry[ "minSeconds" ] = min( entry[ "minSeconds" ] , seconds )
+            entry[ "maxSeconds" ] = max( entry[ "maxSeconds" ] , seconds )
+            entry[ "histogram" ][ bucket ] += 1
+
+    '''
+    @return - the record of an operation that has not happened yet
+    '''
+    @staticmethod
+    def _empty_entry():
+        return { "count" : 0 , "seconds" : 0.0 , "bytes" : 0 , \
+                 "minSeconds" : float( "inf" ) , "maxSeconds" : 0.0 , \
+                 "histogram" : [ 0 ]*Instrumentation.NUM_BUCKETS }
+
+    '''
+    Forgets everything that has been recorded.
+    '''
+    @staticmethod
+    def reset():
+        with Instrumentation.lock:
+            Instrumentation.operations = {}
+
+    '''
+    Takes everything that has been recorded in this process so far, so that
+    a worker process can send it back to the process that started it.
+
+    @return - the records of every operation, to be passed to merge(), or
+    None if instrumentation is disabled
+    '''
+    @staticmethod
+    def collect():
+        if ( not Instrumentation.enabled ):
+            return None
+        with Instrumentation.lock:
+            operations = Instrumentation.operations
+            Instrumentation.operations = {}
+        return operations
+
+    '''
+    Adds records taken with collect(), possibly in another process, to the
+    records of this process.
+
+    @param operations - the value returned by collect()
+    '''
+    @staticmethod
+    def merge( operations ):
+        if ( operations is None ):
+            return
+        with Instrumentation.lock:
+            for operation , other in operations.items():
+                entry = Instrumentation.operations.get( operation )
+                if ( entry is None ):
+                    entry = Instrumentation._empty_entry()
+                    Instrumentation.operations[ operation ] = entry
+                for key in [ "count" , "seconds" , "bytes" ]:
+                    entry[ key ] += other[ key ]
+                entry[ "minSeconds" ] = min( entry[ "minSeconds" ] , other[ "minSeconds" ] )
+                entry[ "maxSeconds" ] = max( entry[ "maxSeconds" ] , other[ "maxSeconds" ] )
+                entry[ "histogram" ] = [ x + y for x , y in \
+                                         zip( entry[ "histogram" ] , other[ "histogram" ] ) ]
+
+    '''
+    Estimates a percentile of the latency of an operation from its
+    histogram. The estimate is the upper end of the bucket that the
+    percentile falls in, but never more than the slowest latency seen.
+
+    @param entry - the record of an operation
+    @param percentile - the percentile, from 0 to 100
+    @return - the estimated latency in seconds
+    '''
+    @staticmethod
+    def _estimate_percentile( entry , percentile ):
+        rank = math.ceil( entry[ "count" ]*percentile/100.0 )
+        seen = 0
+        for bucket , count in enumerate( entry[ "histogram" ] ):
+            seen += count
+            if ( seen >= rank ):
+                return min( 2**bucket/1e6 , entry[ "maxSeconds" ] )
+        return entry[ "maxSeconds" ]
+
+    '''
+    Summarizes everything that has been recorded.
+
+    @return - a dictionary that maps the name of each operation to a
+    dictionary with how many times it happened ("count"), how many seconds
+    it took in total ("seconds"), on average ("meanSeconds"), at least
+    ("minSeconds") and at most ("maxSeconds"), estimates of the median, 90th
+    and 99th percentile latencies ("p50Seconds", "p90Seconds",
+    "p99Seconds"), how many bytes it handled ("bytes") and its latency
+    histogram ("histogram"), a list of [upper bound in seconds, count] pairs
+    for the buckets that are not empty
+    '''
+    @staticmethod
+    def get_report():
+        with Instrumentation.lock:
+            operations = dict( [ (x , dict( y , histogram=list( y[ "histogram" ] ))) \
+                                 for x , y in Instrumentation.operations.items() ] )
+        report = {}
+        for operation , entry in operations.items():
+            report[ operation ] = { \
+                    "count" : entry[ "count" ] , \
+                    "seconds" : entry[ "seconds" ] , \
+                    "meanSeconds" : entry[ "seconds" ]/entry[ "count" ] , \
+                    "minSeconds" : entry[ "minSeconds" ] , \
+                    "maxSeconds" : entry[ "maxSeconds" ] , \
+                    "p50Seconds" : Instrumentation._estimate_percentile( entry , 50 ) , \
+                    "p90Seconds" : Instrumentation._estimate_percentile( entry , 90 ) , \
+                    "p99Seconds" : Instrumentation._estimate_percentile( entry , 99 ) , \
+                    "bytes" : entry[ "bytes" ] , \
+                    "histogram" : [ [ 2**bucket/1e6 , count ] for bucket , count in \
+                                    enumerate( entry[ "histogram" ] ) if count > 0 ] }
+        return report
+
+    '''
+    Writes the report from get_report() to a file as JSON.
+
+    @param filename - the file to which to write the report
+    '''
+    @staticmethod
+    def write_report( filename ):
+        f = open( filename , "w" )
+        json.dump( Instrumentation.get_report() , f , indent=2 , sort_keys=True )
+        f.close()
+
+def main():
+    import os
+    import tempfile
+
+    #nothing is recorded while disabled
+    Instrumentation.reset()
+    assert Instrumentation.start() is None
+    Instrumentation.stop( "test" , Instrumentation.start() , 100 )
+    assert Instrumentation.get_report() == {} and Instrumentation.collect() is None
+
+    Instrumentation.enabled = True
+    try:
+        for seconds in [ 0.0000005 , 0.000003 , 0.000003 , 0.001 , 2.5 ]:
+            Instrumentation.record( "test" , seconds , 10 )
+        start = Instrumentation.start()
+        Instrumentation.stop( "other" , start , 7 )
+
+        report = Instrumentation.get_report()
+        assert sorted( report.keys() ) == [ "other" , "test" ]
+        test = report[ "test" ]
+        assert test[ "count" ] == 5 and test[ "bytes" ] == 50
+        assert test[ "minSeconds" ] == 0.0000005 and test[ "maxSeconds" ] == 2.5
+        assert abs( test[ "meanSeconds" ] - 2.5010065/5 ) < 1e-12
+        assert test[ "histogram" ] == [ [ 1e-6 , 1 ] , [ 4e-6 , 2 ] , [ 1024e-6 , 1 ] , \
+                                        [ 2**22/1e6 , 1 ] ]
+        assert test[ "p50Seconds" ] == 4e-6 and test[ "p90Seconds" ] == 2.5
+        assert report[ "other" ][ "count" ] == 1 and report[ "other" ][ "bytes" ] == 7
+
+        #records collected in a worker process add up with the local ones
+        operations = Instrumentation.collect()
+        assert Instrumentation.get_report() == {}
+        Instrumentation.record( "test" , 0.001 , 1 )
+        Instrumentation.merge( operations )
+        report = Instrumentation.get_report()
+        assert report[ "test" ][ "count" ] == 6 and report[ "test" ][ "bytes" ] == 51
+        assert report[ "test" ][ "histogram" ][ 2 ] == [ 1024e-6 , 2 ]
+
+        f , filename = tempfile.mkstemp()
+        os.close( f )
+        try:
+            Instrumentation.write_report( filename )
+            assert json.load( open( filename ) ) == json.loads( json.dumps( report ) )
+        finally:
+            os.remove( filename )
+    finally:
+        Instrumentation.enabled = False
+        Instrumentation.reset()
+
+    print "Regression testing for instrumentation.py passed."
+
+if __name__ == "__main__" : main()
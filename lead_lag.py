@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import numpy as np
+from market_panel import MarketPanel
+from correlation import CorrelationEngine
+
+'''
+Finds commodities whose price moves come before the price moves of other
+commodities, by correlating the daily log returns of every pair of
+commodities at every lag in a range of days.
+
+The correlation of commodity A with commodity B at lag L is the correlation
+of A's return on each day t with B's return on day t+L, over the days on
+which both returns exist. A positive lag means that A leads B: A's moves
+are followed by B's moves L days later.
+
+Every sum the correlation needs at every lag is a cross-correlation of two
+series, where the series are the returns, their squares and the mask of
+days that have a return (see CorrelationEngine.get_log_returns()). There
+are two ways to compute them for a block of pairs:
+
+* "fft" - the spectra of the series are computed once per commodity, and
+the cross-correlations of a pair at every lag come from one inverse FFT of
+the product of their spectra. The cost does not depend on how many lags
+are scanned.
+* "direct" - the series are shifted by each lag in turn and the sums come
+from matrix products, as in CorrelationEngine.get_block(). The cost grows
+with the number of lags, but BLAS does each lag so quickly that this is
+faster unless many lags are scanned.
+
+On a panel of the master list, an FFT costs about as much as 9*log2(size)
+lags of matrix products, where size is the padded length of the series, so
+that is where the default switches from one to the other.
+'''
+class LeadLagScanner( object ):
+
+    '''
+    Creates a LeadLagScanner for the commodities in a panel.
+
+    @param panel - the MarketPanel with the price data of the commodities.
+    If None, the panel saved in price_data/panel is used, and it is built
+    if it has not been built yet.
+    @param maxLag - the largest lag to scan, in days. Lags from -maxLag to
+    maxLag are scanned.
+    @param minOverlap - the smallest number of shared days over which two
+    commodities are correlated at a lag
+    @param minMoves - see CorrelationEngine()
+    @param method - how the correlations are computed, "fft" or "direct".
+    If None, whichever should be faster for the number of lags is used.
+    '''
+    def __init__( self , panel=None , maxLag=10 , minOverlap=30 , minMoves=10 , method=None ):
+        self.engine = CorrelationEngine( panel , minOverlap , minMoves )
+        self.panel = self.engine.panel
+        self.maxLag = maxLag
+        self.minOverlap = minOverlap
+
+        #padding the series to at least maxLag past their end keeps the
+        #circular cross-correlations from wrapping around at the lags we want
+        numReturns = self.engine.returns.shape[ 1 ]
+        self.size = LeadLagScanner._get_fft_size( numReturns + maxLag )
+        if ( method is None ):
+            method = "fft" if ( 2*maxLag + 1 ) > 9*np.log2( self.size ) else "direct"
+        self.method = method
+
+        if ( method == "fft" ):
+            self.spectra = np.fft.rfft( np.array( [ self.engine.returns , self.engine.valid , \
+                                        self.engine.squares ] ) , self.size , axis=2 )
+
+            #the FFT leaves rounding errors of about 1e-16 of the sums, so a
+            #variance has to be clearly bigger than that for a commodity's
+            #price to count as moving
+            self.thresholds = 1e-9*self.engine.squares.sum( axis=1 ) + 1e-15
+
+    '''
+    @param minimum - a length, as an integer
+    @return - the smallest length that is at least the given length and
+    has no prime factors other than 2, 3 and 5, for which FFTs are fast
+    '''
+    @staticmethod
+    def _get_fft_size( minimum ):
+        size = max( 1 , minimum )
+        while ( True ):
+            remainder = size
+            for factor in ( 2 , 3 , 5 ):
+                while ( remainder % factor == 0 ):
+                    remainder //= factor
+            if ( remainder == 1 ):
+                return size
+            size += 1
+
+    '''
+    @return - the lags that are scanned, from -maxLag to maxLag, as an array
+    '''
+    def get_lags( self ):
+        return np.arange( -self.maxLag , self.maxLag+1 )
+
+    '''
+    Correlates a block of commodities with another block of commodities at
+    every lag.
+
+    @param rows - the rows of the first block in the panel, as a slice
+    @param columns - the rows of the second block in the panel, as a slice
+    @return - an array with a row for each commodity in the first block, a
+    column for each commodity in the second block and the correlation at
+    each lag of get_lags() along its last axis, or NaN at the lags at which
+    the commodities share fewer than minOverlap days or either one's price
+    does not move on the shared days
+    '''
+    def get_block( self , rows , columns ):
+        if ( self.method == "direct" ):
+            return np.dstack( [ self.engine.get_block( rows , columns , lag )[ 0 ] \
+                                for lag in self.get_lags() ] )
+
+        x , vx , xx = [ s[ rows , np.newaxis , : ].conj() for s in self.spectra ]
+        y , vy , yy = [ s[ np.newaxis , columns , : ] for s in self.spectra ]
+
+        #c[L] is the sum over t of f[t]*g[t+L], and the negative lags wrap
+        #around to the end
+        lagIndices = self.get_lags() % self.size
+        overlaps , sumX , sumY , sumXX , sumYY , sumXY = \
+                [ np.fft.irfft( f*g , self.size , axis=2 )[ : , : , lagIndices ] \
+                  for f , g in [ (vx , vy) , (x , vy) , (vx , y) , (xx , vy) , (vx , yy) , (x , y) ] ]
+        overlaps = np.rint( overlaps )
+
+        n = np.maximum( overlaps , 1 )
+        covariance = sumXY - sumX*sumY/n
+        varianceX = sumXX - sumX*sumX/n
+        varianceY = sumYY - sumY*sumY/n
+        defined = ( overlaps >= self.minOverlap ) & \
+                  ( varianceX > self.thresholds[ rows , np.newaxis , np.newaxis ] ) & \
+                  ( varianceY > self.thresholds[ np.newaxis , columns , np.newaxis ] )
+        with np.errstate( divide="ignore" , invalid="ignore" ):
+            correlations = covariance/np.sqrt( varianceX*varianceY )
+        return np.where( defined , np.clip( correlations , -1 , 1 ) , np.nan )
+
+    '''
+    Picks the lag at which each pair of commodities is most strongly
+    correlated, positively or negatively.
+
+    @param correlations - an array of correlations from get_block()
+    @return - a (lags, strengths) tuple of arrays with one value per pair,
+    where lags has the best lag and strengths has the correlation at that
+    lag. Pairs with no correlation at any lag have lag 0 and strength NaN.
+    '''
+    def _get_best( self , correlations ):
+        scores = np.where( np.isnan( correlations ) , -1 , np.abs( correlations ) )
+        best = np.argmax( scores , axis=-1 )
+        strengths = np.take_along_axis( correlations , best[ ... , np.newaxis ] , axis=-1 )[ ... , 0 ]
+        lags = np.where( np.isnan( strengths ) , 0 , self.get_lags()[ best ] )
+        return (lags , strengths)
+
+    '''
+    @param leader - the ID of a commodity in the panel, as an integer
+    @param follower - the ID of another commodity in the panel
+    @return - a (lag, strength) tuple with the lag at which the returns of
+    the two commodities are most strongly correlated and the correlation at
+    that lag. A positive lag means that the leader's moves come first.
+    '''
+    def get_lead_lag( self , leader , follower ):
+        rowA = self.panel.get_row( leader )
+        rowB = self.panel.get_row( follower )
+        lags , strengths = self._get_best( self.get_block( slice( rowA , rowA+1 ) , \
+                                                              slice( rowB , rowB+1 ) ) )
+        return (int( lags[ 0 , 0 ] ) , strengths[ 0 , 0 ])
+
+    '''
+    Finds the best lag of every pair of commodities in the panel. Only the
+    pairs on and above the diagonal are scanned, since swapping the two
+    commodities of a pair only flips the sign of its lags. The rows are
+    split into blocks, which can be scanned in parallel by a pool of worker
+    processes.
+
+    @param blockSize - the number of commodities in each block. If None,
+    16 for the "fft" method, where each pair of blocks takes about
+    8*blockSize^2*size bytes for each sum, where size is the padded length
+    of the series, and 256 for the "direct" method.
+    @param processes - the number of worker processes to use. If None, one
+    process per CPU is used. If 1, everything is scanned in this process.
+    @return - a (lags, strengths) tuple of items-by-items arrays in the
+    order of the panel's rows, where lags[a, b] is the lag at which the
+    returns of a and b are most strongly correlated, positive if a leads b,
+    and strengths[a, b] is the correlation at that lag. Pairs with no
+    correlation at any lag, and every commodity with itself, have lag 0 and
+    strength NaN.
+    '''
+    def scan( self , blockSize=None , processes=None ):
+        numItems = self.panel.get_num_items()
+        if ( blockSize is None ):
+            blockSize = 16 if self.method == "fft" else 256
+        lags = np.zeros( ( numItems , numItems ) , dtype=np.int32 )
+        strengths = np.full( ( numItems , numItems ) , np.nan )
+        tasks = [ (x , min( x + blockSize , numItems ) , blockSize) \
+                    for x in range( 0 , numItems , blockSize ) ]
+
+        if ( processes is None ):
+            processes = multiprocessing.cpu_count()
+        pool = None
+        if ( processes <= 1 or len( tasks ) <= 1 ):
+            results = ( self._scan_rows( *x ) for x in tasks )
+        else:
+            #the rows near the top have the most pairs to scan, so they are
+            #handed out first and the workers finish at about the same time
+            pool = multiprocessing.Pool( processes , _init_scan_worker , ( self , ) )
+            results = pool.imap_unordered( _scan_rows , tasks , 1 )
+
+        try:
+            for blocks in results:
+                for rowStart , columnStart , blockLags , blockStrengths in blocks:
+                    rows = slice( rowStart , rowStart + blockLags.shape[ 0 ] )
+                    columns = slice( columnStart , columnStart + blockLags.shape[ 1 ] )
+                    lags[ rows , columns ] = blockLags
+                    strengths[ rows , columns ] = blockStrengths
+        finally:
+            if ( pool is not None ):
+                pool.close()
+                pool.join()
+
+        #the pairs below the diagonal are the pairs above it, swapped. the
+        #blocks on the diagonal scanned both, but they could break ties
+        #between equally strong lags differently, so only one is kept.
+        upper = np.triu( np.ones( ( numItems , numItems ) , dtype=np.bool_ ) , 1 )
+        lags = np.where( upper , lags , -lags.T )
+        strengths = np.where( upper , strengths , strengths.T )
+        np.fill_diagonal( lags , 0 )
+        np.fill_diagonal( strengths , np.nan )
+        return (lags , strengths)
+
+    '''
+    Scans a block of rows against every block of columns on and after it.
+
+    @param rowStart - the first row of the block
+    @param rowStop - the row after the last row of the block
+    @param blockSize - the number of columns in each block of columns
+    @return - a list of (rowStart, columnStart, lags, strengths) tuples, one
+    for each block of columns, see _get_best()
+    '''
+    def _scan_rows( self , rowStart , rowStop , blockSize ):
+        numItems = self.panel.get_num_items()
+        rtn = []
+        for columnStart in range( rowStart , numItems , blockSize ):
+            columns = slice( columnStart , min( columnStart + blockSize , numItems ) )
+            blockLags , blockStrengths = self._get_best( \
+                                self.get_block( slice( rowStart , rowStop ) , columns ) )
+            rtn.append( (rowStart , columnStart , blockLags , blockStrengths) )
+        return rtn
+
+    '''
+    Lists the pairs of commodities in which one most strongly leads the
+    other, from the results of scan().
+
+    @param lags - the lags from scan()
+    @param strengths - the strengths from scan()
+    @param count - the number of pairs to list
+    @param minLag - the smallest lag a pair must have to be listed, so that
+    pairs that move on the same day are left out
+    @return - a list of (leader, follower, lag, strength) tuples, where
+    leader and follower are commodity IDs and lag is positive, sorted in
+    descending order by the size of the strength
+    '''
+    def get_strongest_leads( self , lags , strengths , count=20 , minLag=1 ):
+        leaders , followers = np.nonzero( ( lags >= minLag ) & ~np.isnan( strengths ) )
+        sizes = np.abs( strengths[ leaders , followers ] )
+        order = np.argsort( -sizes , kind="mergesort" )[ 0:count ]
+        ids = self.panel.ids
+        return [ (int( ids[ leaders[ x ] ] ) , int( ids[ followers[ x ] ] ) , \
+                  int( lags[ leaders[ x ] , followers[ x ] ] ) , \
+                  strengths[ leaders[ x ] , followers[ x ] ]) for x in order ]
+
+'''
+The LeadLagScanner of a worker process, set by _init_scan_worker()
+'''
+_scanner = None
+
+'''
+Initializer for the worker processes of LeadLagScanner.scan(), which gives
+each worker the scanner once instead of with every task.
+
+@param scanner - the LeadLagScanner doing the scan
+'''
+def _init_scan_worker( scanner ):
+    global _scanner
+    _scanner = scanner
+
+'''
+Worker function for LeadLagScanner.scan(). Worker processes can only be
+given module-level functions.
+
+@param task - a (rowStart, rowStop, blockSize) tuple
+@return - see LeadLagScanner._scan_rows()
+'''
+def _scan_rows( task ):
+    return _scanner._scan_rows( *task )
+
+def main():
+    import shutil
+    import tempfile
+    import time
+
+    #a random panel with gaps, a flat stretch and pairs in which one
+    #commodity follows another a few days later
+    random = np.random.RandomState( 0 )
+    numItems = 40
+    numDays = 150
+    steps = random.normal( 0 , 0.02 , ( numItems , numDays ) )
+    for leader , follower , lag in [ (0 , 1 , 3) , (4 , 2 , 1) , (6 , 9 , 5) ]:
+        steps[ follower , lag: ] = 0.8*steps[ leader , 0:-lag ] + \
+                                   random.normal( 0 , 0.01 , numDays - lag )
+    steps[ 3 ] = 0
+    daily = np.round( 1000*np.exp( np.cumsum( steps , axis=1 ) ) ).astype( np.int64 )
+    missing = random.rand( numItems , numDays ) < 0.1
+    missing[ 5 , 25: ] = True
+    daily[ missing ] = 0
+    ids = np.arange( 100 , 100 + numItems , dtype=np.int64 )
+    panel = MarketPanel( ids , np.arange( numDays , dtype=np.int32 ) , daily , daily , \
+                         np.zeros_like( daily ) , missing )
+    returns = np.diff( np.log( np.where( missing , 1 , daily ).astype( np.float64 ) ) , axis=1 )
+    valid = ~missing[ : , 1: ] & ~missing[ : , 0:-1 ]
+    assert LeadLagScanner( panel , maxLag=6 ).method == "direct"
+    assert LeadLagScanner( panel , maxLag=60 ).method == "fft"
+
+    results = []
+    for method in [ "fft" , "direct" ]:
+        scanner = LeadLagScanner( panel , maxLag=6 , minOverlap=30 , method=method )
+
+        #every lag of every pair matches correlating the shifted shared
+        #days directly
+        correlations = scanner.get_block( slice( 0 , numItems ) , slice( 0 , numItems ) )
+        for a in range( 0 , numItems ):
+            for b in range( 0 , numItems ):
+                for i , lag in enumerate( scanner.get_lags() ):
+                    start = max( 0 , -lag )
+                    stop = min( numDays-1 , numDays-1 - lag )
+                    shared = valid[ a , start:stop ] & valid[ b , start+lag:stop+lag ]
+                    x = returns[ a , start:stop ][ shared ]
+                    y = returns[ b , start+lag:stop+lag ][ shared ]
+                    if ( shared.sum() >= 30 and np.std( x ) > 1e-9 and np.std( y ) > 1e-9 ):
+                        assert abs( correlations[ a , b , i ] - np.corrcoef( x , y )[ 0 , 1 ] ) < 1e-8
+                    else:
+                        assert np.isnan( correlations[ a , b , i ] )
+
+        #the planted pairs are found at the right lags, in both directions
+        lag , strength = scanner.get_lead_lag( 100 , 101 )
+        assert lag == 3 and strength > 0.8 and scanner.get_lead_lag( 101 , 100 )[ 0 ] == -3
+        lags , strengths = scanner.scan( blockSize=7 , processes=1 )
+        assert lags[ 4 , 2 ] == 1 and lags[ 2 , 4 ] == -1 and lags[ 6 , 9 ] == 5
+        assert np.all( np.isnan( strengths[ 3 ] ) ) and np.all( np.isnan( strengths[ : , 5 ] ) )
+        assert sorted( [ x[ 0:3 ] for x in scanner.get_strongest_leads( lags , strengths , 3 ) ] ) == \
+                [ (100 , 101 , 3) , (104 , 102 , 1) , (106 , 109 , 5) ]
+        for a in range( 0 , numItems ):
+            for b in range( a+1 , numItems ):
+                if ( np.all( np.isnan( correlations[ a , b ] ) ) ):
+                    assert np.isnan( strengths[ a , b ] ) and lags[ a , b ] == 0
+                else:
+                    best = np.nanargmax( np.abs( correlations[ a , b ] ) )
+                    assert lags[ a , b ] == scanner.get_lags()[ best ]
+                    assert abs( strengths[ a , b ] - correlations[ a , b , best ] ) < 1e-12
+
+        #the scan is the same in parallel and with other block sizes
+        parallelLags , parallelStrengths = scanner.scan( blockSize=5 , processes=2 )
+        assert np.array_equal( lags , parallelLags )
+        assert np.allclose( strengths , parallelStrengths , equal_nan=True , rtol=0 , atol=1e-12 )
+        results.append( (lags , strengths) )
+
+    #and the same either way it is computed
+    assert np.array_equal( results[ 0 ][ 0 ] , results[ 1 ][ 0 ] )
+    assert np.allclose( results[ 0 ][ 1 ] , results[ 1 ][ 1 ] , equal_nan=True , rtol=0 , atol=1e-8 )
+
+    #the whole master list
+    defaultDirectory = MarketPanel.DIRECTORY
+    MarketPanel.DIRECTORY = tempfile.mkdtemp()
+    try:
+        scanner = LeadLagScanner( MarketPanel.build() , maxLag=10 )
+        start = time.time()
+        lags , strengths = scanner.scan()
+        print "Scanned lags -10 to 10 of " + str( scanner.panel.get_num_items() ) + \
+                " items in " + str( round( time.time() - start , 3 ) ) + " seconds"
+        assert np.array_equal( lags , -lags.T )
+        for leader , follower , lag , strength in scanner.get_strongest_leads( lags , strengths , 5 ):
+            print str( leader ) + " leads " + str( follower ) + " by " + str( lag ) + \
+                    " days with correlation " + str( round( strength , 3 ) )
+    finally:
+        shutil.rmtree( MarketPanel.DIRECTORY )
+        MarketPanel.DIRECTORY = defaultDirectory
+
+    print "Regression testing for lead_lag.py passed."
+
+if __name__ == "__main__" : main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+from date_utils import DateUtils
+from price_data_io import PriceReader
+
+'''
+Stores the price data of every known commodity in dense 2-D arrays so that
+questions about the whole market can be answered with vectorized NumPy
+expressions instead of loading commodities one at a time.
+
+Each array has one row per commodity and one column per calendar day:
+
+* daily - the daily prices
+* average - the average 180-day prices
+* volume - the trade volumes
+* missing - True wherever a commodity has no datapoint for a day. The
+daily, average and volume values are 0 wherever data is missing.
+
+The panel is saved as .npy files in price_data/panel and is memory-mapped
+when loaded, so every array is a read-only view into its file.
+'''
+class MarketPanel( object ):
+
+    '''
+    The folder in which the panel files are stored
+    '''
+    DIRECTORY = "price_data/panel"
+
+    '''
+    The names of the arrays that make up a panel. Each is stored as
+    <name>.npy in the panel folder.
+    '''
+    FIELDS = ( "ids" , "dates" , "daily" , "average" , "volume" , "missing" )
+
+    '''
+    Creates a MarketPanel from arrays that have already been built.
+
+    @param ids - the commodity ID of each row, as an array of integers
+    @param dates - the day ordinal of each column, as an array of integers
+    @param daily - the daily prices, as an items-by-days array
+    @param average - the average 180-day prices, as an items-by-days array
+    @param volume - the trade volumes, as an items-by-days array
+    @param missing - the missing-value mask, as an items-by-days array
+    '''
+    def __init__( self , ids , dates , daily , average , volume , missing ):
+        self.ids = ids
+        self.dates = dates
+        self.daily = daily
+        self.average = average
+        self.volume = volume
+        self.missing = missing
+        self._idToRow = {}
+        for row , commodityId in enumerate( ids.tolist() ):
+            self._idToRow[ commodityId ] = row
+
+    '''
+    @return - the number of commodities in this panel
+    '''
+    def get_num_items( self ):
+        return len( self.ids )
+
+    '''
+    @return - the number of days in this panel
+    '''
+    def get_num_days( self ):
+        return len( self.dates )
+
+    '''
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the row of the given commodity in this panel, or None if the
+    commodity is not in this panel
+    '''
+    def get_row( self , commodityId ):
+        return self._idToRow.get( commodityId )
+
+    '''
+    @param year - a year, as an integer
+    @param month - a month, as an integer
+    @param day - a day, as an integer
+    @return - the column of the given date in this panel, or None if the
+    date is not covered by this panel
+    '''
+    def get_column( self , year , month , day ):
+        column = DateUtils.to_ordinal( year , month , day ) - int( self.dates[ 0 ] )
+        if ( column < 0 or column >= len( self.dates ) ):
+            return None
+        return column
+
+    '''
+    Builds the panel files from the price data of the given commodities and
+    saves them to price_data/panel. The arrays are filled in one commodity
+    at a time directly in their files, so the whole panel never has to fit
+    in memory.
+
+    @param commodityIds - the IDs of the commodities to include, as a list
+    of integers. If None, every commodity in price_data/item_ids is included.
+    @return - the MarketPanel that was built, memory-mapped from its files
+    '''
+    @staticmethod
+    def build( commodityIds=None ):
+        if ( commodityIds is None ):
+            commodityIds = PriceReader.read_item_ids()
+
+        #the first pass finds the range of dates the panel has to cover.
+        #commodities without any price data are left out of the panel.
+        ids = []
+        firstDate = None
+        lastDate = None
+        for commodityId in commodityIds:
+            columns = PriceReader.get_price_columns( commodityId )
+            if ( columns is None or len( columns[ 1 ] ) == 0 ):
+                continue
+            dates = columns[ 1 ]
+            ids.append( commodityId )
+            firstDate = int( dates[ 0 ] ) if firstDate is None else min( firstDate , int( dates[ 0 ] ) )
+            lastDate = int( dates[ -1 ] ) if lastDate is None else max( lastDate , int( dates[ -1 ] ) )
+
+        if ( len( ids ) == 0 ):
+            firstDate = lastDate = 0
+            numDays = 0
+        else:
+            numDays = lastDate - firstDate + 1
+        shape = ( len( ids ) , numDays )
+
+        if ( not os.path.exists( MarketPanel.DIRECTORY ) ):
+            os.makedirs( MarketPanel.DIRECTORY )
+        np.save( MarketPanel._get_filename( "ids" ) , np.array( ids , dtype=np.int64 ) )
+        np.save( MarketPanel._get_filename( "dates" ) , \
+                 np.arange( firstDate , firstDate + numDays , dtype=np.int32 ) )
+        openMemmap = np.lib.format.open_memmap
+        daily = openMemmap( MarketPanel._get_filename( "daily" ) , mode="w+" , \
+                            dtype=np.int64 , shape=shape )
+        average = openMemmap( MarketPanel._get_filename( "average" ) , mode="w+" , \
+                              dtype=np.int64 , shape=shape )
+        volume = openMemmap( MarketPanel._get_filename( "volume" ) , mode="w+" , \
+                             dtype=np.int64 , shape=shape )
+        missing = openMemmap( MarketPanel._get_filename( "missing" ) , mode="w+" , \
+                              dtype=np.bool_ , shape=shape )
+
+        #the second pass scatters each commodity's series into its row
+        missing[ : ] = True
+        for row , commodityId in enumerate( ids ):
+            name , dates , dailyPrices , averagePrices , volumes = \
+                                PriceReader.get_price_columns( commodityId )
+            columns = np.asarray( dates , dtype=np.int64 ) - firstDate
+            daily[ row , columns ] = dailyPrices
+            average[ row , columns ] = averagePrices
+            volume[ row , columns ] = volumes
+            missing[ row , columns ] = False
+
+        for array in ( daily , average , volume , missing ):
+            array.flush()
+        del daily , average , volume , missing
+        return MarketPanel.load()
+
+    '''
+    Loads the panel saved in price_data/panel. Every array is memory-mapped
+    read-only, so loading is cheap and no data is copied.
+
+    @return - the saved MarketPanel, or None if no panel has been built
+    '''
+    @staticmethod
+    def load():
+        arrays = []
+        for field in MarketPanel.FIELDS:
+            filename = MarketPanel._get_filename( field )
+            if ( not os.path.exists( filename ) ):
+                return None
+            arrays.append( np.load( filename , mmap_mode="r" ) )
+        return MarketPanel( *arrays )
+
+    '''
+    @param field - one of MarketPanel.FIELDS
+    @return - the name of the file in which the given array is stored
+    '''
+    @staticmethod
+    def _get_filename( field ):
+        return MarketPanel.DIRECTORY + "/" + field + ".npy"
+
+def main():
+    import shutil
+    import tempfile
+
+    defaultDirectory = MarketPanel.DIRECTORY
+    MarketPanel.DIRECTORY = tempfile.mkdtemp()
+    try:
+        assert MarketPanel.load() is None
+        panel = MarketPanel.build( [ 2 , 447 , 1038 , -1 ] )
+        assert panel.get_num_items() == 3
+        assert panel.get_row( -1 ) is None
+
+        #every value in the panel must match the commodity's own series
+        for commodityId in [ 2 , 447 , 1038 ]:
+            row = panel.get_row( commodityId )
+            name , dates , daily , average , volume = PriceReader.get_price_columns( commodityId )
+            columns = dates - panel.dates[ 0 ]
+            assert np.all( panel.daily[ row , columns ] == daily )
+            assert np.all( panel.average[ row , columns ] == average )
+            assert np.all( panel.volume[ row , columns ] == volume )
+            assert np.sum( ~panel.missing[ row ] ) == len( dates )
+
+        column = panel.get_column( 2016 , 1 , 8 )
+        assert panel.daily[ panel.get_row( 447 ) , column ] == 252
+
+        #a whole-market question is one expression over the panel
+        marketVolume = np.where( panel.missing , 0 , panel.volume ).sum( axis=0 )
+        assert marketVolume[ column ] == 6100759 + 422970 + 1057
+    finally:
+        shutil.rmtree( MarketPanel.DIRECTORY )
+        MarketPanel.DIRECTORY = defaultDirectory
+
+    print "Regression testing for market_panel.py passed."
+
+if __name__ == "__main__" : main()
@@ -4,17 +4,54 @@ Created on Wed Aug 19 21:39:45 2015
 
 @author: mjchao
 """
-import requests
 import datetime
+import json
 import re
+import time
+import numpy as np
 from time import sleep
-from price_data import DataPoint , CommodityPriceData
+from date_utils import DateUtils
+from price_data import DataPoint , CommodityPriceData , ArrayPriceData
+from http_cache import HttpCache
+from instrumentation import Instrumentation
        
+'''
+Raised when the Grand Exchange has temporarily blocked our IP address
+because we made too many requests recently.
+'''
+class RequestThrottledError( Exception ):
+    pass
+    
 '''
 Provides functions for obtaining Grand Exchange data.
 '''
 class PriceCrawler( object ):
     
+    '''
+    The address of the Grand Exchange database. This can be changed to
+    point the crawler at a different server, such as a local stub server.
+    '''
+    BASE_URL = "http://services.runescape.com/m=itemdb_oldschool"
+    
+    '''
+    How many seconds to wait before trying again when our IP address has
+    been blocked, and how many times to try again before giving up
+    '''
+    BLOCKED_WAIT = 15
+    BLOCKED_RETRIES = 5
+    
+    '''
+    Matches, in a single pass over an item's webpage, the name of the item in
+    the title of the page, the date, daily price and average price pushed to
+    the price graph on each line like
+            average180.push([new Date('2015/08/21'), 348, 308]);
+    and the date and volume pushed to the volume graph on each line like
+            trade180.push([new Date('2015/08/21'), 4210]);
+    '''
+    HTML_PATTERN = re.compile( r"<title>(.*)(?= - Grand Exchange)" + \
+        r"|average180\.push[^\d\n]*(\d+)[^\d\n]+(\d+)[^\d\n]+(\d+)[^\d\n]+(\d+)[^\d\n]+(\d+)" + \
+        r"|trade180\.push[^\d\n]*(\d+)[^\d\n]+(\d+)[^\d\n]+(\d+)[^\d\n]+(\d+)" )
+    
     '''
     Gets price data for a given commodity from json provided by the
     Grand Exchange API. The trade volume is not reported, however, as the
@@ -29,110 +66,283 @@ class PriceCrawler( object ):
     '''
     @staticmethod
     def get_price_data_from_json( name , objectId ):
-        page = requests.get( "http://services.runescape.com/m=itemdb_oldschool/api/graph/" + str(objectId) + ".json" )        
-        json = page.text
+        start = Instrumentation.start()
+        text = HttpCache.get( PriceCrawler.BASE_URL + "/api/graph/" + str(objectId) + ".json" , \
+                              lambda body : "404 - Page not found" not in body )
+        Instrumentation.stop( "crawler.fetch_json" , start , len( text ) )
         
         #bad object ID
-        if ( "404 - Page not found" in json ):
+        if ( "404 - Page not found" in text ):
             return None
-         
-        #split the data given to us into the two halves: the first half
-        #is our daily price data. the second half is our average price data
-        dailyPriceJson = json[0:json.find( "average" )]
-        averagePriceJson = json[json.find( "average"):len(json)]
+        return PriceCrawler.parse_json( name , objectId , text )
         
-        datapoints = []
+    '''
+    Gets price data for a given commodity from the json of its Grand
+    Exchange graph. The json looks like
+            {"daily":{"<timestamp>":<price>,...},"average":{"<timestamp>":<price>,...}}
+    where the timestamps are in milliseconds.
+    
+    The json is decoded with a json decoder and all the timestamps are
+    converted to day ordinals in one vectorized step, so no DataPoint
+    objects are created.
+    
+    @param name - the name of the commodity, as a string.
+    @param objectId - the Grand Exchange object ID for the commodity, as an integer.
+    @param text - the json, as a string
+    @return - an ArrayPriceData object that stores all the time series data
+    for the daily and average prices of the commodity. The volumes are all 0.
+    '''
+    @staticmethod
+    def parse_json( name , objectId , text ):
+        start = Instrumentation.start()
+        graph = json.loads( text )
+        dailyPrices = graph[ "daily" ]
+        averagePrices = graph[ "average" ]
+        keys = sorted( dailyPrices.keys() , key=int )
+        timestamps = np.array( keys , dtype=np.int64 )
+        daily = np.array( [ dailyPrices[ x ] for x in keys ] , dtype=np.int64 )
+        average = np.array( [ averagePrices[ x ] for x in keys ] , dtype=np.int64 )
         
-        #data comes in the form {timestamp:value, timestamp:value, ...}
-        #where all timestamps and prices are integer values,
-        #so we can just parse out all the integer values and process them
-        #in pairs of 2.
+        #have to add an extra 12 hours because Jagex is several hours ahead.
+        #we just add 12 hours to be safe. We are only interested in dates
+        #and the actual hour of day does not matter to us.
+        dates = (timestamps//1000 + 43200)//86400 + DateUtils.EPOCH_ORDINAL
         
-        #note that the average price data and daily price data must have
-        #the same length, so we can iterate through both lists simultaneously
-        priceData = re.findall( r'\d+' , dailyPriceJson )   
-        averageData = re.findall( r'\d+' , averagePriceJson )
-        for i in range( 0 , len( priceData ) , 2 ):
-            
-            timestamp = priceData[ i ]
-            
-            #have to add an extra 12 hours because Jagex is several hours ahead.
-            #we just add 12 hours to be safe. We are only interested in dates
-            #and the actual hour of day does not matter to us.
-            dateValues = re.findall( r'\d+' , str(datetime.datetime.fromtimestamp( int(timestamp)/1000 + 43200 )) )
-            year = str( dateValues[ 0 ] )
-            month = str( dateValues[ 1 ] )
-            day = str( dateValues[ 2 ] )
-            price = int( priceData[ i+1 ] )
-            average = int( averageData[ i+1 ] )
-            datapoints.append( DataPoint( year , month , day , price , average ) )
-
-        return CommodityPriceData( objectId , name , datapoints )         
+        rtn = ArrayPriceData( objectId , name , dates , daily , average , \
+                              np.zeros( len( keys ) , dtype=np.int64 ) )
+        Instrumentation.stop( "crawler.parse_json" , start , len( text ) )
+        return rtn
 
     '''
     Gets price data for a given commodity from the HTML of the Grand Exchange
     website. The name of the commodity is also automatically determined from
     the HTML.
     
+    If our IP address has been blocked for making too many requests, we
+    wait BLOCKED_WAIT seconds and try again, up to BLOCKED_RETRIES times.
+    
     @param objectId - the Grand Exchange object ID of a commodity, as an integer.
     @return - a CommodityPriceData object that stores time series data
     for the daily and average price of a commodity.
     None is returned if the given object ID was invalid.
+    @throws RequestThrottledError - if our IP address is still blocked after
+    all the retries
     '''
     @staticmethod
     def get_price_data_from_html( objectId ):
-        page = requests.get( "http://services.runescape.com/m=itemdb_oldschool/viewitem?obj=" + str( objectId ) )
-        html = page.text
+        for attempt in range( 0 , PriceCrawler.BLOCKED_RETRIES+1 ):
+            try:
+                return PriceCrawler.parse_html( objectId , PriceCrawler.fetch_html( objectId ) )
+            except RequestThrottledError:
+                if ( attempt == PriceCrawler.BLOCKED_RETRIES ):
+                    raise
+                print "Computer IP has been blocked. Trying again in " + \
+                    str( PriceCrawler.BLOCKED_WAIT ) + " seconds..."
+                sleep( PriceCrawler.BLOCKED_WAIT )
+                
+    '''
+    Downloads the Grand Exchange webpage of a commodity. Pages are cached by
+    HttpCache, except for error pages.
+    
+    @param objectId - the Grand Exchange object ID of a commodity, as an integer.
+    @return - the HTML of the webpage, as a string
+    '''
+    @staticmethod
+    def fetch_html( objectId ):
+        start = Instrumentation.start()
+        html = HttpCache.get( PriceCrawler.BASE_URL + "/viewitem?obj=" + str( objectId ) , \
+                              lambda body : "Sorry, there was a problem with your request." not in body )
+        Instrumentation.stop( "crawler.fetch_html" , start , len( html ) )
+        return html
+        
+    '''
+    Determines if a Grand Exchange webpage is the page that says our IP
+    address has been blocked for making too many requests.
+    
+    @param html - the HTML of a Grand Exchange webpage
+    @return - True if the page says that we have been blocked
+    '''
+    @staticmethod
+    def is_throttled( html ):
+        return "Sorry, there was a problem with your request." in html and \
+            "You've made too many requests recently." in html and \
+            "As a result, your IP address has been temporarily blocked. Please try again later." in html
+        
+    '''
+    Gets price data for a given commodity from the HTML of its Grand
+    Exchange webpage.
+    
+    @param objectId - the Grand Exchange object ID of a commodity, as an integer.
+    @param html - the HTML of the commodity's webpage, as a string
+    @return - an ArrayPriceData object that stores time series data
+    for the daily and average price of a commodity.
+    None is returned if the given object ID was invalid.
+    @throws RequestThrottledError - if the page says that our IP address
+    has been blocked
+    '''
+    @staticmethod
+    def parse_html( objectId , html ):
+        start = Instrumentation.start()
         
         #invalid object ID
         if ( "Sorry, there was a problem with your request." in html ):
-            if ( "You've made too many requests recently." in html and \
-                    "As a result, your IP address has been temporarily blocked. Please try again later." in html ):
-                print "Computer IP has been blocked. Trying again in 15 seconds..."
-                sleep( 15 )
-                return PriceCrawler.get_price_data_from_html( objectId )
+            if ( PriceCrawler.is_throttled( html ) ):
+                raise RequestThrottledError( "Too many requests while getting " + str( objectId ) )
+            Instrumentation.stop( "crawler.parse_html" , start , len( html ) )
             return None
         
-        #we can find the name in the title of the webpage.
-        name = str( re.search( r'(?<=<title>)(.*)(?= - Grand Exchange)' , html ).group( 0 ) )
+        #we can find the name in the title of the webpage, and the price
+        #data is always pushed to the graphs on the webpage with the
+        #commands "average180.push( ... )" and "trade180.push( ... )".
+        #all three are pulled out together in a single scan of the page.
+        #each match fills in the groups of only one of the three patterns.
+        name = None
+        priceData = []
+        volumeData = []
+        for match in PriceCrawler.HTML_PATTERN.findall( html ):
+            if ( match[ 1 ] ):
+                priceData.append( match[ 1:6 ] )
+            elif ( match[ 6 ] ):
+                volumeData.append( match[ 9 ] )
+            elif ( name is None ):
+                name = str( match[ 0 ] )
         
-        #and the price data is always pushed to the graphs on the webpage
-        #with the command "average180.push( ... )" so we are just interested
-        #in lines with that command
-        priceData = re.findall( r'average180.push.*' , html )
-        volumeData = re.findall( r'trade180.push.*' , html )
+        #every price is matched with the volume on the same day
+        numDatapoints = min( len( priceData ) , len( volumeData ) )
+        prices = np.array( priceData[ 0:numDatapoints ] , dtype=np.int64 ).reshape( -1 , 5 )
+        volumes = np.array( volumeData[ 0:numDatapoints ] , dtype=np.int64 )
+        dates = DateUtils.to_ordinal_array( prices[ : , 0 ] , prices[ : , 1 ] , prices[ : , 2 ] )
         
-        datapoints = []
+        rtn = ArrayPriceData( objectId , name , dates , prices[ : , 3 ].copy() , \
+                              prices[ : , 4 ].copy() , volumes )
+        Instrumentation.stop( "crawler.parse_html" , start , len( html ) )
+        return rtn
         
-        for price , volume in zip( priceData , volumeData ):
-            priceNumbers = re.findall( r'\d+' , price )
-            
-            #we'll keep years, months, and days in string form because
-            #we want there to always be 4 digits in a year, 2 digits in 
-            #a month and 2 digits in a day. If we converted them to integers,
-            #we would lose a digit sometimes - e.g. 01 would be converted to 1
-            #and we'd lose consistency.
-            year = str( priceNumbers[ 1 ] )
-            month = str( priceNumbers[ 2 ] )
-            day = str( priceNumbers[ 3 ] )
-            
-            #prices, on the other hand, can be converted to integers because
-            #all commodities will always cost an integer number of coins.
-            price = int( priceNumbers[ 4 ] )
-            average = int( priceNumbers[ 5 ] )
-            
-            volumeNumbers = re.findall( r'\d+' , volume )
-            
-            #volume can also be converted to integers
-            #because all commodities will have an integer volume each day
-            volume = int( volumeNumbers[ 4 ] )
-            
-            datapoints.append( DataPoint( year , month , day , price , average , volume ) )
-
-        return CommodityPriceData( objectId , name , datapoints )    
         
+'''
+Parses graph json the way PriceCrawler.get_price_data_from_json used to:
+with regular expressions, and with a datetime and a string for every
+datapoint. This is only kept so benchmark_json_parsing() can compare
+against it.
+'''
+def _parse_json_with_regex( name , objectId , text ):
+    dailyPriceJson = text[0:text.find( "average" )]
+    averagePriceJson = text[text.find( "average"):len(text)]
+    datapoints = []
+    priceData = re.findall( r'\d+' , dailyPriceJson )   
+    averageData = re.findall( r'\d+' , averagePriceJson )
+    for i in range( 0 , len( priceData ) , 2 ):
+        timestamp = priceData[ i ]
+        dateValues = re.findall( r'\d+' , str(datetime.datetime.fromtimestamp( int(timestamp)/1000 + 43200 )) )
+        year = str( dateValues[ 0 ] )
+        month = str( dateValues[ 1 ] )
+        day = str( dateValues[ 2 ] )
+        price = int( priceData[ i+1 ] )
+        average = int( averageData[ i+1 ] )
+        datapoints.append( DataPoint( year , month , day , price , average ) )
+    return CommodityPriceData( objectId , name , datapoints )
+
+'''
+Parses an item's webpage the way PriceCrawler.parse_html used to: with a
+separate regular expression scan for the title, the price lines and the
+volume lines, and another one for every line. This is only kept so
+benchmark_html_parsing() can compare against it.
+'''
+def _parse_html_with_regexes( objectId , html ):
+    if ( "Sorry, there was a problem with your request." in html ):
+        return None
+    name = str( re.search( r'(?<=<title>)(.*)(?= - Grand Exchange)' , html ).group( 0 ) )
+    priceData = re.findall( r'average180.push.*' , html )
+    volumeData = re.findall( r'trade180.push.*' , html )
+    datapoints = []
+    for price , volume in zip( priceData , volumeData ):
+        priceNumbers = re.findall( r'\d+' , price )
+        year = str( priceNumbers[ 1 ] )
+        month = str( priceNumbers[ 2 ] )
+        day = str( priceNumbers[ 3 ] )
+        price = int( priceNumbers[ 4 ] )
+        average = int( priceNumbers[ 5 ] )
+        volumeNumbers = re.findall( r'\d+' , volume )
+        volume = int( volumeNumbers[ 4 ] )
+        datapoints.append( DataPoint( year , month , day , price , average , volume ) )
+    return CommodityPriceData( objectId , name , datapoints )
+    
+'''
+Times how long it takes to parse item webpages with the old multi-scan
+parser and with PriceCrawler.parse_html().
+
+@param pages - a list of (objectId, html) tuples to parse
+@param repeat - how many times to parse every page
+@return - a dictionary with the average number of seconds it took to parse
+one page, for the "regex" parser and the "single pass" parser
+'''
+def benchmark_html_parsing( pages , repeat=1 ):
+    rtn = {}
+    for parserName , parser in (("regex" , _parse_html_with_regexes) , \
+                                ("single pass" , PriceCrawler.parse_html)):
+        start = time.time()
+        for i in range( 0 , repeat ):
+            for objectId , html in pages:
+                parser( objectId , html )
+        rtn[ parserName ] = (time.time() - start)/(repeat*max( 1 , len( pages ) ))
+    return rtn
+
+'''
+Times how long it takes to parse graph json with the old regular expression
+parser and with PriceCrawler.parse_json().
+
+@param payloads - a list of (name, objectId, json) tuples to parse
+@param repeat - how many times to parse every payload
+@return - a dictionary with the average number of seconds it took to parse
+one payload, for the "regex" parser and the "json" parser
+'''
+def benchmark_json_parsing( payloads , repeat=3 ):
+    rtn = {}
+    for parserName , parser in (("regex" , _parse_json_with_regex) , \
+                                ("json" , PriceCrawler.parse_json)):
+        start = time.time()
+        for i in range( 0 , repeat ):
+            for name , objectId , text in payloads:
+                parser( name , objectId , text )
+        rtn[ parserName ] = (time.time() - start)/(repeat*max( 1 , len( payloads ) ))
+    return rtn
         
 def main():
+    from stub_server import StubGrandExchangeServer
+    from price_data_io import PriceReader
+    from price_store import PriceStore
+    
+    #the json parser gives the same data as the regex parser did
+    payloads = []
+    for objectId in [ 2 , 447 , 1038 ]:
+        text = StubGrandExchangeServer.get_json( objectId )
+        payloads.append( ("Item" , objectId , text) )
+        assert PriceCrawler.parse_json( "Item" , objectId , text ) == \
+                _parse_json_with_regex( "Item" , objectId , text )
+    times = benchmark_json_parsing( payloads )
+    print "Seconds to parse graph json per item: " + str( times )
+    
+    #the single pass html parser gives the same data as the old one on the
+    #saved webpages, and the saved webpages have the stored price data
+    for objectId in [ 2 , 447 , 1038 ]:
+        html = open( "price_data/html_fixtures/" + str( objectId ) + ".html" ).read()
+        parsed = PriceCrawler.parse_html( objectId , html )
+        assert parsed == _parse_html_with_regexes( objectId , html )
+        stored = PriceReader.get_price_data_from_csv( objectId )
+        assert parsed.get_name() == stored.get_name()
+        assert parsed.get_all_datapoints() == stored.get_all_datapoints()[ -180: ]
+    assert PriceCrawler.parse_html( 1 , open( "price_data/html_fixtures/error.html" ).read() ) is None
+    try:
+        PriceCrawler.parse_html( 447 , open( "price_data/html_fixtures/throttled.html" ).read() )
+        assert False
+    except RequestThrottledError:
+        pass
+    
+    #benchmark on the webpages of every item in the master list
+    pages = [ (x , StubGrandExchangeServer.get_html( x )) for x in PriceStore.get_csv_ids() ]
+    times = benchmark_html_parsing( pages )
+    print "Seconds to parse an item webpage, over " + str( len( pages ) ) + " pages: " + str( times )
+    
     test = PriceCrawler.get_price_data_from_json( "Mithril ore" , 447 ) 
     test2 = PriceCrawler.get_price_data_from_html( 447 )
     
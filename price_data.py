@@ -4,20 +4,25 @@ from date_utils import DateUtils
 from datetime import datetime
 import matplotlib.pyplot as plt
 import numpy as np
+import sys
 
 '''
 Represents one data point of time series data. A DataPoint keeps track of
 the following data:
 
-* year - the year values of the time series data, stored as a string of length 4
-* month - the month values of the time series data, stored as a string of length 2
-* day - the day values of the time series data, stored as a string of length 2
+* date - the date of the time series data, stored as an integer day ordinal
+(see DateUtils.to_ordinal). The year, month and day are derived from it.
 * daily - the daily integer prices of the time series data
 * average - the average integer prices of the time series data
 * traded - the quantity traded on a givne day, stored as an integer
+
+DataPoints use __slots__ instead of a per-instance __dict__ because the
+whole market has close to a million of them.
 '''
 class DataPoint( object ):
     
+    __slots__ = ( "_date" , "_daily" , "_average" , "_traded" )
+    
     '''
     Creates a DataPoint from some CSV data that contains the
     day, daily price, average price, and trade volume of a data point.
@@ -45,31 +50,61 @@ class DataPoint( object ):
     @staticmethod
     def from_csv_data( data ):
         values = data.split( "," )
-        year = str( values[ 0 ] )
-        month = str( values[ 1 ] )
-        day = str( values[ 2 ] )
-        daily = int( values[ 3 ] )
-        average = int( values[ 4 ] )
-        traded = int( values[ 5 ] )
-        return DataPoint( year , month , day , daily , average , traded )
+        rtn = DataPoint.__new__( DataPoint )
+        rtn._date = DateUtils.to_ordinal( values[ 0 ] , values[ 1 ] , values[ 2 ] )
+        rtn._daily = int( values[ 3 ] )
+        rtn._average = int( values[ 4 ] )
+        rtn._traded = int( values[ 5 ] )
+        return rtn
+        
+    '''
+    Creates a DataPoint for the date with the given day ordinal.
+    
+    @param ordinal - the date of the DataPoint, as an integer day ordinal
+    @param daily - the daily price, as an integer
+    @param average - the average 180-day price, as an integer
+    @param traded - the quantity traded, as an integer
+    '''
+    @staticmethod
+    def from_ordinal( ordinal , daily=0 , average=0 , traded=0 ):
+        rtn = DataPoint.__new__( DataPoint )
+        rtn._date = ordinal
+        rtn._daily = daily
+        rtn._average = average
+        rtn._traded = traded
+        return rtn
         
     '''
     Creates a DataPoint object with the following data:
     
-    * year - the year values of the time series data, stored as a string of length 4
-    * month - the month values of the time series data, stored as a string of length 2
-    * day - the day values of the time series data, stored as a string of length 2
+    * year - the year values of the time series data, as an integer or a string
+    * month - the month values of the time series data, as an integer or a string
+    * day - the day values of the time series data, as an integer or a string
     * daily - the daily integer prices of the time series data
     * average - the average integer prices of the time series data
     * traded - the quantity traded on a givne day, stored as an integer
     '''
     def __init__( self , year , month , day , daily=0 , average=0 , traded=0 ):
-        self._year = year
-        self._month = month
-        self._day = day
+        self._date = DateUtils.to_ordinal( year , month , day )
         self._daily = daily
         self._average = average
         self._traded = traded
+        
+    '''
+    The year, month and day of this data point as strings of length 4, 2
+    and 2. These are derived from the day ordinal.
+    '''
+    @property
+    def _year( self ):
+        return self.get_year()
+        
+    @property
+    def _month( self ):
+        return self.get_month()
+        
+    @property
+    def _day( self ):
+        return self.get_day()
 
     '''
     Determines the textual representation of this data point as a comma
@@ -78,7 +113,9 @@ class DataPoint( object ):
     @return - the representation of this data point in CSV format
     '''
     def __str__( self ):
-        return self._year + "," + self._month + "," + self._day + "," + \
+        year , month , day = DateUtils.from_ordinal( self._date )
+        return str( year ) + "," + DateUtils.format_month( month ) + "," + \
+                DateUtils.format_day( day ) + "," + \
                 str( self._daily ) + "," + str( self._average ) + "," + \
                 str( self._traded )
                 
@@ -96,30 +133,43 @@ class DataPoint( object ):
                 str( self._traded )
                 
     def __eq__( self , other ):
-        return self._year == other._year and \
-            self._month == other._month and \
-            self._day == other._day and \
+        return self._date == other._date and \
             self._daily == other._daily and \
             self._average == other._average and \
             self._traded == other._traded
+            
+    def __ne__( self , other ):
+        return not self == other
+        
+    def __getstate__( self ):
+        return (self._date , self._daily , self._average , self._traded)
+        
+    def __setstate__( self , state ):
+        self._date , self._daily , self._average , self._traded = state
+       
+    '''
+    @return - the date of this data point, as an integer day ordinal
+    '''
+    def get_date_ordinal( self ):
+        return self._date
        
     '''
     @return - the year of this data point, as a string of length 4
     '''
     def get_year( self ):
-        return self._year
+        return str( DateUtils.from_ordinal( self._date )[ 0 ] )
         
     '''
     @return - the month of this data point, as a string of length 2
     '''
     def get_month( self ):
-        return self._month
+        return DateUtils.format_month( DateUtils.from_ordinal( self._date )[ 1 ] )
         
     '''
     @return - the day of this data point, as a string of length 2
     '''
     def get_day( self ):
-        return self._day
+        return DateUtils.format_day( DateUtils.from_ordinal( self._date )[ 2 ] )
     
     '''
     @return - the price on YYYY/MM/DD of the commodity this data point
@@ -152,6 +202,14 @@ class DataPoint( object ):
     '''
     def initialize_volume( self , volume ):
         self._traded = volume
+        
+    '''
+    @return - the approximate number of bytes used by this data point
+    '''
+    def get_memory_usage( self ):
+        return sys.getsizeof( self ) + sys.getsizeof( self._date ) + \
+            sys.getsizeof( self._daily ) + sys.getsizeof( self._average ) + \
+            sys.getsizeof( self._traded )
 
     '''
     Determines if this DataPoint comes before another DataPoint's time.
@@ -159,9 +217,7 @@ class DataPoint( object ):
     @param otherDatapoint - another Datapoint with which to compare precedence
     '''        
     def is_before( self , otherDatapoint ):
-        return DateUtils.is_after( int( self._year ) , int( self._month ) , \
-            int( self._day ) , int( otherDatapoint._year ) , \
-            int( otherDatapoint._month ) , int( otherDatapoint._day ) )
+        return self._date < otherDatapoint._date
     
 '''
 Stores daily and average price time series data for a commodity. 
@@ -227,25 +283,63 @@ class CommodityPriceData( object ):
     def append_datapoint( self , datapoint ):
         self._datapoints.append( datapoint )
         
+    '''
+    Estimates how much memory this object uses. The estimate assumes every
+    DataPoint is about the same size as the first one.
+    
+    @return - the approximate number of bytes used by this object and the
+    DataPoint objects it stores
+    '''
+    def get_memory_usage( self ):
+        rtn = sys.getsizeof( self ) + sys.getsizeof( self._datapoints )
+        if ( len( self._datapoints ) > 0 ):
+            rtn += self._datapoints[ 0 ].get_memory_usage()*len( self._datapoints )
+        return rtn
+        
+    '''
+    @return - the day ordinal of every datapoint, as a NumPy array
+    '''
+    def dates( self ):
+        return np.array( [ x.get_date_ordinal() for x in self.get_all_datapoints() ] , dtype=np.int32 )
+        
+    '''
+    @return - the daily price of every datapoint, as a NumPy array
+    '''
+    def prices( self ):
+        return np.array( [ x.get_price() for x in self.get_all_datapoints() ] , dtype=np.int64 )
+        
+    '''
+    @return - the average 180-day price of every datapoint, as a NumPy array
+    '''
+    def averages( self ):
+        return np.array( [ x.get_average180_price() for x in self.get_all_datapoints() ] , dtype=np.int64 )
+        
+    '''
+    @return - the trade volume of every datapoint, as a NumPy array
+    '''
+    def volumes( self ):
+        return np.array( [ x.get_volume() for x in self.get_all_datapoints() ] , dtype=np.int64 )
+        
     def __str__( self ):
         rtn = "Price data for " + self._name
-        for i in range( 0 , len( self._datapoints ) ):
-            rtn += "\n[" + str( self._datapoints[ i ] ) + "]";
+        for datapoint in self.get_all_datapoints():
+            rtn += "\n[" + str( datapoint ) + "]";
         return rtn
         
     def __eq__( self , other ):
         return self._id == other._id and \
             self._name == other._name and \
-            self._datapoints == other._datapoints
+            self.get_all_datapoints() == other.get_all_datapoints()
+            
+    def __ne__( self , other ):
+        return not self == other
             
     '''
     Plots the price of this commodity over time.
     '''
     def plot_price_over_time( self ):
-        times = np.array( [ datetime.strptime( x.get_year() + "-" + \
-                    x.get_month() + "-" + x.get_day() , "%Y-%m-%d" ) \
-                    for x in self._datapoints ] )
-        prices = np.array([ x.get_price() for x in self._datapoints ])
+        times = np.array( [ datetime.fromordinal( x ) for x in self.dates().tolist() ] )
+        prices = self.prices()
         plt.clf()
         plt.plot( times , prices , marker="o" )
         plt.suptitle( self._name )
@@ -257,22 +351,214 @@ class CommodityPriceData( object ):
     Plots the trade volume of this commodity over time.
     '''
     def plot_volume_over_time( self ):
-        times = np.array( [ datetime.strptime( x.get_year() + "-" + \
-                    x.get_month() + "-" + x.get_day() , "%Y-%m-%d" ) \
-                    for x in self._datapoints ] )
-        volumes = np.array([ x.get_volume() for x in self._datapoints ])
+        times = np.array( [ datetime.fromordinal( x ) for x in self.dates().tolist() ] )
+        volumes = self.volumes()
         plt.clf()
         plt.plot( times , volumes , marker="o" )
         plt.suptitle( self._name )
         plt.xlabel( "t" )
         plt.ylabel( "Volume" )
         plt.show()
+        
+'''
+Stores daily and average price time series data for a commodity in NumPy
+arrays instead of a list of DataPoint objects.
+
+The dates, daily prices, average prices and volumes are kept in four
+parallel arrays, which dates(), prices(), averages() and volumes() return
+without copying. DataPoint objects are only created when get_data_at() or
+get_all_datapoints() is called, so an ArrayPriceData can be used anywhere
+a CommodityPriceData is expected.
+'''
+class ArrayPriceData( CommodityPriceData ):
+    
+    '''
+    Creates an ArrayPriceData object with the given time series data. The
+    arrays are used as they are, without being copied, so they may be views
+    into a memory-mapped file.
+    
+    @param id - the ID of the commodity, as an integer
+    @param name - the name of the commodity, as a string
+    @param dates - the day ordinal of each datapoint
+    @param daily - the daily price of each datapoint
+    @param average - the average 180-day price of each datapoint
+    @param volume - the trade volume of each datapoint
+    '''
+    def __init__( self , id , name , dates , daily , average , volume ):
+        self._id = id
+        self._name = name
+        self._dates = np.asarray( dates , dtype=np.int32 )
+        self._daily = np.asarray( daily , dtype=np.int64 )
+        self._average = np.asarray( average , dtype=np.int64 )
+        self._volume = np.asarray( volume , dtype=np.int64 )
+        self._size = len( self._dates )
+        
+    '''
+    @return - a new DataPoint object for the datapoint at the given index.
+    Changing it does not change the data stored in this object.
+    '''
+    def get_data_at( self , index ):
+        if ( index < -self._size or index >= self._size ):
+            raise IndexError( "datapoint index out of range" )
+        if ( index < 0 ):
+            index += self._size
+        return DataPoint.from_ordinal( int( self._dates[ index ] ) , \
+                    int( self._daily[ index ] ) , int( self._average[ index ] ) , \
+                    int( self._volume[ index ] ) )
+        
+    '''
+    @return - the number of datapoints stored
+    '''
+    def get_num_datapoints( self ):
+        return self._size
+        
+    '''
+    @return - a new list of new DataPoint objects for all the datapoints
+    stored. Changing them does not change the data stored in this object.
+    '''
+    def get_all_datapoints( self ):
+        return [ DataPoint.from_ordinal( *x ) for x in zip( self.dates().tolist() , \
+                    self.prices().tolist() , self.averages().tolist() , \
+                    self.volumes().tolist() ) ]
+        
+    '''
+    Adds the given datapoint to the end of the arrays. The arrays grow by
+    doubling their capacity when they are full, so appending n datapoints
+    takes O(n) time overall.
+    WARNING: There are no checks. You must make sure you do not append
+    an out of order datapoint! In particular, the datapoint
+    you are appending should come after all previous datapoints
+    
+    @param datapoint - the DataPoint obejct to append
+    '''
+    def append_datapoint( self , datapoint ):
+        
+        #arrays that are not writeable (such as memory-mapped files) have
+        #to be copied before we can append to them
+        if ( self._size == len( self._dates ) or not self._dates.flags.writeable ):
+            capacity = max( 2*self._size , 16 )
+            self._dates = self._grow( self._dates , capacity )
+            self._daily = self._grow( self._daily , capacity )
+            self._average = self._grow( self._average , capacity )
+            self._volume = self._grow( self._volume , capacity )
+        self._dates[ self._size ] = datapoint.get_date_ordinal()
+        self._daily[ self._size ] = datapoint.get_price()
+        self._average[ self._size ] = datapoint.get_average180_price()
+        self._volume[ self._size ] = datapoint.get_volume()
+        self._size += 1
+        
+    '''
+    Copies the used part of an array into a new array with the given capacity.
+    '''
+    def _grow( self , array , capacity ):
+        rtn = np.zeros( capacity , dtype=array.dtype )
+        rtn[ 0:self._size ] = array[ 0:self._size ]
+        return rtn
+        
+    '''
+    @return - the approximate number of bytes used by this object and its
+    arrays
+    '''
+    def get_memory_usage( self ):
+        return sys.getsizeof( self ) + self._dates.nbytes + self._daily.nbytes + \
+                self._average.nbytes + self._volume.nbytes
+        
+    '''
+    Creates a new ArrayPriceData that shares the arrays of this object but
+    cannot modify them. Writing to the arrays of the view raises an error,
+    and appending to the view copies its arrays first, so this object is
+    never changed through the view.
+    
+    @return - a read only view of this object's price data
+    '''
+    def get_read_only_view( self ):
+        columns = [ self.dates() , self.prices() , self.averages() , self.volumes() ]
+        for array in columns:
+            array.flags.writeable = False
+        return ArrayPriceData( self._id , self._name , *columns )
+        
+    '''
+    @return - the day ordinal of every datapoint, as a NumPy array. This is
+    a view of the stored data and should not be modified externally!
+    '''
+    def dates( self ):
+        return self._dates[ 0:self._size ]
+        
+    '''
+    @return - the daily price of every datapoint, as a NumPy array. This is
+    a view of the stored data and should not be modified externally!
+    '''
+    def prices( self ):
+        return self._daily[ 0:self._size ]
+        
+    '''
+    @return - the average 180-day price of every datapoint, as a NumPy array.
+    This is a view of the stored data and should not be modified externally!
+    '''
+    def averages( self ):
+        return self._average[ 0:self._size ]
+        
+    '''
+    @return - the trade volume of every datapoint, as a NumPy array. This is
+    a view of the stored data and should not be modified externally!
+    '''
+    def volumes( self ):
+        return self._volume[ 0:self._size ]
             
 def main():
     p1 = DataPoint( "2015" , "08" , "01" )
     p2 = DataPoint( "2015" , "08" , "22" )
     assert p1.is_before( p2 )
     assert p2.is_before( p1 ) == False
+    assert p1.is_before( p1 ) == False
+    
+    p3 = DataPoint.from_csv_data( "2016,01,08,252,295,422970" )
+    assert str( p3 ) == "2016,01,08,252,295,422970"
+    assert p3.get_year() == "2016" and p3.get_month() == "01" and p3.get_day() == "08"
+    assert p3._year == "2016" and p3._month == "01" and p3._day == "08"
+    assert p3 == DataPoint( 2016 , 1 , 8 , 252 , 295 , 422970 )
+    assert p3 == DataPoint.from_ordinal( p3.get_date_ordinal() , 252 , 295 , 422970 )
+    assert p3 != DataPoint( "2016" , "01" , "08" , 252 , 295 , 0 )
+    assert DataPoint( "2015" , "12" , "31" ).is_before( DataPoint( "2016" , "01" , "01" ) )
+    assert not hasattr( p3 , "__dict__" )
+    
+    import pickle
+    assert pickle.loads( pickle.dumps( p3 , 2 ) ) == p3
+    
+    points = [ DataPoint( "2015" , "12" , "31" , 10 , 11 , 12 ) , p3 ]
+    listData = CommodityPriceData( 447 , "Mithril ore" , list( points ) )
+    arrayData = ArrayPriceData( 447 , "Mithril ore" , listData.dates() , \
+                    listData.prices() , listData.averages() , listData.volumes() )
+    assert arrayData == listData and listData == arrayData
+    assert arrayData.get_data_at( -1 ) == p3 and arrayData.get_data_at( 0 ) == points[ 0 ]
+    assert np.all( arrayData.prices() == [ 10 , 252 ] )
+    assert np.all( arrayData.volumes() == [ 12 , 422970 ] )
+    
+    #appending grows the arrays geometrically, even when they start out
+    #read only
+    arrayData._dates.flags.writeable = False
+    for i in range( 0 , 100 ):
+        datapoint = DataPoint.from_ordinal( p3.get_date_ordinal()+1+i , i , i , i )
+        arrayData.append_datapoint( datapoint )
+        listData.append_datapoint( datapoint )
+    assert arrayData == listData
+    assert arrayData.get_num_datapoints() == 102
+    assert len( arrayData._dates ) == 128
+    assert arrayData.averages()[ -1 ] == 99
+    
+    #a read only view shares the arrays but cannot change them
+    view = arrayData.get_read_only_view()
+    assert view == arrayData and np.may_share_memory( view.prices() , arrayData.prices() )
+    try:
+        view.prices()[ 0 ] = 0
+        assert False
+    except ValueError:
+        pass
+    view.append_datapoint( DataPoint.from_ordinal( p3.get_date_ordinal()+101 , 1 , 1 , 1 ) )
+    assert view.get_num_datapoints() == 103 and arrayData.get_num_datapoints() == 102
+    assert arrayData.prices()[ 0 ] == 10
+    arrayData.append_datapoint( DataPoint.from_ordinal( p3.get_date_ordinal()+101 , 2 , 2 , 2 ) )
+    assert view.prices()[ -1 ] == 1 and arrayData.prices()[ -1 ] == 2
     
     print "Regression testing for price_data passed."
 
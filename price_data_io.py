@@ -6,8 +6,14 @@ Created on Fri Aug 21 2015
 """
 
 from price_crawler import PriceCrawler
-from price_data import DataPoint , CommodityPriceData
+from price_data import DataPoint , CommodityPriceData , ArrayPriceData
+from price_store import PriceStore
+from feature_store import FeatureStore
+from instrumentation import Instrumentation
+import fcntl
 import os
+import multiprocessing
+import numpy as np
 from date_utils import DateUtils
 
 '''
@@ -97,12 +103,39 @@ Provides functions for reading in price data.
 '''     
 class PriceReader( object ):
     
+    '''
+    The name of the file, within the folder of a month, that stores the
+    price data of every commodity for that month. See PriceWriter for the
+    format of the file.
+    '''
+    MONTH_PARTITION_FILENAME = "partition.csv"
+    
+    '''
+    Maps the filename of each partition file that has been indexed to an
+    (inode, modification time, size, index) tuple. See get_partition_index().
+    '''
+    partitionIndexes = {}
+    
+    '''
+    @param month - a month, as an integer
+    @param year - a year, as an integer
+    @return - the folder that stores price data for the given month
+    '''
+    @staticmethod
+    def get_month_directory( month , year ):
+        return "price_data/" + str( year ) + " " + DateUtils.format_month( month )
+    
     '''
     Reads in price data for a given month and returns a MonthData object
     with all that data. If the data does not exist, then all the datapoints
     will have daily price 0 and average price 0. Note that the name of the
     commodity is CASE SENSITIVE.
     
+    The data is looked up in the month's partition file first, and only the
+    commodity's own lines are read from it (see get_partition_index()). If
+    the commodity is not in the partition file, the commodity's own file for
+    the month is read instead.
+    
     @param month - the month of the price data to read, as an integer
     @param year - the year of the price data to read, as an integer
     @param commodity - the name of the commodity for which to look up price data,
@@ -113,7 +146,25 @@ class PriceReader( object ):
     @staticmethod
     def read_month_data( month , year , commodity ):
         rtn = MonthData( month , year )
-        dir = "price_data/" + str( year ) + " " + DateUtils.format_month( month )
+        dir = PriceReader.get_month_directory( month , year )
+        
+        foundInPartition = False
+        try :
+            file = open( dir + "/" + PriceReader.MONTH_PARTITION_FILENAME , "r" )
+            index = PriceReader.get_partition_index( file )
+            for offset , length in index.get( commodity , [] ):
+                file.seek( offset )
+                for line in file.read( length ).splitlines():
+                    values = line.rsplit( "," , 4 )
+                    datapoint = DataPoint.from_csv_month_data( year , month , ",".join( values[ 1: ] ) )
+                    rtn.set( int( datapoint.get_day() ) , datapoint )
+                    foundInPartition = True
+            file.close()
+        except IOError:
+            pass
+        if ( foundInPartition ):
+            return rtn
+        
         try :
             file = open( dir + "/" + commodity + ".csv" , "r" )
             lines = file.readlines()
@@ -128,31 +179,346 @@ class PriceReader( object ):
         
         return rtn
         
+    '''
+    Indexes a partition file by commodity, so that the data of one commodity
+    can be read without parsing the data of every other commodity in the
+    month. The index of each file is kept in memory and rebuilt only when
+    the file is replaced or its modification time or size changes. Partition files are
+    written sorted by commodity, so each commodity's lines are usually a
+    single block of the file.
+    
+    @param file - the partition file, opened for reading
+    @return - a dictionary that maps the CASE SENSITIVE names of the
+    commodities in the file to lists of (offset, length) tuples, the blocks
+    of the file that hold their lines
+    '''
+    @staticmethod
+    def get_partition_index( file ):
+        info = os.fstat( file.fileno() )
+        cached = PriceReader.partitionIndexes.get( file.name )
+        if ( cached is not None and cached[ 0:3 ] == (info.st_ino , info.st_mtime , info.st_size) ):
+            return cached[ 3 ]
+        
+        file.seek( 0 )
+        index = {}
+        PriceReader._index_partition_lines( index , file.read().splitlines( True ) , 0 )
+        PriceReader.partitionIndexes[ file.name ] = (info.st_ino , info.st_mtime , info.st_size , index)
+        return index
+    
+    '''
+    Adds lines of a partition file to its index. See get_partition_index().
+    
+    @param index - the index of the partition file, which is updated in place
+    @param lines - the lines, with their line endings
+    @param offset - where the first of the lines starts in the file
+    '''
+    @staticmethod
+    def _index_partition_lines( index , lines , offset ):
+        for line in lines:
+            name = line.rsplit( "," , 4 )[ 0 ]
+            blocks = index.get( name )
+            if ( blocks is not None and sum( blocks[ -1 ] ) == offset ):
+                blocks[ -1 ] = (blocks[ -1 ][ 0 ] , blocks[ -1 ][ 1 ] + len( line ))
+            elif ( blocks is not None ):
+                blocks.append( (offset , len( line )) )
+            else:
+                index[ name ] = [ (offset , len( line )) ]
+            offset += len( line )
+        
+    '''
+    Reads in the partition file of a given month, which has the price data
+    of many commodities, with a single read.
+    
+    @param month - the month of the price data to read, as an integer
+    @param year - the year of the price data to read, as an integer
+    @return - a dictionary that maps the CASE SENSITIVE names of commodities
+    to MonthData objects with their price data for the given month. The
+    dictionary is empty if the month has no partition file.
+    '''
+    @staticmethod
+    def read_month_partition( month , year ):
+        start = Instrumentation.start()
+        rtn = {}
+        filename = PriceReader.get_month_directory( month , year ) + "/" + \
+                    PriceReader.MONTH_PARTITION_FILENAME
+        try :
+            file = open( filename , "r" )
+            text = file.read()
+            file.close()
+        except IOError:
+            return rtn
+        
+        lines = text.splitlines()
+        
+        for line in lines:
+            values = line.rsplit( "," , 4 )
+            if ( not rtn.has_key( values[ 0 ] ) ):
+                rtn[ values[ 0 ] ] = MonthData( month , year )
+            datapoint = DataPoint.from_csv_month_data( year , month , ",".join( values[ 1: ] ) )
+            rtn[ values[ 0 ] ].set( int( datapoint.get_day() ) , datapoint )
+        Instrumentation.stop( "reader.month_partition" , start , len( text ) )
+        return rtn
+        
     '''
     Gets price data for a given commodity from a CSV file or returns
-    None if the CSV file for the given commodity ID was not found
+    None if the CSV file for the given commodity ID was not found.
+    
+    The whole file is read with one call and, after the name on the first
+    line, all the integers in it are decoded into a NumPy array in a single
+    vectorized pass. No DataPoint objects are created. That pass stops at
+    the first thing that is not an integer, so if it did not decode six
+    integers per line (because of CRLF line endings, blank lines or a bad
+    line), the file is parsed again line by line.
     
     @param commodityId - the ID of a commodity, as an integer
-    @param filename - the name of the CSV file from which to read data, as
-    a string. If the CSV file does not exist, None will be returned.
-    @return - a CommodityPriceData object with all the price data
+    @return - an ArrayPriceData object with all the price data
     for the given commodity
     '''
     @staticmethod
     def get_price_data_from_csv( commodityId ):
+        start = Instrumentation.start()
         filename = "price_data/master_list/" + str( commodityId ) + ".csv"
         try:
             f = open( filename , "r" )
+            text = f.read()
+            f.close()
+        except IOError:
+            return None
+        
+        #the first line is the name of the commodity. the rest of the file
+        #is rows of year,month,day,daily,average,volume
+        newline = text.find( "\n" )
+        if ( newline == -1 ):
+            name = text.rstrip( "\r" )
+            body = ""
+        else:
+            name = text[ 0:newline ].rstrip( "\r" )
+            body = text[ newline+1: ].strip()
+        numLines = body.count( "\n" ) + 1 if len( body ) > 0 else 0
+        values = np.fromstring( body.replace( "\n" , "," ) , dtype=np.int64 , sep="," )
+        if ( values.size == 6*numLines ):
+            values = values.reshape( -1 , 6 )
+        else:
+            values = PriceReader._parse_csv_lines( filename , body )
+        
+        dates = DateUtils.to_ordinal_array( values[ : , 0 ] , values[ : , 1 ] , values[ : , 2 ] )
+        rtn = ArrayPriceData( commodityId , name , dates , values[ : , 3 ].copy() , \
+                    values[ : , 4 ].copy() , values[ : , 5 ].copy() )
+        Instrumentation.stop( "reader.csv" , start , len( text ) )
+        return rtn
+        
+    '''
+    Parses the rows of a commodity's CSV file one line at a time, skipping
+    blank lines.
+    
+    @param filename - the name of the file, for error messages
+    @param body - the rows of the file, without the line with the name
+    @return - a NumPy array with one row of year, month, day, daily price,
+    average price and volume per datapoint
+    '''
+    @staticmethod
+    def _parse_csv_lines( filename , body ):
+        rows = []
+        for line in body.splitlines():
+            if ( line.strip() == "" ):
+                continue
+            try:
+                row = [ int( x ) for x in line.split( "," ) ]
+            except ValueError:
+                row = None
+            if ( row is None or len( row ) != 6 ):
+                raise ValueError( filename + " is not a valid price data file." )
+            rows.append( row )
+        return np.array( rows , dtype=np.int64 ).reshape( -1 , 6 )
+        
+    '''
+    Gets price data for many commodities from their CSV files, parsing the
+    files in parallel with a pool of worker processes.
+    
+    @param commodityIds - the IDs of the commodities, as a list of integers
+    @param processes - the number of worker processes to use. If None, one
+    process per CPU is used. If 1, the files are parsed in this process.
+    @return - a dictionary that maps each commodity ID to an ArrayPriceData
+    object with its price data, or to None if it has no CSV file
+    '''
+    @staticmethod
+    def get_price_data_from_csvs( commodityIds , processes=None ):
+        commodityIds = list( commodityIds )
+        if ( processes is None ):
+            processes = multiprocessing.cpu_count()
+        if ( processes <= 1 or len( commodityIds ) <= 1 ):
+            results = [ PriceReader.get_price_data_from_csv( x ) for x in commodityIds ]
+        else:
+            pool = multiprocessing.Pool( processes )
+            try:
+                chunksize = max( 1 , len( commodityIds ) // (4*processes) )
+                results = pool.map( _get_price_data_from_csv , commodityIds , chunksize )
+            finally:
+                pool.close()
+                pool.join()
+        return dict( zip( commodityIds , results ) )
             
-            #have to get rid of the \n at the end of the line
-            name = f.readline()[0:-1]
-            datapoints = []
-            for line in f:
-                datapoints.append( DataPoint.from_csv_data( line ) )
-            return CommodityPriceData( commodityId , name , datapoints )
+    '''
+    Gets price data for a given commodity from its binary file in
+    price_data/binary_list. No text is parsed, so this is much faster than
+    reading the CSV file. None is returned if there is no binary file for the
+    commodity or if it is older than the commodity's CSV file.
+    
+    @param commodityId - the ID of a commodity, as an integer
+    @return - an ArrayPriceData object with all the price data for the
+    given commodity. Its arrays are views into the memory-mapped file.
+    '''
+    @staticmethod
+    def get_price_data_from_binary( commodityId ):
+        start = Instrumentation.start()
+        if ( not PriceStore.is_current( commodityId ) ):
+            return None
+        columns = PriceStore.read_columns( commodityId )
+        if ( columns is None ):
+            return None
+        name , dates , daily , average , volume = columns
+        Instrumentation.stop( "reader.binary" , start , len( name ) + dates.nbytes + \
+                              daily.nbytes + average.nbytes + volume.nbytes )
+        return ArrayPriceData( commodityId , name , dates , daily , average , volume )
+        
+    '''
+    Gets price data for a given commodity, using its binary file if it is
+    up to date and falling back to its CSV file otherwise.
+    
+    @param commodityId - the ID of a commodity, as an integer
+    @return - a CommodityPriceData object with all the price data
+    for the given commodity, or None if the commodity has no price data
+    '''
+    @staticmethod
+    def get_price_data( commodityId ):
+        rtn = PriceReader.get_price_data_from_binary( commodityId )
+        if ( rtn is None ):
+            rtn = PriceReader.get_price_data_from_csv( commodityId )
+        return rtn
+        
+    '''
+    Gets the price data for a given commodity as columns of integers rather
+    than as DataPoint objects. The binary file of the commodity is memory
+    mapped if it is up to date. Otherwise, the CSV file is read.
+    
+    @param commodityId - the ID of a commodity, as an integer
+    @return - a (name, dates, daily, average, volume) tuple, where dates is
+    a NumPy array of day ordinals and the others are NumPy arrays of integers,
+    or None if the commodity has no price data
+    '''
+    @staticmethod
+    def get_price_columns( commodityId ):
+        if ( PriceStore.is_current( commodityId ) ):
+            columns = PriceStore.read_columns( commodityId )
+            if ( columns is not None ):
+                return columns
+        priceData = PriceReader.get_price_data_from_csv( commodityId )
+        if ( priceData is None ):
+            return None
+        return (priceData.get_name() , priceData.dates() , priceData.prices() , \
+                priceData.averages() , priceData.volumes())
+        
+    '''
+    Reads the last line of a file that is not blank by seeking backwards
+    from the end of the file, so only the end of the file is ever read no
+    matter how long it is.
+    
+    @param filename - the file to read
+    @return - a (line, start, end) tuple, where line is the last line of the
+    file that is not blank, without its newline or trailing whitespace, and
+    start and end are the offsets in the file at which it starts and ends.
+    If start is 0, the line is the first line of the file. None is returned
+    if the file does not exist or only has blank lines.
+    '''
+    @staticmethod
+    def read_last_line( filename ):
+        try:
+            f = open( filename , "rb" )
         except IOError:
             return None
+        f.seek( 0 , os.SEEK_END )
+        size = f.tell()
+        
+        #read blocks from the end of the file until we have found the
+        #newline that comes before the last line that is not blank, or
+        #reach the start of the file
+        blockSize = 256
+        tail = ""
+        position = size
+        while ( position > 0 ):
+            readSize = min( blockSize , position )
+            position -= readSize
+            f.seek( position )
+            tail = f.read( readSize ) + tail
+            if ( tail.rstrip().find( "\n" ) != -1 ):
+                break
+        f.close()
+        
+        tail = tail.rstrip()
+        if ( len( tail ) == 0 ):
+            return None
+        lineStart = tail.rfind( "\n" ) + 1
+        return (tail[ lineStart: ] , position + lineStart , position + len( tail ))
+        
+    '''
+    Gets the last DataPoint stored in the CSV file of a commodity without
+    reading the rest of the file.
+    
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the last DataPoint of the commodity, or None if the commodity
+    has no CSV file or no datapoints
+    '''
+    @staticmethod
+    def get_last_datapoint_from_csv( commodityId ):
+        lastLine = PriceReader.read_last_line( "price_data/master_list/" + str( commodityId ) + ".csv" )
+        if ( lastLine is None or lastLine[ 1 ] == 0 ):
+            return None
+        return PriceReader.parse_csv_line( lastLine[ 0 ] )
+        
+    '''
+    Parses a line of price data from a commodity's CSV file.
+    
+    @param line - the line, without its newline
+    @return - the DataPoint on the line, or None if the line is not a valid
+    row of year, month, day, daily price, average price and volume (for
+    example, a row that was cut short when writing it was interrupted)
+    '''
+    @staticmethod
+    def parse_csv_line( line ):
+        if ( line.count( "," ) != 5 ):
+            return None
+        try:
+            return DataPoint.from_csv_data( line )
+        except ValueError:
+            return None
+        
+    '''
+    Reads the IDs of all known commodities from price_data/item_ids,
+    skipping any duplicates.
+    
+    @return - a list of commodity IDs, as integers, in the order in which
+    they appear in price_data/item_ids
+    '''
+    @staticmethod
+    def read_item_ids():
+        rtn = []
+        seen = set()
+        f = open( "price_data/item_ids" , "r" )
+        for line in f:
+            commodityId = int( line.split( "," )[ 1 ] )
+            if ( commodityId not in seen ):
+                seen.add( commodityId )
+                rtn.append( commodityId )
+        f.close()
+        return rtn
         
+'''
+Worker function for PriceReader.get_price_data_from_csvs. Worker processes
+can only be given module-level functions.
+'''
+def _get_price_data_from_csv( commodityId ):
+    return PriceReader.get_price_data_from_csv( commodityId )
+    
 '''
 Provides functions for writing daily and average price data to the 
 appropriate files. 
@@ -174,6 +540,13 @@ specified in the file's path. As an example, if Mithril ore had a daily price
 of 248 and average 180-day price of 308 on 2015/08/21, then in the file
 "price_data/2015 08/Mithril ore.csv", we would find the entry 
 "21,348,308" on line 21.
+
+Month data is now saved to a single partition file per month instead,
+"price_data/2015 08/partition.csv", which holds every commodity's data for
+that month (see PriceWriter.write_month_partition). The per-commodity files
+described above are still read for commodities that are not in a month's
+partition file yet. They are moved into the partition file and removed the
+next time the month is saved, or by PriceWriter.migrate_month_files().
 '''
 class PriceWriter( object ):
     
@@ -193,47 +566,333 @@ class PriceWriter( object ):
         PriceWriter.save_list_data( priceData )
     
     '''
+    Saves the data in a CommodityPriceData object to the commodity's file in
+    price_data/master_list. Only datapoints newer than the ones already
+    stored are appended to the file, and the commodity's stored features
+    are updated with them.
+    
+    @param priceData - a CommodityPriceData object with time series data
+    that should be saved
+    @return - the number of datapoints that were appended
     '''
     @staticmethod
     def save_list_data( priceData ):
         filename = "price_data/master_list/" + str( priceData.get_id() ) + ".csv"
-        PriceWriter.write_price_data_to_csv( filename , priceData )
+        
+        #the stored features can only be brought up to date with the new
+        #datapoints if they were up to date with the file before it changed
+        features = FeatureStore.get( priceData.get_id() )
+        lastDatapoint = PriceReader.get_last_datapoint_from_csv( priceData.get_id() )
+        numAppended = PriceWriter.append_price_data_to_csv( filename , priceData )
+        
+        #fold only the new datapoints into the commodity's stored features
+        lastDate = lastDatapoint.get_date_ordinal() if lastDatapoint is not None else None
+        FeatureStore.append( priceData , numAppended , features , lastDate )
+        return numAppended
         
     '''
-    Saves the data in a CommodityPriceData object to the 
+    Saves the data in a CommodityPriceData object to the partition files of
+    the months it covers. Rather than rewriting each partition file, only
+    the lines of the days that changed are appended to it. Readers apply a
+    partition's lines in order, so the appended lines override the older
+    ones until the next save_month_data_batch() writes the partition out
+    sorted again. This keeps a single save from costing as much as the
+    whole market's data for the month. A month that still has files for
+    single commodities is rewritten instead, so they are moved into its
+    partition.
+    
+    @param priceData - a CommodityPriceData object with time series data
+    that should be saved
     '''
     @staticmethod
     def save_month_data( priceData ):
+        start = Instrumentation.start()
+        name = priceData.get_name()
+        months = PriceWriter._group_by_month( [ priceData ] )
+        for (month , year) , commodities in months.items():
+            lock = PriceWriter._lock_month( month , year )
+            try:
+                if ( PriceWriter._has_month_files( month , year ) ):
+                    PriceWriter._save_month( month , year , commodities )
+                    continue
+                
+                monthData = PriceReader.read_month_data( month , year , name )
+                lines = []
+                for datapoint in commodities[ name ]:
+                    day = int( datapoint.get_day() )
+                    PriceWriter._merge_volume( datapoint , monthData.get( day ) )
+                    if ( datapoint != monthData.get( day ) ):
+                        monthData.set( day , datapoint )
+                        lines.append( PriceWriter._format_partition_line( name , day , datapoint ) )
+                PriceWriter._append_to_month_partition( month , year , lines )
+            finally:
+                os.close( lock )
+        Instrumentation.stop( "writer.month_data" , start )
+        
+    '''
+    Saves the data in many CommodityPriceData objects to the partition files
+    of the months they cover. The work is grouped by month: each month's
+    partition file is read once, the data of every commodity is merged into
+    it, and it is rewritten with a single write. This is much cheaper than
+    reading and writing one file per commodity per month.
+    
+    @param priceDataList - a list of CommodityPriceData objects with time
+    series data that should be saved
+    '''
+    @staticmethod
+    def save_month_data_batch( priceDataList ):
+        start = Instrumentation.start()
+        months = PriceWriter._group_by_month( priceDataList )
+        for (month , year) , commodities in months.items():
+            lock = PriceWriter._lock_month( month , year )
+            try:
+                PriceWriter._save_month( month , year , commodities )
+            finally:
+                os.close( lock )
+        Instrumentation.stop( "writer.month_batch" , start )
+    
+    '''
+    Groups the datapoints of many commodities by month, and then by commodity.
+    
+    @param priceDataList - a list of CommodityPriceData objects
+    @return - a dictionary that maps (month, year) tuples to dictionaries
+    that map the names of commodities to lists of their datapoints in that
+    month
+    '''
+    @staticmethod
+    def _group_by_month( priceDataList ):
         months = {}
-        for i in range( 0 , priceData.get_num_datapoints() ):
-            datapoint = priceData.get_data_at( i )
-            key = (datapoint.get_month() , datapoint.get_year() )
-            
-            #read in the data for the month if it exists
-            if ( not months.has_key( key ) ):
-                months[ key ] = PriceReader.read_month_data( \
-                    int(datapoint.get_month()) , int(datapoint.get_year()) , priceData.get_name() )
-                    
-            #the MonthData object must have been created and contains whatever
-            #values were stored on the hard drive. We now merge
-            #our price data into it.
-            prevData = months[ key ].get( int(datapoint.get_day()) )
+        for priceData in priceDataList:
+            for datapoint in priceData.get_all_datapoints():
+                key = (int( datapoint.get_month() ) , int( datapoint.get_year() ))
+                if ( not months.has_key( key ) ):
+                    months[ key ] = {}
+                commodities = months[ key ]
+                if ( not commodities.has_key( priceData.get_name() ) ):
+                    commodities[ priceData.get_name() ] = []
+                commodities[ priceData.get_name() ].append( datapoint )
+        return months
+    
+    '''
+    Merges the datapoints of many commodities into the partition file of a
+    month and rewrites it. The caller must hold the month's lock (see
+    _lock_month()).
+    
+    @param month - the month, as an integer
+    @param year - the year, as an integer
+    @param commodities - a dictionary that maps the names of commodities to
+    lists of their datapoints in the given month
+    '''
+    @staticmethod
+    def _save_month( month , year , commodities ):
+        partition = PriceReader.read_month_partition( month , year )
+        
+        #the month may still have files for single commodities from
+        #before partition files were used, so their data is moved into
+        #the partition as well
+        monthFiles = PriceWriter._merge_month_files( month , year , partition )
+        
+        for name , datapoints in commodities.items():
+            if ( not partition.has_key( name ) ):
+                partition[ name ] = MonthData( month , year )
+            monthData = partition[ name ]
             
-            #since json does not have volume data, it will always have
-            #volumes of 0. If our past data has nonzero volumes already 
-            #recorded, we don't want to lose that! So, we will merge
-            #the old data's volume into the new data's volume.
-            if ( prevData.get_volume() != 0 and datapoint.get_volume() == 0 ):
-                datapoint.initialize_volume( prevData.get_volume() )
+            for datapoint in datapoints:
+                PriceWriter._merge_volume( datapoint , monthData.get( int( datapoint.get_day() ) ) )
                 
-            #everything else, other than the volume, can be overwritten
-            #by the merge.
-            months[ key ].set( int(datapoint.get_day()) , datapoint )
+                #everything else, other than the volume, can be overwritten
+                #by the merge.
+                monthData.set( int( datapoint.get_day() ) , datapoint )
+        
+        PriceWriter.write_month_partition( month , year , partition )
+        for filename in monthFiles:
+            os.remove( filename )
+    
+    '''
+    Since json does not have volume data, it will always have volumes of 0.
+    If our past data has nonzero volumes already recorded, we don't want to
+    lose that! So, we will merge the old data's volume into the new data's
+    volume.
+    
+    @param datapoint - the new datapoint, which is updated in place
+    @param prevData - the datapoint already stored for the same day
+    '''
+    @staticmethod
+    def _merge_volume( datapoint , prevData ):
+        if ( prevData.get_volume() != 0 and datapoint.get_volume() == 0 ):
+            datapoint.initialize_volume( prevData.get_volume() )
+    
+    '''
+    Locks a month against other processes that save its data, so that they
+    do not read the partition file while it is being merged into and lose
+    each other's updates. The month's folder itself is locked because the
+    partition file is replaced whenever it is rewritten, and a lock file
+    would show up among the files for single commodities.
+    
+    @param month - the month, as an integer
+    @param year - the year, as an integer
+    @return - the file descriptor of the month's folder, which is locked.
+    Closing it with os.close() releases the lock.
+    '''
+    @staticmethod
+    def _lock_month( month , year ):
+        dir = PriceReader.get_month_directory( month , year )
+        try:
+            os.makedirs( dir )
+        except OSError:
+            
+            #another process may have created the folder first
+            if ( not os.path.isdir( dir ) ):
+                raise
+        lock = os.open( dir , os.O_RDONLY )
+        fcntl.flock( lock , fcntl.LOCK_EX )
+        return lock
+    
+    '''
+    @param month - the month, as an integer
+    @param year - the year, as an integer
+    @return - whether the month still has files for single commodities from
+    before partition files were used
+    '''
+    @staticmethod
+    def _has_month_files( month , year ):
+        dir = PriceReader.get_month_directory( month , year )
+        return any( [ x.endswith( ".csv" ) and x != PriceReader.MONTH_PARTITION_FILENAME \
+                      for x in os.listdir( dir ) ] )
+    
+    '''
+    Appends lines to the partition file of a month. If the partition's
+    index is in memory and up to date, the new lines are added to it rather
+    than having it rebuilt from the whole file. The caller must hold the
+    month's lock (see _lock_month()).
+    
+    @param month - the month, as an integer
+    @param year - the year, as an integer
+    @param lines - the lines, in the format of write_month_partition()
+    '''
+    @staticmethod
+    def _append_to_month_partition( month , year , lines ):
+        if ( len( lines ) == 0 ):
+            return
+        filename = PriceReader.get_month_directory( month , year ) + "/" + \
+                    PriceReader.MONTH_PARTITION_FILENAME
+        f = open( filename , "a" )
+        info = os.fstat( f.fileno() )
+        f.write( "".join( lines ) )
+        f.flush()
+        newInfo = os.fstat( f.fileno() )
+        f.close()
         
-        #after all data has been merged, we can rewrite the updated
-        #data back to the hard drive
-        for monthData in months.values() :
-            PriceWriter.write_month_data_to_file( monthData , priceData.get_name() )
+        cached = PriceReader.partitionIndexes.get( filename )
+        if ( cached is not None and cached[ 0:3 ] == (info.st_ino , info.st_mtime , info.st_size) ):
+            index = cached[ 3 ]
+            PriceReader._index_partition_lines( index , lines , info.st_size )
+            PriceReader.partitionIndexes[ filename ] = (newInfo.st_ino , newInfo.st_mtime , \
+                                                        newInfo.st_size , index)
+    
+    '''
+    Moves the data in the files for single commodities of every month, which
+    were used before partition files, into the months' partition files and
+    removes them.
+    
+    @return - the number of files that were removed
+    '''
+    @staticmethod
+    def migrate_month_files():
+        numRemoved = 0
+        for name in sorted( os.listdir( "price_data" ) ):
+            values = name.split( " " )
+            if ( len( values ) != 2 or not values[ 0 ].isdigit() or not values[ 1 ].isdigit() ):
+                continue
+            month = int( values[ 1 ] )
+            year = int( values[ 0 ] )
+            lock = PriceWriter._lock_month( month , year )
+            try:
+                partition = PriceReader.read_month_partition( month , year )
+                monthFiles = PriceWriter._merge_month_files( month , year , partition )
+                if ( len( monthFiles ) > 0 ):
+                    PriceWriter.write_month_partition( month , year , partition )
+                    for filename in monthFiles:
+                        os.remove( filename )
+                    numRemoved += len( monthFiles )
+            finally:
+                os.close( lock )
+        return numRemoved
+    
+    '''
+    Adds the data in the files for single commodities of a month to the
+    month's partition. Commodities that are already in the partition keep
+    their data from the partition, which is what readers use.
+    
+    @param month - the month, as an integer
+    @param year - the year, as an integer
+    @param partition - the month's partition, from read_month_partition()
+    @return - the names of the files that were read, which can be removed
+    once the partition has been written
+    '''
+    @staticmethod
+    def _merge_month_files( month , year , partition ):
+        dir = PriceReader.get_month_directory( month , year )
+        if ( not os.path.isdir( dir ) ):
+            return []
+        filenames = []
+        for name in sorted( os.listdir( dir ) ):
+            if ( not name.endswith( ".csv" ) or name == PriceReader.MONTH_PARTITION_FILENAME ):
+                continue
+            commodity = name[ 0:-4 ]
+            if ( not partition.has_key( commodity ) ):
+                partition[ commodity ] = PriceReader.read_month_data( month , year , commodity )
+            filenames.append( dir + "/" + name )
+        return filenames
+    
+    '''
+    Writes the partition file for a month. The partition file stores the
+    price data of many commodities, one day of one commodity per line, in
+    the comma-separated-value format
+            <commodity name>,<day>,<daily price>,<average price>,<volume>
+    Days for which a commodity has no data are left out. The file is written
+    to a temporary file first and then renamed, so readers never see a
+    partially written partition.
+    
+    @param month - the month of the price data, as an integer
+    @param year - the year of the price data, as an integer
+    @param partition - a dictionary that maps the names of commodities to
+    MonthData objects with their price data for the given month
+    '''
+    @staticmethod
+    def write_month_partition( month , year , partition ):
+        start = Instrumentation.start()
+        dir = PriceReader.get_month_directory( month , year )
+        if ( not os.path.exists( dir ) ):
+            os.makedirs( dir )
+        
+        lines = []
+        for name in sorted( partition.keys() ):
+            monthData = partition[ name ]
+            for day in range( 1 , monthData.numDays+1 ):
+                datapoint = monthData.get( day )
+                if ( datapoint.get_price() != 0 or datapoint.get_average180_price() != 0 or \
+                        datapoint.get_volume() != 0 ):
+                    lines.append( PriceWriter._format_partition_line( name , day , datapoint ) )
+        
+        filename = dir + "/" + PriceReader.MONTH_PARTITION_FILENAME
+        text = "".join( lines )
+        f = open( filename + ".tmp" , "w" )
+        f.write( text )
+        f.close()
+        os.rename( filename + ".tmp" , filename )
+        Instrumentation.stop( "writer.month_partition" , start , len( text ) )
+    
+    '''
+    @param name - the name of a commodity
+    @param day - the day of the month, as an integer
+    @param datapoint - the commodity's datapoint for that day
+    @return - the datapoint's line in a partition file, with its line ending.
+    See write_month_partition().
+    '''
+    @staticmethod
+    def _format_partition_line( name , day , datapoint ):
+        return name + "," + DateUtils.format_day( day ) + "," + datapoint.str_without_date() + "\n"
     
     '''
     Writes the month data for a given commodity to the appropriate file.
@@ -255,13 +914,15 @@ class PriceWriter( object ):
         f.write( str( monthData ) )
                     
     '''
-    Writes some price data to a CSV file.
+    Writes some price data to a CSV file. If the file is the commodity's
+    file in the master list, its stored features are computed again.
     
     @param filename - the file to which to write price data
     @param priceData - the CommodityPriceData object to save to a CSV file
     '''      
     @staticmethod
     def write_price_data_to_csv( filename , priceData ):
+        start = Instrumentation.start()
         mergedData = PriceReader.get_price_data_from_csv( priceData.get_id() )
         if ( mergedData is None ):
             mergedData = priceData
@@ -271,13 +932,295 @@ class PriceWriter( object ):
                 if ( lastDatapoint.is_before( datapoint ) ):
                     mergedData.append_datapoint( datapoint )
         
+        text = mergedData.get_name() + "\n" + \
+                "".join( [ str( x ) + "\n" for x in mergedData.get_all_datapoints() ] )
         f = open( filename , "w" )
-        f.write( mergedData.get_name() + "\n" )
-        for datapoint in mergedData.get_all_datapoints():
-            f.write( str( datapoint ) + "\n" )
+        f.write( text )
+        f.close()
+        if ( os.path.abspath( filename ) == \
+                os.path.abspath( PriceStore.get_csv_filename( priceData.get_id() ) ) ):
+            FeatureStore.replace( mergedData )
+        Instrumentation.stop( "writer.csv" , start , len( text ) )
+        
+    '''
+    Appends some price data to a CSV file. Only the last line of the file is
+    read, to find the most recent datapoint already stored, and only the
+    datapoints that come after it are appended. The rest of the file is never
+    read or rewritten, so the cost of an update depends on the number of new
+    days rather than on the length of the history. If the file does not
+    exist yet, all the price data is written to it.
+    
+    Blank lines at the end of the file are removed before appending. A last
+    row that cannot be parsed, such as one that was cut short by a crash
+    while appending, is removed as well, and the row before it is used as
+    the most recent datapoint instead, so the history is never written
+    twice.
+    
+    @param filename - the file to which to write price data
+    @param priceData - the CommodityPriceData object to save to a CSV file
+    @return - the number of datapoints that were appended
+    '''
+    @staticmethod
+    def append_price_data_to_csv( filename , priceData ):
+        start = Instrumentation.start()
+        lastLine = PriceReader.read_last_line( filename )
+        if ( lastLine is None ):
+            text = priceData.get_name() + "\n" + \
+                    "".join( [ str( x ) + "\n" for x in priceData.get_all_datapoints() ] )
+            f = open( filename , "w" )
+            f.write( text )
+            f.close()
+            Instrumentation.stop( "writer.append_csv" , start , len( text ) )
+            return priceData.get_num_datapoints()
+        
+        line , lineStart , lineEnd = lastLine
+        
+        #drop rows that cannot be parsed from the end of the file. if the
+        #file only has the name of the commodity, then every datapoint is new
+        lastDatapoint = None
+        while ( lineStart > 0 ):
+            lastDatapoint = PriceReader.parse_csv_line( line )
+            if ( lastDatapoint is not None ):
+                break
+            f = open( filename , "r+b" )
+            f.truncate( lineStart )
+            f.close()
+            line , lineStart , lineEnd = PriceReader.read_last_line( filename )
+        if ( lastDatapoint is not None ):
+            newDatapoints = [ x for x in priceData.get_all_datapoints() \
+                                if lastDatapoint.is_before( x ) ]
+        else:
+            newDatapoints = priceData.get_all_datapoints()
+        
+        if ( len( newDatapoints ) == 0 ):
+            Instrumentation.stop( "writer.append_csv" , start )
+            return 0
+        
+        #unless the last line is followed by exactly one newline, the file
+        #is cut at the end of the last line and a newline is written first
+        text = "".join( [ str( x ) + "\n" for x in newDatapoints ] )
+        f = open( filename , "r+b" )
+        f.seek( 0 , os.SEEK_END )
+        size = f.tell()
+        f.seek( lineEnd )
+        if ( size != lineEnd + 1 or f.read( 1 ) != "\n" ):
+            f.truncate( lineEnd )
+            text = "\n" + text
+        f.seek( 0 , os.SEEK_END )
+        f.write( text )
         f.close()
+        Instrumentation.stop( "writer.append_csv" , start , len( text ) )
+        return len( newDatapoints )
+
+'''
+Saves the month data of a commodity from a worker process, so that main()
+can check that processes saving the same month do not lose each other's
+updates.
+
+@param item - a (priceData, batch) tuple. If batch is True, the data is
+saved with PriceWriter.save_month_data_batch(), and otherwise with
+PriceWriter.save_month_data().
+'''
+def _save_month_data( item ):
+    priceData , batch = item
+    if ( batch ):
+        PriceWriter.save_month_data_batch( [ priceData ] )
+    else:
+        PriceWriter.save_month_data( priceData )
     
 def main():
+    import shutil
+    import tempfile
+    
+    #appending only writes datapoints that are newer than the last one stored,
+    #and instrumentation counts every byte that is read and written
+    tmpDir = tempfile.mkdtemp()
+    Instrumentation.enabled = True
+    try:
+        filename = tmpDir + "/447.csv"
+        history = PriceReader.get_price_data_from_csv( 447 )
+        oldData = CommodityPriceData( 447 , history.get_name() , \
+                                      history.get_all_datapoints()[ 0:300 ] )
+        assert PriceWriter.append_price_data_to_csv( filename , oldData ) == 300
+        newData = CommodityPriceData( 447 , history.get_name() , \
+                                      history.get_all_datapoints()[ 290: ] )
+        assert PriceWriter.append_price_data_to_csv( filename , newData ) == \
+                history.get_num_datapoints() - 300
+        assert PriceWriter.append_price_data_to_csv( filename , newData ) == 0
+        assert open( filename ).read() == open( "price_data/master_list/447.csv" ).read()
+        lastLine = str( history.get_data_at( history.get_num_datapoints()-1 ) )
+        assert PriceReader.read_last_line( filename ) == \
+                (lastLine , os.path.getsize( filename ) - len( lastLine ) - 1 , \
+                 os.path.getsize( filename ) - 1)
+        
+        report = Instrumentation.get_report()
+        Instrumentation.reset()
+        assert report[ "reader.csv" ][ "count" ] == 1
+        assert report[ "reader.csv" ][ "bytes" ] == os.path.getsize( filename )
+        assert report[ "writer.append_csv" ][ "count" ] == 3
+        assert report[ "writer.append_csv" ][ "bytes" ] == os.path.getsize( filename )
+        
+        #blank lines at the end of the file and a last row that was cut short
+        #are removed instead of making the whole batch be appended again
+        text = open( filename ).read()
+        lines = text.splitlines( True )
+        lastData = CommodityPriceData( 447 , history.get_name() , \
+                                       history.get_all_datapoints()[ -5: ] )
+        for head , expected in [ (text + "\n\n" , 0) , \
+                                 ("".join( lines[ 0:-5 ] ) + "\r\n \n\n" , 5) , \
+                                 ("".join( lines[ 0:-5 ] ) + lines[ -5 ].rsplit( "," , 1 )[ 0 ][ 0:-1 ] , 5) , \
+                                 ("".join( lines[ 0:-5 ] ) + "2016,01,x,1,2,3\n\n" , 5) , \
+                                 (lines[ 0 ] + "\n\n" , 5) ]:
+            f = open( filename , "w" )
+            f.write( head )
+            f.close()
+            assert PriceWriter.append_price_data_to_csv( filename , lastData ) == expected
+            result = open( filename ).read()
+            if ( head == lines[ 0 ] + "\n\n" ):
+                assert result == lines[ 0 ] + "".join( lines[ -5: ] )
+            else:
+                assert result.rstrip() == text.rstrip()
+    finally:
+        Instrumentation.enabled = False
+        Instrumentation.reset()
+        shutil.rmtree( tmpDir )
+    
+    #the vectorized parser matches parsing line by line
+    for commodityId in [ 2 , 447 , 1038 ]:
+        f = open( "price_data/master_list/" + str( commodityId ) + ".csv" )
+        name = f.readline()[ 0:-1 ]
+        expected = CommodityPriceData( commodityId , name , \
+                        [ DataPoint.from_csv_data( line ) for line in f ] )
+        f.close()
+        assert PriceReader.get_price_data_from_csv( commodityId ) == expected
+    parsed = PriceReader.get_price_data_from_csvs( [ 2 , 447 , 1038 , -1 ] , processes=2 )
+    assert parsed[ -1 ] is None
+    assert parsed[ 447 ] == PriceReader.get_price_data_from_csv( 447 )
+    
+    #files that the vectorized parser cannot read all the way through are
+    #parsed line by line instead of being cut short
+    text = open( "price_data/master_list/447.csv" ).read()
+    lines = text.splitlines( True )
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp()
+    try:
+        os.chdir( tmpDir )
+        os.makedirs( "price_data/master_list" )
+        for variant in [ text.replace( "\n" , "\r\n" ) , \
+                         "".join( lines[ 0:10 ] ) + "\n" + "".join( lines[ 10: ] ) , \
+                         text + "\n\n" ]:
+            f = open( "price_data/master_list/447.csv" , "w" )
+            f.write( variant )
+            f.close()
+            assert PriceReader.get_price_data_from_csv( 447 ) == parsed[ 447 ]
+            assert PriceReader.get_price_data_from_csv( 447 ).get_name() == "Mithril ore"
+        for variant in [ "".join( lines[ 0:10 ] ) + "2016,1,1,5\n" + "".join( lines[ 10: ] ) , \
+                         "".join( lines[ 0:10 ] ) + "2016,1,x,5,5,5\n" + "".join( lines[ 10: ] ) ]:
+            f = open( "price_data/master_list/447.csv" , "w" )
+            f.write( variant )
+            f.close()
+            try:
+                PriceReader.get_price_data_from_csv( 447 )
+                assert False
+            except ValueError:
+                pass
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( tmpDir )
+    
+    assert PriceReader.get_last_datapoint_from_csv( 447 ) == \
+            DataPoint( "2016" , "01" , "08" , 252 , 295 , 422970 )
+    
+    itemIds = PriceReader.read_item_ids()
+    assert 447 in itemIds and len( set( itemIds ) ) == len( itemIds )
+    
+    #month data is merged into one partition file per month, and volumes
+    #already on disk survive json data that has no volume
+    items = [ PriceReader.get_price_data_from_csv( x ) for x in [ 2 , 447 ] ]
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp()
+    try:
+        os.chdir( tmpDir )
+        PriceWriter.save_month_data_batch( items )
+        assert len( os.listdir( "price_data" ) ) == 11
+        assert PriceReader.read_month_data( 1 , 2016 , "Mithril ore" ).get( 8 ) == \
+                DataPoint( 2016 , 1 , "08" , 252 , 295 , 422970 )
+        
+        jsonData = CommodityPriceData( 447 , "Mithril ore" , \
+                    [ DataPoint( "2016" , "01" , "08" , 260 , 296 ) , \
+                      DataPoint( "2016" , "01" , "09" , 261 , 297 ) ] )
+        PriceWriter.save_month_data( jsonData )
+        partition = PriceReader.read_month_partition( 1 , 2016 )
+        assert sorted( partition.keys() ) == [ "Cannonball" , "Mithril ore" ]
+        assert partition[ "Mithril ore" ].get( 8 ).str_without_date() == "260,296,422970"
+        assert partition[ "Mithril ore" ].get( 9 ).str_without_date() == "261,297,0"
+        assert partition[ "Cannonball" ].get( 8 ).str_without_date() == "233,230,6100759"
+        
+        #single commodities are read through the partition's index, which
+        #is rebuilt whenever the partition file changes
+        for name in partition:
+            for day in range( 1 , 32 ):
+                assert PriceReader.read_month_data( 1 , 2016 , name ).get( day ) == \
+                        partition[ name ].get( day )
+        assert PriceReader.read_month_data( 1 , 2016 , "Mithril" ).get( 8 ).get_price() == 0
+        
+        #a single save appends only the days that changed, without rewriting
+        #the partition, and keeps the partition's index up to date
+        filename = "price_data/2016 01/partition.csv"
+        info = os.stat( filename )
+        PriceWriter.save_month_data( jsonData )
+        assert os.path.getsize( filename ) == info.st_size
+        PriceWriter.save_month_data( CommodityPriceData( 447 , "Mithril ore" , \
+                    [ DataPoint( "2016" , "01" , "09" , 262 , 297 ) ] ) )
+        assert os.stat( filename ).st_ino == info.st_ino
+        assert os.path.getsize( filename ) == info.st_size + len( "Mithril ore,09,262,297,0\n" )
+        assert PriceReader.read_month_data( 1 , 2016 , "Mithril ore" ).get( 9 ).str_without_date() == "262,297,0"
+        assert PriceReader.read_month_partition( 1 , 2016 )[ "Mithril ore" ].get( 9 ).str_without_date() == "262,297,0"
+        index = PriceReader.partitionIndexes[ filename ][ 3 ]
+        del PriceReader.partitionIndexes[ filename ]
+        assert PriceReader.get_partition_index( open( filename , "r" ) ) == index
+        f = open( "price_data/2016 01/partition.csv" , "w" )
+        f.write( "Mithril ore,08,1,2,3\nCannonball,08,4,5,6\nMithril ore,09,7,8,9\n" )
+        f.close()
+        assert PriceReader.read_month_data( 1 , 2016 , "Mithril ore" ).get( 9 ).str_without_date() == "7,8,9"
+        assert PriceReader.read_month_data( 1 , 2016 , "Mithril ore" ).get( 8 ).str_without_date() == "1,2,3"
+        assert PriceReader.read_month_data( 1 , 2016 , "Cannonball" ).get( 8 ).str_without_date() == "4,5,6"
+        
+        #files for single commodities from before partition files were used
+        #are moved into the partition files
+        old = MonthData( 1 , 2016 )
+        old.set( 3 , DataPoint( 2016 , 1 , "03" , 10 , 11 , 12 ) )
+        PriceWriter.write_month_data_to_file( old , "Old item" )
+        old = MonthData( 2 , 2016 )
+        old.set( 4 , DataPoint( 2016 , 2 , "04" , 13 , 14 , 15 ) )
+        PriceWriter.write_month_data_to_file( old , "Old item" )
+        PriceWriter.save_month_data( jsonData )
+        assert not os.path.exists( "price_data/2016 01/Old item.csv" )
+        assert os.path.exists( "price_data/2016 02/Old item.csv" )
+        assert PriceWriter.migrate_month_files() == 1
+        assert os.listdir( "price_data/2016 02" ) == [ "partition.csv" ]
+        assert PriceReader.read_month_partition( 1 , 2016 )[ "Old item" ].get( 3 ).str_without_date() == "10,11,12"
+        assert PriceReader.read_month_partition( 2 , 2016 )[ "Old item" ].get( 4 ).str_without_date() == "13,14,15"
+        assert PriceWriter.migrate_month_files() == 0
+        
+        #processes that save the same month at the same time do not lose
+        #each other's updates
+        items = [ (CommodityPriceData( x , "Item " + str( x ) , [ DataPoint( 2016 , 3 , day , x , day , 0 ) \
+                    for day in range( 1 , 32 ) ] ) , x % 2 == 0) for x in range( 0 , 16 ) ]
+        pool = multiprocessing.Pool( 4 )
+        try:
+            pool.map( _save_month_data , items , 1 )
+        finally:
+            pool.close()
+            pool.join()
+        partition = PriceReader.read_month_partition( 3 , 2016 )
+        assert sorted( partition.keys() ) == sorted( [ "Item " + str( x ) for x in range( 0 , 16 ) ] )
+        for x in range( 0 , 16 ):
+            assert partition[ "Item " + str( x ) ].get( 31 ).str_without_date() == str( x ) + ",31,0"
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( tmpDir )
+    
     test = MonthData( 2 , 2012 )
     assert len( test.data ) == 30
     test = MonthData( 2 , 2013 )
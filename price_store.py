@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+from date_utils import DateUtils
+
+'''
+Stores the price data of commodities in a binary columnar format that can be
+memory-mapped with NumPy, so that reading price data does not require any
+text parsing.
+
+There is one file per commodity, stored as price_data/binary_list/<id>.bin.
+Every value is little-endian and the file is laid out as follows:
+
+* a 48 byte header: the magic string "GEPS", the format version (uint32),
+the commodity ID (int64), the number of datapoints n (int64), the length of
+the commodity name in bytes (uint32), 4 bytes of padding, and the size
+(int64) and modification time (float64) of the CSV file the data was
+converted from, or -1 and 0 if it was not converted from a CSV file
+* the name of the commodity, padded with zeros to a multiple of 8 bytes
+* the date of each datapoint as a day ordinal (n x int32), padded with zeros
+to a multiple of 8 bytes
+* the daily prices (n x int64)
+* the average 180-day prices (n x int64)
+* the trade volumes (n x int64)
+'''
+class PriceStore( object ):
+
+    '''
+    The folder in which binary price data is stored
+    '''
+    DIRECTORY = "price_data/binary_list"
+
+    '''
+    The folder with the CSV files from which binary price data is converted
+    '''
+    CSV_DIRECTORY = "price_data/master_list"
+
+    MAGIC = "GEPS"
+    VERSION = 2
+
+    HEADER = np.dtype( [ ("magic" , "S4") , ("version" , "<u4") , \
+                         ("id" , "<i8") , ("count" , "<i8") , \
+                         ("nameLength" , "<u4") , ("padding" , "<u4") , \
+                         ("csvSize" , "<i8") , ("csvMtime" , "<f8") ] )
+    DATE_TYPE = np.dtype( "<i4" )
+    VALUE_TYPE = np.dtype( "<i8" )
+
+    '''
+    Rounds a number of bytes up to the next multiple of 8 so that every
+    column in the file stays aligned.
+    '''
+    @staticmethod
+    def _align( numBytes ):
+        return (numBytes + 7) // 8 * 8
+
+    '''
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the name of the binary file that stores the given commodity's
+    price data
+    '''
+    @staticmethod
+    def get_filename( commodityId ):
+        return PriceStore.DIRECTORY + "/" + str( commodityId ) + ".bin"
+
+    '''
+    @param commodityId - the ID of a commodity, as an integer
+    @return - the name of the CSV file in the master list that stores the
+    given commodity's price data
+    '''
+    @staticmethod
+    def get_csv_filename( commodityId ):
+        return PriceStore.CSV_DIRECTORY + "/" + str( commodityId ) + ".csv"
+
+    '''
+    @return - the IDs of all the commodities that have a CSV file in the
+    master list, as a list of integers
+    '''
+    @staticmethod
+    def get_csv_ids():
+        return [ int( x[ 0:-4 ] ) for x in os.listdir( PriceStore.CSV_DIRECTORY ) \
+                    if x.endswith( ".csv" ) ]
+
+    '''
+    @param commodityId - the ID of a commodity, as an integer
+    @return - a (size, modification time) tuple for the commodity's CSV file
+    in the master list, or None if it has no CSV file
+    '''
+    @staticmethod
+    def get_csv_signature( commodityId ):
+        try:
+            stat = os.stat( PriceStore.get_csv_filename( commodityId ) )
+        except OSError:
+            return None
+        return (stat.st_size , stat.st_mtime)
+
+    '''
+    Determines if the binary file for a commodity exists and was converted
+    from the current version of its CSV file in the master list, by
+    comparing the size and modification time of the CSV file with the ones
+    stored in the binary file's header. Comparing the modification times of
+    the two files instead would not notice a CSV file that changed within
+    the same clock tick as the binary file was written.
+
+    @param commodityId - the ID of a commodity, as an integer
+    @return - True if the binary data for the commodity can be used
+    '''
+    @staticmethod
+    def is_current( commodityId ):
+        try:
+            f = open( PriceStore.get_filename( commodityId ) , "rb" )
+            data = f.read( PriceStore.HEADER.itemsize )
+            f.close()
+        except IOError:
+            return False
+        if ( len( data ) < PriceStore.HEADER.itemsize ):
+            return False
+        header = np.frombuffer( data , dtype=PriceStore.HEADER )[ 0 ]
+        if ( header[ "magic" ] != PriceStore.MAGIC or \
+                header[ "version" ] != PriceStore.VERSION ):
+            return False
+        signature = PriceStore.get_csv_signature( commodityId )
+        if ( signature is None ):
+            return True
+        return (int( header[ "csvSize" ] ) , float( header[ "csvMtime" ] )) == signature
+
+    '''
+    Writes the columns of price data for a commodity to its binary file.
+    The file is written to a temporary file first and then renamed so that
+    readers never see a partially written file.
+
+    @param commodityId - the ID of the commodity, as an integer
+    @param name - the name of the commodity, as a string
+    @param dates - the day ordinal of each datapoint
+    @param daily - the daily price of each datapoint
+    @param average - the average 180-day price of each datapoint
+    @param volume - the trade volume of each datapoint
+    @param csvSignature - the get_csv_signature() of the CSV file the data
+    was read from, if any
+    '''
+    @staticmethod
+    def write_columns( commodityId , name , dates , daily , average , volume , csvSignature=None ):
+        count = len( dates )
+        header = np.zeros( 1 , dtype=PriceStore.HEADER )
+        header[ "magic" ] = PriceStore.MAGIC
+        header[ "version" ] = PriceStore.VERSION
+        header[ "id" ] = commodityId
+        header[ "count" ] = count
+        header[ "nameLength" ] = len( name )
+        header[ "csvSize" ] , header[ "csvMtime" ] = csvSignature if csvSignature is not None \
+                                                    else (-1 , 0.0)
+
+        dateBytes = np.asarray( dates , dtype=PriceStore.DATE_TYPE ).tostring()
+        nameBytes = name
+
+        filename = PriceStore.get_filename( commodityId )
+        if ( not os.path.exists( PriceStore.DIRECTORY ) ):
+            os.makedirs( PriceStore.DIRECTORY )
+
+        tmpFilename = filename + ".tmp"
+        f = open( tmpFilename , "wb" )
+        f.write( header.tostring() )
+        f.write( nameBytes.ljust( PriceStore._align( len( nameBytes ) ) , "\0" ) )
+        f.write( dateBytes.ljust( PriceStore._align( len( dateBytes ) ) , "\0" ) )
+        for column in (daily , average , volume):
+            f.write( np.asarray( column , dtype=PriceStore.VALUE_TYPE ).tostring() )
+        f.close()
+        os.rename( tmpFilename , filename )
+
+    '''
+    Writes the price data in a CommodityPriceData object to its binary file.
+
+    @param priceData - the CommodityPriceData object to store
+    @param csvSignature - see write_columns()
+    '''
+    @staticmethod
+    def write_price_data( priceData , csvSignature=None ):
+        datapoints = priceData.get_all_datapoints()
+        dates = [ DateUtils.to_ordinal( x.get_year() , x.get_month() , x.get_day() ) \
+                    for x in datapoints ]
+        daily = [ x.get_price() for x in datapoints ]
+        average = [ x.get_average180_price() for x in datapoints ]
+        volume = [ x.get_volume() for x in datapoints ]
+        PriceStore.write_columns( priceData.get_id() , priceData.get_name() , \
+                    dates , daily , average , volume , csvSignature )
+
+    '''
+    Memory-maps the binary file of a commodity. No data is copied: the
+    returned arrays are read-only views into the file.
+
+    @param commodityId - the ID of a commodity, as an integer
+    @return - a (name, dates, daily, average, volume) tuple, where dates
+    is an array of day ordinals and the others are arrays of integers, or
+    None if there is no binary file for the commodity
+    '''
+    @staticmethod
+    def read_columns( commodityId ):
+        filename = PriceStore.get_filename( commodityId )
+        try:
+            buf = np.memmap( filename , dtype=np.uint8 , mode="r" )
+        except (IOError , OSError , ValueError):
+            return None
+
+        header = buf[ 0:PriceStore.HEADER.itemsize ].view( PriceStore.HEADER )[ 0 ]
+        if ( header[ "magic" ] != PriceStore.MAGIC or \
+                header[ "version" ] != PriceStore.VERSION ):
+            raise ValueError( filename + " is not a binary price data file." )
+        count = int( header[ "count" ] )
+        nameLength = int( header[ "nameLength" ] )
+
+        offset = PriceStore.HEADER.itemsize
+        name = buf[ offset:offset+nameLength ].tostring()
+        offset += PriceStore._align( nameLength )
+
+        dateBytes = count*PriceStore.DATE_TYPE.itemsize
+        dates = buf[ offset:offset+dateBytes ].view( PriceStore.DATE_TYPE )
+        offset += PriceStore._align( dateBytes )
+
+        columns = []
+        valueBytes = count*PriceStore.VALUE_TYPE.itemsize
+        for i in range( 0 , 3 ):
+            columns.append( buf[ offset:offset+valueBytes ].view( PriceStore.VALUE_TYPE ) )
+            offset += valueBytes
+
+        return (name , dates , columns[ 0 ] , columns[ 1 ] , columns[ 2 ])
+
+    '''
+    Converts the CSV files in price_data/master_list to binary files. Files
+    whose binary data is already current are skipped.
+
+    @param commodityIds - the IDs of the commodities to convert, as a list of
+    integers. If None, every CSV file in the master list is converted.
+    @return - the number of files that were converted
+    '''
+    @staticmethod
+    def convert_master_list( commodityIds=None ):
+        from price_data_io import PriceReader
+        if ( commodityIds is None ):
+            commodityIds = PriceStore.get_csv_ids()
+        converted = 0
+        for commodityId in commodityIds:
+            if ( PriceStore.is_current( commodityId ) ):
+                continue
+            
+            #the CSV file is looked at before it is read, so if it changes
+            #while it is read, the binary file will not be current
+            signature = PriceStore.get_csv_signature( commodityId )
+            priceData = PriceReader.get_price_data_from_csv( commodityId )
+            if ( priceData is not None ):
+                PriceStore.write_price_data( priceData , signature )
+                converted += 1
+        return converted
+
+def main():
+    
+    #use the same PriceStore class as PriceReader does, rather than the one
+    #in this __main__ module, so that both see the scratch directory
+    from price_data_io import PriceReader , PriceStore
+    import shutil
+    import tempfile
+
+    #convert a few commodities into a scratch directory and make sure the
+    #fast path gives back exactly what the CSV files have
+    defaultDirectory = PriceStore.DIRECTORY
+    PriceStore.DIRECTORY = tempfile.mkdtemp()
+    try:
+        assert PriceStore.read_columns( 447 ) is None
+        assert PriceStore.convert_master_list( [ 2 , 447 , 1038 ] ) == 3
+        assert PriceStore.convert_master_list( [ 2 , 447 , 1038 ] ) == 0
+        for commodityId in [ 2 , 447 , 1038 ]:
+            fromCSV = PriceReader.get_price_data_from_csv( commodityId )
+            fromBinary = PriceReader.get_price_data_from_binary( commodityId )
+            assert fromCSV == fromBinary
+
+        name , dates , daily , average , volume = PriceStore.read_columns( 447 )
+        assert name == "Mithril ore"
+        assert DateUtils.from_ordinal( dates[ 0 ] ) == (2015 , 3 , 1)
+        assert daily[ 0 ] == 343 and average[ 0 ] == 258 and volume[ -1 ] == 422970
+
+        #a CSV file that changes is noticed even if its modification time
+        #is no later than the binary file's
+        cwd = os.getcwd()
+        tmpDir = tempfile.mkdtemp()
+        try:
+            os.makedirs( tmpDir + "/" + PriceStore.CSV_DIRECTORY )
+            shutil.copy( PriceStore.get_csv_filename( 447 ) , \
+                         tmpDir + "/" + PriceStore.get_csv_filename( 447 ) )
+            os.chdir( tmpDir )
+            csvFilename = PriceStore.get_csv_filename( 447 )
+            assert not PriceStore.is_current( 447 )
+            assert PriceStore.convert_master_list( [ 447 ] ) == 1
+            assert PriceStore.is_current( 447 )
+            binaryTime = os.path.getmtime( PriceStore.get_filename( 447 ) )
+            f = open( csvFilename , "a" )
+            f.write( "2016,1,9,253,295,1000\n" )
+            f.close()
+            os.utime( csvFilename , (binaryTime , binaryTime) )
+            assert not PriceStore.is_current( 447 )
+            assert PriceStore.convert_master_list( [ 447 ] ) == 1
+            assert PriceStore.read_columns( 447 )[ 1 ][ -1 ] == DateUtils.to_ordinal( 2016 , 1 , 9 )
+            os.utime( csvFilename , (binaryTime - 10 , binaryTime - 10) )
+            assert not PriceStore.is_current( 447 )
+        finally:
+            os.chdir( cwd )
+            shutil.rmtree( tmpDir )
+    finally:
+        shutil.rmtree( PriceStore.DIRECTORY )
+        PriceStore.DIRECTORY = defaultDirectory
+
+    print "Regression testing for price_store.py passed."
+
+if __name__ == "__main__" : main()
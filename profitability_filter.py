@@ -2,7 +2,13 @@
 
 from data_manager import DataManager
 from price_data_io import PriceReader
+from feature_store import FeatureStore
+from instrumentation import Instrumentation
+import heapq
+import multiprocessing
 import numpy as np
+import os
+import time
 
 
 '''
@@ -31,6 +37,190 @@ class ProfitabilityRanker( object ):
         maxQty = min( averageVolume , int( totalFunds/currentPrice ) )
         return maxQty*averagePriceChange
        
+    '''
+    Finds the maximum of every window of the given width in a series, where
+    the window starting at the end of the series is cut off by the end of
+    the series.
+    
+    This uses the van Herk/Gil-Werman algorithm, which takes linear time no
+    matter how wide the windows are. The series is split into blocks of the
+    window width, and every window covers the end of one block and the start
+    of the next, so its maximum is the larger of a running maximum from the
+    right in the first block and a running maximum from the left in the next.
+    Both running maximums are computed for all blocks at once with NumPy.
+    
+    @param values - the series, as a 1-D array
+    @param width - the width of the windows, as a positive integer
+    @return - an array with the maximum of values[i:i+width] at index i
+    '''
+    @staticmethod
+    def _sliding_window_max( values , width ):
+        n = values.size
+        
+        #pad the end with the smallest value there is, so that it never
+        #wins over the values in a window that is cut off
+        if ( values.dtype.kind in "iu" ):
+            smallest = np.iinfo( values.dtype ).min
+        else:
+            smallest = -np.inf
+        numBlocks = (n + width - 1)//width + 1
+        padded = np.full( numBlocks*width , smallest , dtype=values.dtype )
+        padded[ 0:n ] = values
+        blocks = padded.reshape( numBlocks , width )
+        
+        fromLeft = np.maximum.accumulate( blocks , axis=1 ).ravel()
+        fromRight = np.maximum.accumulate( blocks[ : , ::-1 ] , axis=1 )[ : , ::-1 ].ravel()
+        return np.maximum( fromRight[ 0:n ] , fromLeft[ width-1:width-1+n ] )
+    
+    '''
+    Adds up the best profit we could make by buying on each day and selling
+    on the best day within the given duration, counting only the days on
+    which there is a profit to be made.
+    
+    @param prices - the daily prices of a commodity, as an array
+    @param duration - how long the money will be invested for at maximum,
+                      as an integer number of days
+    @return - a (profitSum, daysOfProfit) tuple with the sum of the best
+              profits and the number of days on which a profit can be made
+    '''
+    @staticmethod
+    def _sum_best_profits( prices , duration ):
+        bestProfits = ProfitabilityRanker._sliding_window_max( prices , duration ) - prices
+        bestProfits = bestProfits[ bestProfits > 0 ]
+        if ( bestProfits.size == 0 ):
+            return (0 , 0)
+        return (np.sum( bestProfits ) , bestProfits.size)
+       
+    '''
+    @param features - the stored features of a commodity, or None
+    @param data - the price data for the same commodity
+    @return - whether the features were computed from every datapoint of
+              data, and so can be used in place of it
+    '''
+    @staticmethod
+    def _covers( features , data ):
+        return features is not None and features[ "count" ] == data.get_num_datapoints()
+    
+    '''
+    Counts how many times the trend of the average price of a commodity
+    reversed over the last 180 days. A commodity whose trend changes enough
+    is likely to be profitable to trade on.
+    
+    @param data - the price data for a given commodity
+    @param features - the stored features of the commodity, or None. They
+                      are only used if they cover every datapoint of data.
+    @return - the number of trend reversals
+    '''
+    @staticmethod
+    def _count_trend_changes( data , features=None ):
+        if ( ProfitabilityRanker._covers( features , data ) ):
+            return features[ "trendChanges" ]
+        return FeatureStore.count_trend_changes( data.averages() )
+    
+    '''
+    @param data - the price data for a given commodity
+    @param features - the stored features of the commodity, or None. They
+                      are only used if they cover every datapoint of data.
+    @return - half the average trade volume of the commodity, which is how
+              much of it we expect to be able to buy
+    '''
+    @staticmethod
+    def _get_average_volume( data , features=None ):
+        if ( ProfitabilityRanker._covers( features , data ) ):
+            volumeCount = int( features[ "volumeCount" ] )
+            return features[ "volumeSum" ]/float( volumeCount )/2 if volumeCount > 0 else 0
+        
+        #we exclude 0 volume datapoints because for some time, the
+        #price database did not record volumes and they were reported
+        #as 0. We don't want this to affect average volume
+        volumes = data.volumes()
+        volumes = volumes[ volumes != 0 ]
+        return np.mean( volumes )/2 if volumes.size > 0 else 0
+    
+    '''
+    Builds a sparse table for answering range maximum queries over a series
+    in constant time. Level k of the table holds the maximum of every run of
+    2^k values, cut off by the end of the series, so the maximum of any
+    window is the larger of two overlapping runs from the same level.
+    
+    @param values - the series, as a 1-D array
+    @param maxWidth - the widest window that will be queried
+    @return - a list of arrays, where level k has the maximum of
+              values[i:i+2^k] at index i
+    '''
+    @staticmethod
+    def _build_range_max_table( values , maxWidth ):
+        n = values.size
+        table = [ values ]
+        width = 1
+        
+        #once a run covers the whole series, wider runs are all the same
+        while ( width*2 <= maxWidth and width < n ):
+            previous = table[ -1 ]
+            nextStart = np.minimum( np.arange( width , n + width ) , n-1 )
+            table.append( np.maximum( previous , previous[ nextStart ] ) )
+            width *= 2
+        return table
+    
+    '''
+    Finds the maximum of every window of the given width in a series, where
+    the window starting at the end of the series is cut off by the end of
+    the series, using a table from _build_range_max_table().
+    
+    @param table - the range maximum table of the series
+    @param width - the width of the windows, as a positive integer no wider
+                   than the table was built for
+    @return - an array with the maximum of values[i:i+width] at index i
+    '''
+    @staticmethod
+    def _query_range_max( table , width ):
+        n = table[ 0 ].size
+        level = min( int( np.log2( width ) ) , len( table )-1 )
+        
+        #the second run ends where the window ends, or at the end of the
+        #series if the window is cut off
+        secondStart = np.minimum( np.arange( width - 2**level , n + width - 2**level ) , n-1 )
+        return np.maximum( table[ level ] , table[ level ][ secondStart ] )
+    
+    '''
+    Calculates the expected profitability of an item for many amounts of
+    funds and investment durations at once. The item's trend reversals,
+    average volume and a range maximum table of its prices are computed
+    once and shared by every combination, so this is much faster than
+    calling get_item_profitability() for every combination.
+    
+    @param data - the price data for a given commodity
+    @param fundsList - the amounts of money to be invested, as a list
+    @param durations - how long the money will be invested for at maximum,
+                       as a list of integer numbers of days
+    @return - a len(fundsList) by len(durations) array, where the value at
+              [i, j] is get_item_profitability( data , fundsList[ i ] ,
+              durations[ j ] )
+    @param features - the stored features of the commodity, if they were
+                      already read, to avoid going over the whole series
+    '''
+    @staticmethod
+    def get_profitability_sweep( data , fundsList , durations , features=None ):
+        start = Instrumentation.start()
+        scores = np.zeros( ( len( fundsList ) , len( durations ) ) )
+        if ( ProfitabilityRanker._count_trend_changes( data , features ) <= 5 ):
+            Instrumentation.stop( "ranker.sweep" , start )
+            return scores
+        
+        averageVolume = ProfitabilityRanker._get_average_volume( data , features )
+        prices = data.prices()
+        table = ProfitabilityRanker._build_range_max_table( prices , max( durations ) )
+        for j , duration in enumerate( durations ):
+            bestProfits = ProfitabilityRanker._query_range_max( table , duration ) - prices
+            bestProfits = bestProfits[ bestProfits > 0 ]
+            profitSum = np.sum( bestProfits ) if bestProfits.size > 0 else 0
+            averagePriceChange = profitSum / bestProfits.size if profitSum != 0 else 0
+            for i , totalFunds in enumerate( fundsList ):
+                scores[ i , j ] = ProfitabilityRanker.__calculate_expected_profit__( \
+                            averageVolume , totalFunds , prices[-1] , averagePriceChange )
+        Instrumentation.stop( "ranker.sweep" , start )
+        return scores
+    
     '''
     Calculates the expected item profitability if we invest in this
     item optimally during the given time frame.
@@ -42,96 +232,420 @@ class ProfitabilityRanker( object ):
     @return - an decimal quantity that is the expected amount of gold
               to be gained if investing optimally in the given commodity
               with the given amount of funds for the given duration
+    @param features - the stored features of the commodity, if they were
+                      already read, to avoid going over the whole series
     '''
     @staticmethod
-    def get_item_profitability( data , totalFunds , duration ):
-        datapoints = data.get_all_datapoints()
-
-        #use the average price data over the last 180 days to
-        #see if a given commodity changes trend enough to be
-        #profitable to trade on
-        averagePrices = []
-        for i in range(len(datapoints)-180 , len(datapoints)):    
-            averagePrices.append( datapoints[ i ].get_average180_price() )
-        averagePrices = np.array( averagePrices )
-        
-        #calculate number of trend reversals in the average price trends
-        differences = np.diff( averagePrices )
-        differences =  differences[ differences != 0 ]
-        isPositive = (differences > 0).astype( int )
-        isNegatve = (differences < 0).astype( int )
-        trends = (isPositive - isNegatve)
-        isTrendChange = (np.abs( np.diff( trends )) == 2)
-        trendChanges = np.sum( isTrendChange )
-
+    def get_item_profitability( data , totalFunds , duration , features=None ):
+        start = Instrumentation.start()
+        
         #if the trend rarely changes, the item probably has 
         #a consistently falling price and we're not going
         #to make any profit off that
-        if ( trendChanges <= 5 ):
+        if ( ProfitabilityRanker._count_trend_changes( data , features ) <= 5 ):
+            Instrumentation.stop( "ranker.item" , start )
             return 0
         
+        averageVolume = ProfitabilityRanker._get_average_volume( data , features )
         
-        #we exclude 0 volume datapoints because for some time, the
-        #price database did not record volumes and they were reported
-        #as 0. We don't want this to affect average volume
-        volumes = np.array( [ x.get_volume() for x in datapoints if x.get_volume() != 0 ] )
-        averageVolume = np.mean( volumes )/2 if volumes.size > 0 else 0
-        
-        prices = np.array( [ x.get_price() for x in datapoints ] )
+        prices = data.prices()
         
         #record the maximum profits we could make by starting investment
         #on a given day and clearing it within the specified duration
-        profitSum = 0
-        daysOfProfit = 0
-        for i in range( 0 , prices.size ):
-            window = prices[ i:i+duration ]
-            buyPrice = window[ 0 ]
-            sellPrice = window[ 0 ]
-            for j in range( 0 , len(window) ):
-                if ( sellPrice < window[ j ] ):
-                    sellPrice = window[ j ]
-            bestProfit = sellPrice - buyPrice
-            if ( bestProfit > 0 ):
-                profitSum += bestProfit
-                daysOfProfit += 1
+        profitSum , daysOfProfit = ProfitabilityRanker._sum_best_profits( prices , duration )
                 
         averagePriceChange = profitSum / daysOfProfit if profitSum != 0 else 0
         
-        return ProfitabilityRanker.__calculate_expected_profit__( averageVolume , \
+        rtn = ProfitabilityRanker.__calculate_expected_profit__( averageVolume , \
                                 totalFunds , prices[-1] , averagePriceChange )
+        Instrumentation.stop( "ranker.item" , start )
+        return rtn
         
+    '''
+    The time each worker process spent on the last call to
+    get_profitability_rankings(). Each entry is a dictionary with the
+    process ID of the worker ("pid"), how many chunks ("chunks") and items
+    ("items") it scored, and how many seconds it spent scoring ("seconds").
+    '''
+    workerTimings = []
+    
     '''
     Gets the profitability rankings of all known commodities, sorted in
     descending order by profitability
     
+    The items can be scored in parallel by a pool of worker processes. The
+    items are split into chunks of consecutive items and the chunks are
+    handed out to the workers as they become free, so a slow chunk does not
+    hold up the others. The rankings are the same no matter how many
+    processes are used. How long each worker took is recorded in
+    ProfitabilityRanker.workerTimings, and what the workers recorded with
+    Instrumentation is merged into this process.
+    
     @param totalFunds - the total amount of gold with which to invest
     @param duration - the maximum duration of the investment
+    @param processes - the number of worker processes to use. If None, one
+    process per CPU is used. If 1, the items are scored in this process.
+    @param chunkSize - the number of items in each chunk. If None, there are
+    about 4 chunks per process.
     @return - the profitability rankings
     '''
     @staticmethod
-    def get_profitability_rankings( totalFunds , duration ):
-        f = open( "price_data/item_ids" , 'r' )
+    def get_profitability_rankings( totalFunds , duration , processes=1 , chunkSize=None ):
         rankings = []
-        for line in f.readlines():
-            commodityId = int(line.split( "," )[ 1 ])
-            data = PriceReader.get_price_data_from_csv( commodityId )
-            rankings.append( (data , ProfitabilityRanker.get_item_profitability( data , totalFunds , duration ) ) )
-            
+        for chunkRankings in ProfitabilityRanker._score_chunks( "get_item_profitability" , \
+                                totalFunds , duration , processes , chunkSize , True ):
+            rankings.extend( chunkRankings )
         rankings.sort( key=lambda x: -1*x[1] )
         return rankings
+    
+    '''
+    Scores every known commodity one at a time, without keeping the price
+    data of any commodity once it has been scored. Items are scored in the
+    same way as by get_profitability_rankings(), but they are not sorted.
+    
+    @param totalFunds - see get_profitability_rankings()
+    @param duration - see get_profitability_rankings()
+    @param processes - see get_profitability_rankings()
+    @param chunkSize - see get_profitability_rankings()
+    @return - an iterator over (id, name, profitability) tuples, in the
+    order of price_data/item_ids
+    '''
+    @staticmethod
+    def iterate_profitability( totalFunds , duration , processes=1 , chunkSize=None ):
+        for chunkRankings in ProfitabilityRanker._score_chunks( "get_item_profitability" , \
+                                totalFunds , duration , processes , chunkSize , False ):
+            for ranking in chunkRankings:
+                yield ranking
+    
+    '''
+    Gets the most profitable commodities without keeping every commodity's
+    price data in memory. Only the (id, name, profitability) of each
+    commodity is kept, and if k is given, only the k best of those are kept
+    in a heap while the commodities are being scored.
+    
+    @param totalFunds - see get_profitability_rankings()
+    @param duration - see get_profitability_rankings()
+    @param k - the number of commodities to keep. If None, every commodity
+    is kept.
+    @param processes - see get_profitability_rankings()
+    @param chunkSize - see get_profitability_rankings()
+    @return - a list of (id, name, profitability) tuples, sorted in
+    descending order by profitability. Commodities that are equally
+    profitable are in the same order as in get_profitability_rankings().
+    '''
+    @staticmethod
+    def get_top_rankings( totalFunds , duration , k=None , processes=1 , chunkSize=None ):
+        rankings = ProfitabilityRanker.iterate_profitability( totalFunds , duration , \
+                                                             processes , chunkSize )
+        if ( k is None ):
+            return sorted( rankings , key=lambda x: x[ 2 ] , reverse=True )
+        return heapq.nlargest( k , rankings , key=lambda x: x[ 2 ] )
+    
+    '''
+    Writes the profitability rankings to a file, one "name,id,profitability"
+    line per commodity, most profitable first. See get_top_rankings().
+    
+    Since the file is sorted by profitability, nothing can be written until
+    every commodity has been scored. The commodities are scored as a stream,
+    but if k is None all n of their scores are kept and sorted at the end,
+    which takes O(n log n) time and O(n) memory. With a k, only the best k
+    are kept, in O(n log k) time and O(k) memory.
+    
+    @param totalFunds - see get_profitability_rankings()
+    @param duration - see get_profitability_rankings()
+    @param filename - the file to which to write the rankings
+    @param k - the number of commodities to write. If None, every
+    commodity is written.
+    @param processes - see get_profitability_rankings()
+    @param chunkSize - see get_profitability_rankings()
+    @return - the number of commodities that were written
+    '''
+    @staticmethod
+    def write_rankings( totalFunds , duration , filename="trade_data/item_rankings.csv" , \
+                        k=None , processes=1 , chunkSize=None ):
+        rankings = ProfitabilityRanker.get_top_rankings( totalFunds , duration , k , \
+                                                        processes , chunkSize )
+        
+        #write to a temporary file first, so that the old rankings can still
+        #be read until the new ones are complete
+        f = open( filename + ".tmp" , "w" )
+        for commodityId , name , profitability in rankings:
+            f.write( str( name ) + "," + str( commodityId ) + "," + str( profitability ) + "\n" )
+        f.close()
+        os.rename( filename + ".tmp" , filename )
+        return len( rankings )
+    
+    '''
+    Calculates the expected profitability of every known commodity for many
+    amounts of funds and investment durations, loading each commodity only
+    once. See get_profitability_sweep().
+    
+    @param fundsList - the amounts of money to be invested, as a list
+    @param durations - how long the money will be invested for at maximum,
+                       as a list of integer numbers of days
+    @param processes - see get_profitability_rankings()
+    @param chunkSize - see get_profitability_rankings()
+    @return - an iterator over (id, name, scores) tuples, in the order of
+    price_data/item_ids, where scores is the commodity's score matrix
+    '''
+    @staticmethod
+    def iterate_profitability_sweep( fundsList , durations , processes=1 , chunkSize=None ):
+        for chunkRankings in ProfitabilityRanker._score_chunks( "get_profitability_sweep" , \
+                                fundsList , durations , processes , chunkSize , False ):
+            for ranking in chunkRankings:
+                yield ranking
+    
+    '''
+    Scores every commodity in price_data/item_ids in chunks, either in this
+    process or on a pool of worker processes, and records how long each
+    worker took in ProfitabilityRanker.workerTimings.
+    
+    @param method - the name of the ProfitabilityRanker method that scores
+    an item, which is called with the item's data, funds and duration
+    @param funds - the funds argument of the method
+    @param duration - the duration argument of the method
+    @param keepData - if True, every chunk is a list of (data,
+    profitability) tuples. Otherwise it is a list of (id, name,
+    profitability) tuples.
+    @return - an iterator over the scored chunks, in the order of
+    price_data/item_ids
+    '''
+    @staticmethod
+    def _score_chunks( method , funds , duration , processes , chunkSize , keepData ):
+        f = open( "price_data/item_ids" , 'r' )
+        commodityIds = [ int(line.split( "," )[ 1 ]) for line in f.readlines() ]
+        f.close()
+        
+        if ( processes is None ):
+            processes = multiprocessing.cpu_count()
+        if ( chunkSize is None ):
+            chunkSize = max( 1 , len( commodityIds ) // (4*processes) )
+        chunks = [ (commodityIds[ i:i+chunkSize ] , method , funds , duration , keepData) \
+                    for i in range( 0 , len( commodityIds ) , chunkSize ) ]
+        
+        timings = {}
+        ProfitabilityRanker.workerTimings = []
+        pool = None
+        if ( processes <= 1 ):
+            results = ( _rank_chunk( x ) for x in chunks )
+        else:
+            pool = multiprocessing.Pool( processes , _init_rank_worker )
+            results = pool.imap( _rank_chunk , chunks , 1 )
         
+        #chunks come back in the order they were handed out, so the items
+        #are in the same order as in item_ids
+        try:
+            for pid , seconds , chunkRankings , operations in results:
+                Instrumentation.merge( operations )
+                timing = timings.setdefault( pid , { "pid" : pid , "chunks" : 0 , \
+                                                     "items" : 0 , "seconds" : 0.0 } )
+                timing[ "chunks" ] += 1
+                timing[ "items" ] += len( chunkRankings )
+                timing[ "seconds" ] += seconds
+                ProfitabilityRanker.workerTimings = sorted( timings.values() , \
+                                                            key=lambda x : x[ "pid" ] )
+                yield chunkRankings
+        finally:
+            if ( pool is not None ):
+                pool.close()
+                pool.join()
+        
+'''
+Initializer for the worker processes of ProfitabilityRanker. A worker that
+was forked starts with a copy of what this process had recorded with
+Instrumentation, which must not be sent back and counted again.
+'''
+def _init_rank_worker():
+    Instrumentation.reset()
+
+'''
+Worker function for ProfitabilityRanker.get_profitability_rankings. Worker
+processes can only be given module-level functions.
+
+@param chunk - a (commodityIds, method, funds, duration, keepData) tuple
+@return - a (pid, seconds, rankings, operations) tuple with the ID of the
+process that scored the chunk, how long it took, the rankings of the items
+in the chunk: (data, profitability) if keepData is True, or (id, name,
+profitability) otherwise, and what the chunk recorded with Instrumentation,
+see Instrumentation.collect()
+'''
+def _rank_chunk( chunk ):
+    commodityIds , method , funds , duration , keepData = chunk
+    score = getattr( ProfitabilityRanker , method )
+    start = time.time()
+    instrumentationStart = Instrumentation.start()
+    rankings = []
+    for commodityId in commodityIds:
+        
+        #an item whose trend rarely changes scores 0, which its stored
+        #features can tell us without loading its price data
+        features = FeatureStore.get( commodityId )
+        if ( not keepData and features is not None and features[ "trendChanges" ] <= 5 ):
+            if ( method == "get_item_profitability" ):
+                rankings.append( (commodityId , str( features[ "name" ] ) , 0) )
+            else:
+                rankings.append( (commodityId , str( features[ "name" ] ) , \
+                                  np.zeros( ( len( funds ) , len( duration ) ) )) )
+            continue
+        
+        data = PriceReader.get_price_data( commodityId )
+        profitability = score( data , funds , duration , features )
+        if ( keepData ):
+            rankings.append( (data , profitability) )
+        else:
+            rankings.append( (commodityId , data.get_name() , profitability) )
+    seconds = time.time() - start
+    Instrumentation.stop( "ranker.chunk" , instrumentationStart )
+    return (os.getpid() , seconds , rankings , Instrumentation.collect())
+
+'''
+Adds up the best profits the way ProfitabilityRanker.get_item_profitability
+used to, by scanning every window with a loop. This is only kept so main()
+can check ProfitabilityRanker._sum_best_profits against it.
+'''
+def _sum_best_profits_with_loops( prices , duration ):
+    profitSum = 0
+    daysOfProfit = 0
+    for i in range( 0 , prices.size ):
+        window = prices[ i:i+duration ]
+        buyPrice = window[ 0 ]
+        sellPrice = window[ 0 ]
+        for j in range( 0 , len(window) ):
+            if ( sellPrice < window[ j ] ):
+                sellPrice = window[ j ]
+        bestProfit = sellPrice - buyPrice
+        if ( bestProfit > 0 ):
+            profitSum += bestProfit
+            daysOfProfit += 1
+    return (profitSum , daysOfProfit)
 
 def main():
     
+    #the linear time best profits match scanning every window, including the
+    #windows cut off by the end of the series and windows wider than it
+    random = np.random.RandomState( 0 )
+    for trial in range( 0 , 300 ):
+        n = random.randint( 1 , 400 )
+        duration = random.randint( 1 , 60 ) if trial % 10 != 0 else n + random.randint( 0 , 5 )
+        prices = random.randint( 0 , random.choice( [ 3 , 1000 , 10**9 ] ) , n ).astype( np.int64 )
+        assert ProfitabilityRanker._sum_best_profits( prices , duration ) == \
+                _sum_best_profits_with_loops( prices , duration )
+        windowMax = ProfitabilityRanker._sliding_window_max( prices.astype( float ) , duration )
+        assert np.all( windowMax == [ max( prices[ i:i+duration ] ) for i in range( 0 , n ) ] )
+    for commodityId in [ 2 , 447 , 1038 ]:
+        prices = PriceReader.get_price_data( commodityId ).prices()
+        for duration in [ 1 , 7 , 30 , 180 ]:
+            assert ProfitabilityRanker._sum_best_profits( prices , duration ) == \
+                    _sum_best_profits_with_loops( prices , duration )
+    
+    #the rankings are the same when they are scored in parallel
+    serial = ProfitabilityRanker.get_profitability_rankings( 2000000 , 30 )
+    assert len( ProfitabilityRanker.workerTimings ) == 1
+    parallel = ProfitabilityRanker.get_profitability_rankings( 2000000 , 30 , processes=2 , chunkSize=100 )
+    assert [ (x[ 0 ].get_id() , x[ 1 ]) for x in serial ] == \
+            [ (x[ 0 ].get_id() , x[ 1 ]) for x in parallel ]
+    assert sum( [ x[ "chunks" ] for x in ProfitabilityRanker.workerTimings ] ) == \
+            (len( serial ) + 99)//100
+    assert sum( [ x[ "items" ] for x in ProfitabilityRanker.workerTimings ] ) == len( serial )
+    
+    #streaming rankings keep only the ids, names and scores, in the same order
+    expected = [ (x[ 0 ].get_id() , x[ 0 ].get_name() , x[ 1 ]) for x in serial ]
+    assert ProfitabilityRanker.get_top_rankings( 2000000 , 30 ) == expected
+    assert ProfitabilityRanker.get_top_rankings( 2000000 , 30 , k=25 , processes=2 ) == expected[ 0:25 ]
+    
+    #a sweep gives the same scores as scoring every combination separately
+    fundsList = [ 1000 , 2000000 , 10**9 ]
+    durations = [ 1 , 2 , 3 , 7 , 30 , 64 , 180 , 400 ]
+    for commodityId , name , scores in ProfitabilityRanker.iterate_profitability_sweep( \
+                                                fundsList , durations , chunkSize=500 ):
+        if ( commodityId % 5 != 0 ):
+            continue
+        data = PriceReader.get_price_data( commodityId )
+        for i , totalFunds in enumerate( fundsList ):
+            for j , duration in enumerate( durations ):
+                assert scores[ i , j ] == \
+                        ProfitabilityRanker.get_item_profitability( data , totalFunds , duration )
+    for trial in range( 0 , 100 ):
+        prices = random.randint( 0 , 1000 , random.randint( 1 , 300 ) ).astype( np.int64 )
+        table = ProfitabilityRanker._build_range_max_table( prices , 100 )
+        for duration in [ 1 , 3 , 4 , 5 , 17 , 64 , 99 , 100 ]:
+            assert np.all( ProfitabilityRanker._query_range_max( table , duration ) == \
+                    ProfitabilityRanker._sliding_window_max( prices , duration ) )
+    
+    import shutil
+    import tempfile
+    
+    #stored features let items that rarely change trend be skipped without
+    #changing the rankings
+    defaultDirectory = FeatureStore.DIRECTORY
+    FeatureStore.DIRECTORY = tempfile.mkdtemp()
+    try:
+        FeatureStore.build()
+        assert ProfitabilityRanker.get_top_rankings( 2000000 , 30 , processes=2 ) == expected
+        sweep = list( ProfitabilityRanker.iterate_profitability_sweep( fundsList , durations ) )
+        for commodityId , name , scores in sweep[ ::25 ]:
+            assert name == PriceReader.get_price_data( commodityId ).get_name()
+            data = PriceReader.get_price_data( commodityId )
+            assert np.all( scores == ProfitabilityRanker.get_profitability_sweep( data , \
+                                                                fundsList , durations ) )
+        
+        #the average volume and trend changes are read from the features
+        #only when they cover every datapoint
+        for commodityId , name , scores in sweep[ ::25 ]:
+            data = PriceReader.get_price_data( commodityId )
+            features = FeatureStore.get( commodityId )
+            assert ProfitabilityRanker._get_average_volume( data , features ) == \
+                    ProfitabilityRanker._get_average_volume( data )
+            assert ProfitabilityRanker._count_trend_changes( data , features ) == \
+                    ProfitabilityRanker._count_trend_changes( data )
+            features[ "count" ] += 1
+            features[ "volumeSum" ] = 0
+            assert ProfitabilityRanker._get_average_volume( data , features ) == \
+                    ProfitabilityRanker._get_average_volume( data )
+    finally:
+        shutil.rmtree( FeatureStore.DIRECTORY )
+        FeatureStore.DIRECTORY = defaultDirectory
+    
+    #what the workers record is counted once, along with what was recorded
+    #before they started
+    reports = []
+    Instrumentation.enabled = True
+    try:
+        for processes in [ 1 , 2 ]:
+            Instrumentation.reset()
+            for i in range( 0 , 30 ):
+                Instrumentation.record( "reader.csv" , 0.001 , 100 )
+            ProfitabilityRanker.get_top_rankings( 2000000 , 30 , k=10 , processes=processes , \
+                                                  chunkSize=500 )
+            reports.append( Instrumentation.get_report() )
+    finally:
+        Instrumentation.enabled = False
+        Instrumentation.reset()
+    for operation in [ "reader.csv" , "reader.binary" , "ranker.item" , "ranker.chunk" ]:
+        assert reports[ 0 ].get( operation , {} ).get( "count" ) == \
+                reports[ 1 ].get( operation , {} ).get( "count" )
+    assert reports[ 1 ][ "ranker.chunk" ][ "count" ] == (len( serial ) + 499)//500
+    
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = tmpDir + "/item_rankings.csv"
+        assert ProfitabilityRanker.write_rankings( 2000000 , 30 , filename , k=10 ) == 10
+        assert open( filename ).read() == "".join( [ str( name ) + "," + str( commodityId ) + \
+                "," + str( score ) + "\n" for commodityId , name , score in expected[ 0:10 ] ] )
+    finally:
+        shutil.rmtree( tmpDir )
+    print "Regression testing for profitability_filter.py passed."
+    
     
     #data = PriceReader.get_price_data_from_csv( 1038 )
     #print ProfitabilityRanker.get_item_profitability( data , 2000000 , 30 )
     
     
-    rankings = ProfitabilityRanker.get_profitability_rankings( 2000000 , 30 )
-    f = open( "trade_data/item_rankings.csv" , "w" )
-    for ranking in rankings:
-        f.write( str(ranking[ 0 ].get_name()) + "," + str(ranking[ 0 ].get_id()) + "," + str(ranking[ 1 ]) + "\n" )
+    ProfitabilityRanker.write_rankings( 2000000 , 30 , processes=None )
+    for timing in ProfitabilityRanker.workerTimings:
+        print "Worker " + str( timing[ "pid" ] ) + " scored " + str( timing[ "items" ] ) + \
+                " items in " + str( timing[ "chunks" ] ) + " chunks in " + \
+                str( round( timing[ "seconds" ] , 3 ) ) + " seconds"
     #''' 
   
 '''      
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+import os
+from datetime import date
+from crawl_engine import CrawlEngine
+from price_data_io import PriceReader , PriceWriter
+
+'''
+Keeps the master list up to date without downloading every commodity.
+
+The last line of each commodity's CSV file tells us the last day for which we
+have its price data. A commodity is stale if that day is at least staleDays
+days before today, and only stale commodities are downloaded, so fresh ones
+cost no requests at all. Stale commodities are downloaded most important
+first, where importance comes from the latest profitability rankings if
+they exist, or from the price and volume ranges in price_data/item_stats
+otherwise. At most budget requests are made per run, so the commodities that
+do not fit are simply left for the next run.
+'''
+class RefreshScheduler( object ):
+
+    '''
+    The file with the latest profitability rankings, as written by
+    profitability_filter.py
+    '''
+    RANKINGS_FILENAME = "trade_data/item_rankings.csv"
+
+    '''
+    The file with the price and volume ranges of each commodity, as written
+    by IDManager.record_commodity_stats()
+    '''
+    STATS_FILENAME = "price_data/item_stats"
+
+    '''
+    Creates a RefreshScheduler.
+
+    @param budget - the maximum number of requests to make per run
+    @param staleDays - how many days old the last stored datapoint of a
+    commodity has to be before the commodity is downloaded again
+    @param engine - the CrawlEngine with which to download price data. By
+    default, one that makes one request every 2 seconds.
+    @param fetch - the function that downloads the price data of one
+    commodity, see CrawlEngine.crawl(). By default, the commodity's webpage
+    is downloaded, since it is the only source that has trade volumes.
+    '''
+    def __init__( self , budget=100 , staleDays=1 , engine=None , fetch=None ):
+        self.budget = budget
+        self.staleDays = staleDays
+        self.engine = engine if engine is not None else CrawlEngine( rate=0.5 )
+        self.fetch = fetch if fetch is not None else CrawlEngine.fetch_html
+
+    '''
+    Reads how important it is to keep each commodity up to date. If there
+    are profitability rankings, a commodity's priority is its profitability.
+    Otherwise it is the range its price moves over times the highest volume
+    it trades at, so that commodities that are traded a lot and move a lot
+    come first, as described in IDManager.record_commodity_stats().
+
+    @return - a dictionary that maps commodity IDs to their priority. Higher
+    priorities are refreshed first.
+    '''
+    @staticmethod
+    def read_priorities():
+        priorities = {}
+        if ( os.path.exists( RefreshScheduler.RANKINGS_FILENAME ) ):
+            f = open( RefreshScheduler.RANKINGS_FILENAME , "r" )
+            for line in f:
+                #the name of the commodity may have commas in it, but the
+                #ID and the profitability never do
+                data = line.rsplit( "," , 2 )
+                priorities[ int( data[ 1 ] ) ] = float( data[ 2 ] )
+            f.close()
+        elif ( os.path.exists( RefreshScheduler.STATS_FILENAME ) ):
+            f = open( RefreshScheduler.STATS_FILENAME , "r" )
+            for line in f:
+                data = [ int( x ) for x in line.split( "," ) ]
+                priorities[ data[ 0 ] ] = float( data[ 1 ] - data[ 2 ] )*data[ 3 ]
+            f.close()
+        return priorities
+
+    '''
+    Finds how many days old the stored price data of each commodity is,
+    reading only the last line of each CSV file.
+
+    @param commodityIds - the IDs of the commodities, as a list of integers
+    @param today - the day ordinal of today
+    @return - a dictionary that maps each commodity ID to the number of days
+    between its last stored datapoint and today, or None if nothing is
+    stored for the commodity
+    '''
+    @staticmethod
+    def get_staleness( commodityIds , today ):
+        rtn = {}
+        for commodityId in commodityIds:
+            lastDatapoint = PriceReader.get_last_datapoint_from_csv( commodityId )
+            if ( lastDatapoint is None ):
+                rtn[ commodityId ] = None
+            else:
+                rtn[ commodityId ] = today - lastDatapoint.get_date_ordinal()
+        return rtn
+
+    '''
+    Decides which commodities to download in the next run.
+
+    @param commodityIds - the IDs of the commodities to consider, as a list
+    of integers. If None, every commodity in price_data/item_ids is considered.
+    @param today - the day ordinal of today. If None, the current date is used.
+    @return - a (scheduled, deferred, numFresh) tuple, where scheduled is the
+    list of the stale IDs to download, most important first, deferred is the
+    list of the stale IDs that do not fit in the budget, in the same order,
+    and numFresh is the number of commodities that are up to date
+    '''
+    def plan( self , commodityIds=None , today=None ):
+        if ( commodityIds is None ):
+            commodityIds = PriceReader.read_item_ids()
+        if ( today is None ):
+            today = date.today().toordinal()
+
+        staleness = RefreshScheduler.get_staleness( commodityIds , today )
+        priorities = RefreshScheduler.read_priorities()
+
+        #commodities with nothing stored are the most out of date of all
+        stale = [ x for x in commodityIds if staleness[ x ] is None or \
+                    staleness[ x ] >= self.staleDays ]
+        age = lambda x : staleness[ x ] if staleness[ x ] is not None else float( "inf" )
+        stale.sort( key=lambda x : (-priorities.get( x , 0 ) , -age( x )) )
+        return (stale[ 0:self.budget ] , stale[ self.budget: ] , len( commodityIds ) - len( stale ))
+
+    '''
+    Downloads the stale commodities that fit in the budget and appends their
+    new datapoints to the master list. Retries after being throttled count
+    against the budget too, so once it is spent the commodities that have
+    not been downloaded yet are left for the next run.
+
+    @param commodityIds - see plan()
+    @param today - see plan()
+    @return - a dictionary of statistics about the run: how many commodities
+    were fresh, stale and scheduled, how many were refreshed, how many
+    datapoints were appended, which commodities failed or were left for the
+    next run, and how many requests were made
+    '''
+    def run( self , commodityIds=None , today=None ):
+        scheduled , deferred , numFresh = self.plan( commodityIds , today )
+        stats = { "fresh" : numFresh , "stale" : len( scheduled ) + len( deferred ) , \
+                  "scheduled" : len( scheduled ) , \
+                  "refreshed" : 0 , "appended" : 0 }
+
+        def save( commodityId , priceData ):
+            if ( priceData is not None ):
+                stats[ "appended" ] += PriceWriter.save_list_data( priceData )
+                stats[ "refreshed" ] += 1
+
+        self.engine.reset_stats()
+        results , failed = self.engine.crawl( scheduled , self.fetch , save , self.budget )
+        stats[ "failed" ] = failed
+        stats[ "deferred" ] = [ x for x in scheduled if x not in results and x not in failed ] + \
+                                deferred
+        stats[ "requests" ] = self.engine.stats[ "requests" ]
+        return stats
+
+def main():
+    from price_crawler import PriceCrawler , RequestThrottledError
+    from stub_server import StubGrandExchangeServer
+    from price_store import PriceStore
+    from date_utils import DateUtils
+    import shutil
+    import tempfile
+
+    #build the webpages of a few commodities from the full master list
+    ids = [ 2 , 6 , 8 , 447 , 1038 ]
+    pages = dict( [ (x , StubGrandExchangeServer.get_html( x )) for x in ids ] )
+    fetched = []
+    def fetch( commodityId ):
+        fetched.append( commodityId )
+        return PriceCrawler.parse_html( commodityId , pages[ commodityId ] )
+
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp()
+    try:
+        os.makedirs( tmpDir + "/price_data/master_list" )
+        os.makedirs( tmpDir + "/trade_data" )
+        for commodityId in ids:
+            shutil.copy( PriceStore.get_csv_filename( commodityId ) , \
+                         tmpDir + "/" + PriceStore.get_csv_filename( commodityId ) )
+        os.chdir( tmpDir )
+
+        #cut the last 10 days off 447 and 1038 and the last 3 days off 8
+        today = DateUtils.to_ordinal( 2016 , 1 , 8 )
+        for commodityId , days in [ (447 , 10) , (1038 , 10) , (8 , 3) ]:
+            filename = PriceStore.get_csv_filename( commodityId )
+            lines = open( filename ).readlines()
+            open( filename , "w" ).write( "".join( lines[ 0:-days ] ) )
+
+        f = open( RefreshScheduler.STATS_FILENAME , "w" )
+        f.write( "2,243,175,34834834,1534318\n8,185951,140000,371,23\n" + \
+                 "447,343,200,5000000,100000\n1038,3000000,1000000,10,1\n" )
+        f.close()
+
+        #fresh commodities cost nothing, and stale ones are downloaded by
+        #priority until the budget is spent
+        engine = CrawlEngine( rate=1000 , threads=2 )
+        scheduler = RefreshScheduler( budget=2 , engine=engine , fetch=fetch )
+        assert scheduler.plan( ids , today ) == ([ 447 , 1038 ] , [ 8 ] , 2)
+        stats = scheduler.run( ids , today )
+        assert sorted( fetched ) == [ 447 , 1038 ]
+        assert stats[ "requests" ] == 2 and stats[ "refreshed" ] == 2
+        assert stats[ "appended" ] == 20 and stats[ "deferred" ] == [ 8 ]
+        for commodityId in [ 447 , 1038 ]:
+            assert open( PriceStore.get_csv_filename( commodityId ) ).read() == \
+                    open( cwd + "/" + PriceStore.get_csv_filename( commodityId ) ).read()
+
+        #the next run picks up what was left, and then nothing is stale
+        del fetched[ : ]
+        stats = scheduler.run( ids , today )
+        assert fetched == [ 8 ] and stats[ "appended" ] == 3 and stats[ "fresh" ] == 4
+        del fetched[ : ]
+        stats = scheduler.run( ids , today )
+        assert fetched == [] and stats[ "requests" ] == 0 and stats[ "fresh" ] == 5
+
+        #rankings take precedence over the item stats
+        open( RefreshScheduler.RANKINGS_FILENAME , "w" ).write( \
+                "Cannonball,2,5\nRed partyhat,1038,100\nMithril ore,447,7\n" )
+        assert RefreshScheduler.read_priorities() == { 2 : 5.0 , 1038 : 100.0 , 447 : 7.0 }
+        assert scheduler.plan( ids , today + 1 )[ 0 ] == [ 1038 , 447 ]
+
+        #retries after being throttled count against the budget
+        def throttled( commodityId ):
+            raise RequestThrottledError( "Too many requests" )
+        engine = CrawlEngine( rate=1000 , threads=1 , maxRetries=2 , backoff=0 , maxBackoff=0 )
+        scheduler = RefreshScheduler( budget=4 , engine=engine , fetch=throttled )
+        stats = scheduler.run( ids , today + 1 )
+        assert stats[ "requests" ] == 4 and stats[ "failed" ] == [ 1038 ]
+        assert stats[ "deferred" ] == [ 447 , 2 , 6 , 8 ]
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( tmpDir )
+
+    print "Regression testing for refresh_scheduler.py passed."
+
+if __name__ == "__main__" : main()
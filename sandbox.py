@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from price_crawler import PriceCrawler
 from price_data_io import PriceWriter
-from time import sleep
+from crawl_engine import CrawlEngine
 
 import matplotlib.pyplot as plt
 
@@ -11,24 +11,29 @@ import matplotlib.pyplot as plt
 #coalData = DataManager.get_data_by_date_range( "Coal" , 2 , 2015 , 8 , 2015 )
 
 #DO NOT USE IF YOU ARE UPDATING DATA - ONLY USE IF YOU ARE DOWNLOADING FROM SCRATCH
-def download_data_by_id( id ):
-    priceData = PriceCrawler.get_price_data_from_html( id )
+def save_downloaded_data( id , priceData ):
+    print "Processing " + str( id )
     if ( priceData != None ):
         f = open( "price_data/item_ids" , "a" )
         f.write( priceData.get_name() + "," + str( id ) + "\n" )
         f.close()
         PriceWriter.write_price_data_to_csv( "price_data/master_list/" + str(id) + ".csv" , priceData )
+        
+#DO NOT USE IF YOU ARE UPDATING DATA - ONLY USE IF YOU ARE DOWNLOADING FROM SCRATCH
+def download_data_by_id( id ):
+    save_downloaded_data( id , PriceCrawler.get_price_data_from_html( id ) )
     
 f = open( "price_data/item_stats" , "r" )
 startID = 2134
 endID = 12520
+itemIDs = []
 for line in f:
     data = line.split( "," )
     itemID = int( data[ 0 ] )
     if ( startID <= itemID and itemID <= endID ):
-        print "Processing " + str( itemID )
-        download_data_by_id( itemID )
-        print "Sleeping 2"
-        sleep( 2 )
+        itemIDs.append( itemID )
+        
+#the crawl engine keeps us to one request every 2 seconds
+CrawlEngine( rate=0.5 ).crawl_html( itemIDs , save_downloaded_data )
     
     
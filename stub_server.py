@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import BaseHTTPServer
+import SocketServer
+import calendar
+import email.utils
+import hashlib
+import re
+import threading
+import time
+from price_data_io import PriceReader
+
+'''
+A local HTTP server that imitates the Grand Exchange database for regression
+testing the crawler without going to the real website.
+
+The server serves the item webpages (/viewitem?obj=<id>) and the graph json
+(/api/graph/<id>.json) of every commodity in price_data/master_list, built
+from the last 180 days of its stored price data. Unknown IDs get the
+Grand Exchange's error page.
+
+Pages are served with an ETag, and a request whose If-None-Match header
+matches it gets a 304 Not Modified response with no body.
+
+To simulate throttling, a request that arrives less than minInterval seconds
+after the previous accepted request gets the "too many requests" page
+instead, as do the first throttleFirst requests.
+'''
+class StubGrandExchangeServer( object ):
+
+    ERROR_PAGE = "<html><body><p>Sorry, there was a problem with your request.</p></body></html>"
+
+    THROTTLED_PAGE = "<html><body><p>Sorry, there was a problem with your request.</p>" + \
+        "<p>You've made too many requests recently.</p><p>As a result, your IP " + \
+        "address has been temporarily blocked. Please try again later.</p></body></html>"
+
+    '''
+    Creates a stub server listening on a free local port. The server is not
+    started until start() is called.
+
+    @param minInterval - the minimum number of seconds between requests
+    before the server starts throttling
+    @param throttleFirst - the number of requests to throttle before
+    serving any real pages
+    '''
+    def __init__( self , minInterval=0 , throttleFirst=0 ):
+        self.minInterval = minInterval
+        self.throttleFirst = throttleFirst
+        self.requests = 0
+        self.throttled = 0
+        self.lastAccepted = None
+        self.lock = threading.Lock()
+        self.lastModified = email.utils.formatdate( usegmt=True )
+
+        stub = self
+        class Handler( BaseHTTPServer.BaseHTTPRequestHandler ):
+            def do_GET( self ):
+                status , body = stub.respond( self.path )
+                etag = None
+                if ( status == 200 and body != StubGrandExchangeServer.THROTTLED_PAGE ):
+                    etag = '"' + hashlib.md5( body ).hexdigest() + '"'
+                    if ( self.headers.get( "If-None-Match" ) == etag ):
+                        self.send_response( 304 )
+                        self.send_header( "ETag" , etag )
+                        self.end_headers()
+                        return
+                self.send_response( status )
+                self.send_header( "Content-Type" , "text/html" )
+                self.send_header( "Content-Length" , str( len( body ) ) )
+                if ( etag is not None ):
+                    self.send_header( "ETag" , etag )
+                    self.send_header( "Last-Modified" , stub.lastModified )
+                self.end_headers()
+                self.wfile.write( body )
+            def log_message( self , format , *args ):
+                pass
+
+        self.server = ThreadingHTTPServer( ("127.0.0.1" , 0) , Handler )
+        self.thread = None
+
+    '''
+    @return - the base URL of this server, for PriceCrawler.BASE_URL
+    '''
+    def get_url( self ):
+        return "http://127.0.0.1:" + str( self.server.server_address[ 1 ] )
+
+    '''
+    Starts serving requests on a background thread.
+    '''
+    def start( self ):
+        self.thread = threading.Thread( target=self.server.serve_forever )
+        self.thread.daemon = True
+        self.thread.start()
+
+    '''
+    Stops serving requests.
+    '''
+    def stop( self ):
+        self.server.shutdown()
+        self.server.server_close()
+
+    '''
+    Determines the response to a request for the given path.
+
+    @param path - the path of the request, as a string
+    @return - a (status code, body) tuple
+    '''
+    def respond( self , path ):
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            if ( self.throttleFirst > 0 or ( self.lastAccepted is not None and \
+                    now - self.lastAccepted < self.minInterval ) ):
+                self.throttleFirst = max( 0 , self.throttleFirst-1 )
+                self.throttled += 1
+                return (200 , StubGrandExchangeServer.THROTTLED_PAGE)
+            self.lastAccepted = now
+
+        match = re.match( r"/viewitem\?obj=(-?\d+)$" , path )
+        if ( match is not None ):
+            return (200 , self.get_html( int( match.group( 1 ) ) ))
+        match = re.match( r"/api/graph/(-?\d+)\.json$" , path )
+        if ( match is not None ):
+            json = self.get_json( int( match.group( 1 ) ) )
+            if ( json is None ):
+                return (404 , "<html><body>404 - Page not found</body></html>")
+            return (200 , json)
+        return (404 , "<html><body>404 - Page not found</body></html>")
+
+    '''
+    @param objectId - the ID of a commodity, as an integer
+    @return - the last 180 days of the commodity's stored price data, or
+    None if there is no stored data for the commodity
+    '''
+    @staticmethod
+    def get_recent_data( objectId ):
+        priceData = PriceReader.get_price_data_from_csv( objectId )
+        if ( priceData is None ):
+            return None
+        datapoints = priceData.get_all_datapoints()
+        return (priceData.get_name() , datapoints[ -180: ])
+
+    '''
+    Builds the item webpage of a commodity, which pushes its daily prices,
+    average prices and volumes to the graphs on the page.
+
+    @param objectId - the ID of a commodity, as an integer
+    @return - the HTML of the webpage, as a string
+    '''
+    @staticmethod
+    def get_html( objectId ):
+        recentData = StubGrandExchangeServer.get_recent_data( objectId )
+        if ( recentData is None ):
+            return StubGrandExchangeServer.ERROR_PAGE
+        name , datapoints = recentData
+        lines = [ "<html><head><title>" + name + " - Grand Exchange - Old School RuneScape</title></head>" , \
+                  "<body><h2>" + name + "</h2><script>" ]
+        for x in datapoints:
+            lines.append( "average180.push([new Date('" + x.get_year() + "/" + x.get_month() + \
+                          "/" + x.get_day() + "'), " + str( x.get_price() ) + ", " + \
+                          str( x.get_average180_price() ) + "]);" )
+        for x in datapoints:
+            lines.append( "trade180.push([new Date('" + x.get_year() + "/" + x.get_month() + \
+                          "/" + x.get_day() + "'), " + str( x.get_volume() ) + "]);" )
+        lines.append( "</script></body></html>" )
+        return "\n".join( lines )
+
+    '''
+    Builds the graph json of a commodity, which maps the timestamp (in
+    milliseconds) of midnight UTC on each day to the prices on that day.
+
+    @param objectId - the ID of a commodity, as an integer
+    @return - the json, as a string, or None if the commodity is unknown
+    '''
+    @staticmethod
+    def get_json( objectId ):
+        recentData = StubGrandExchangeServer.get_recent_data( objectId )
+        if ( recentData is None ):
+            return None
+        name , datapoints = recentData
+        timestamps = [ str( calendar.timegm( (int( x.get_year() ) , int( x.get_month() ) , \
+                            int( x.get_day() ) , 0 , 0 , 0) )*1000 ) for x in datapoints ]
+        daily = ",".join( [ '"' + t + '":' + str( x.get_price() ) \
+                            for t , x in zip( timestamps , datapoints ) ] )
+        average = ",".join( [ '"' + t + '":' + str( x.get_average180_price() ) \
+                            for t , x in zip( timestamps , datapoints ) ] )
+        return '{"daily":{' + daily + '},"average":{' + average + '}}'
+
+'''
+An HTTP server that handles every request on its own thread.
+'''
+class ThreadingHTTPServer( SocketServer.ThreadingMixIn , BaseHTTPServer.HTTPServer ):
+    daemon_threads = True
+
+def main():
+    from price_crawler import PriceCrawler
+    from http_cache import HttpCache
+
+    server = StubGrandExchangeServer( throttleFirst=1 )
+    server.start()
+    defaultUrl = PriceCrawler.BASE_URL
+    defaultWait = PriceCrawler.BLOCKED_WAIT
+    PriceCrawler.BASE_URL = server.get_url()
+    PriceCrawler.BLOCKED_WAIT = 0
+    HttpCache.enabled = False
+    try:
+        fromHTML = PriceCrawler.get_price_data_from_html( 447 )
+        assert server.throttled == 1 and server.requests == 2
+        stored = PriceReader.get_price_data_from_csv( 447 )
+        assert fromHTML.get_all_datapoints() == stored.get_all_datapoints()[ -180: ]
+        assert fromHTML.get_name() == "Mithril ore"
+        assert PriceCrawler.get_price_data_from_html( 1 ) is None
+
+        fromJSON = PriceCrawler.get_price_data_from_json( "Mithril ore" , 447 )
+        assert fromJSON.get_num_datapoints() == fromHTML.get_num_datapoints()
+        assert fromJSON.get_data_at( 0 ).get_date_ordinal() == \
+                fromHTML.get_data_at( 0 ).get_date_ordinal()
+        assert fromJSON.get_data_at( -1 ).get_price() == 252
+        assert PriceCrawler.get_price_data_from_json( "Nothing" , 1 ) is None
+    finally:
+        PriceCrawler.BASE_URL = defaultUrl
+        PriceCrawler.BLOCKED_WAIT = defaultWait
+        HttpCache.enabled = True
+        server.stop()
+
+    print "Regression testing for stub_server.py passed."
+
+if __name__ == "__main__" : main()